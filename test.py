@@ -1,7 +1,88 @@
+import os
+import json
+import shutil
+import tempfile
 import unittest
 import numpy as np
+from scipy.io import savemat
 from visualization.python.util import *
 from visualization.python.util_vtk import *
+from visualization.python.render import parse_indices
+from visualization.python.octree import VoxelOctree
+from visualization.python.cache import ShapeCache, voxels_arrays, arrays_voxels
+from visualization.python.gallery import grid_offsets, page_blocks, Gallery
+from visualization.python import profiling
+from visualization.python.batch import chunk_ranges, preprocess_file
+from visualization.python import mesh
+from visualization.python.similarity import ShapeIndex
+from visualization.python.watcher import Watcher
+from visualization.python import chunked
+
+class Test_read_tensor(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.voxels = np.random.RandomState(0).rand(5, 1, 4, 3, 2)
+        self.filename = os.path.join(self.directory, 'chair_sample.mat')
+        savemat(self.filename, {'inputs': np.ones((5, 200)), 'voxels': self.voxels})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_valid_1(self):
+        a = self.voxels[:, 0]
+        self.assertTrue(np.array_equal(a, read_tensor(self.filename)))
+        tensor = read_tensor(self.filename, lazy=True)
+        self.assertEqual((5, 4, 3, 2), tensor.shape)
+        self.assertTrue(np.array_equal(a[3], tensor[3]))
+        self.assertTrue(np.array_equal(a[[4, 0, 4]], tensor[[4, 0, 4]]))
+        self.assertTrue(np.array_equal(a[-1, 1:], tensor[-1, 1:]))
+
+    def test_valid_2(self):
+        tensor = read_tensor(self.filename, lazy=True, cache=True)
+        self.assertTrue(os.path.exists(sidecar_path(self.filename)))
+        self.assertTrue(np.array_equal(self.voxels[2, 0], tensor[2]))
+        self.assertTrue(np.array_equal(self.voxels[:, 0], read_tensor(self.filename, cache=True)))
+
+    def test_valid_3(self):
+        savemat(self.filename, {'voxels': self.voxels}, do_compression=True)
+        self.assertIsNone(mat5_variable(self.filename, 'voxels'))
+        self.assertTrue(np.array_equal(self.voxels[1, 0], read_tensor(self.filename, lazy=True)[1]))
+
+    def test_invalid_1(self):
+        tensor = read_tensor(self.filename, lazy=True)
+        self.assertRaises(IndexError, tensor.__getitem__, 5)
+        self.assertIsNone(mat5_variable(self.filename, 'missing'))
+
+
+class Test_voxel_archive(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.voxels = np.random.RandomState(0).rand(3, 4, 5, 6)
+        self.filename = os.path.join(self.directory, 'chair_sample.npz')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_valid_1(self):
+        write_voxel_archive(self.filename, self.voxels, inputs=np.ones((3, 200)))
+        tensor = read_tensor(self.filename, lazy=True)
+        self.assertEqual(self.voxels.shape, tensor.shape)
+        self.assertTrue(np.abs(tensor[1] - self.voxels[1]).max() <= 1 / 510.)
+        self.assertTrue(np.abs(read_tensor(self.filename) - self.voxels).max() <= 1 / 510.)
+        self.assertTrue(np.array_equal(np.ones((3, 200)), read_inputs(self.filename)))
+
+    def test_valid_2(self):
+        write_voxel_archive(self.filename, self.voxels, encoding='bits', threshold=0.3)
+        a = (self.voxels >= 0.3).astype(float)
+        self.assertTrue(np.array_equal(a[[2, 0]], read_tensor(self.filename, lazy=True)[[2, 0]]))
+        self.assertIsNone(read_inputs(self.filename))
+
+    def test_invalid_1(self):
+        self.assertRaises(AssertionError, write_voxel_archive, self.filename, self.voxels,
+                          encoding='float16')
+
 
 class Test_sigmoid(unittest.TestCase):
 
@@ -132,6 +213,34 @@ class Test_center_of_mass(unittest.TestCase):
         self.assertNotEqual(a, center_of_mass(voxels, threshold=threshold))
 
 
+class Test_shape_statistics(unittest.TestCase):
+
+    def test_valid_1(self):
+        rng = np.random.RandomState(0)
+        voxels = rng.rand(5, 6, 7, 8) * (rng.rand(5, 6, 7, 8) < 0.3)
+        voxels[2] = 0
+        columns = shape_statistics(voxels, (0.1, 0.5), distance=2, chunk_size=2)
+        for ind in (0, 1, 3, 4):
+            occupied = voxels[ind] >= 0.1
+            coords = np.argwhere(occupied)
+            self.assertTrue(np.allclose(center_of_mass(voxels[ind], 0.1),
+                                        [columns['center_' + axis][ind] for axis in 'xyz']))
+            self.assertEqual(list(coords.min(0)), [columns['min_' + axis][ind] for axis in 'xyz'])
+            self.assertEqual(list(coords.max(0)), [columns['max_' + axis][ind] for axis in 'xyz'])
+            self.assertEqual(occupied.sum(), columns['occupied_0.1'][ind])
+            self.assertEqual((voxels[ind] >= 0.5).sum(), columns['occupied_0.5'][ind])
+            self.assertAlmostEqual(voxels[ind][occupied].mean(), columns['mean_confidence'][ind])
+            self.assertAlmostEqual(max_connected(occupied, 2).sum() / float(occupied.sum()),
+                                   columns['largest_component_fraction'][ind])
+
+    def test_valid_2(self):
+        voxels = np.zeros((1, 4, 4, 4))
+        columns = shape_statistics(voxels, distance=0)
+        self.assertEqual([2, 2, 2], [columns['center_' + axis][0] for axis in 'xyz'])
+        self.assertEqual(-1, columns['min_x'][0])
+        self.assertTrue(np.isnan(columns['mean_confidence'][0]))
+
+
 class Test_voxel_exist(unittest.TestCase):
     
     def test_valid_1(self):
@@ -163,6 +272,202 @@ class Test_voxel_exist(unittest.TestCase):
         self.assertNotEqual(a, voxel_exist(voxels, coord_x, coord_y, coord_z))
 
 
+class Test_downsample(unittest.TestCase):
+
+    def test_valid_1(self):
+        voxels = np.random.RandomState(0).rand(2, 4, 4, 4)
+        a = voxels.reshape(2, 2, 2, 2, 2, 2, 2).max(axis=(2, 4, 6))
+        self.assertTrue(np.array_equal(a, downsample(voxels, 2, method='max')))
+        a = voxels.reshape(2, 2, 2, 2, 2, 2, 2).mean(axis=(2, 4, 6))
+        self.assertTrue(np.allclose(a, downsample(voxels, 2, method='mean')))
+        a = voxels[1].reshape(2, 2, 2, 2, 2, 2).min(axis=(1, 3, 5))
+        self.assertTrue(np.array_equal(a, downsample(voxels[1], 2, method='min')))
+
+    def test_valid_2(self):
+        voxels = np.arange(5.).reshape(5, 1, 1) / 5
+        self.assertEqual([0.2, 0.6, 0.8], list(downsample(voxels, 2, edge='pad').ravel()))
+        self.assertEqual([0.1, 0.5, 0.8], list(downsample(voxels, 2, method='mean').ravel()))
+        self.assertEqual([0, 1, 1], list(downsample(voxels, 2, method='occupancy',
+                                                    threshold=0.3).ravel()))
+        self.assertEqual((2, 1, 1), downsample(np.ones((5, 4, 4)), 4, edge='pad').shape)
+        self.assertEqual((1, 1, 1), downsample(np.ones((5, 4, 4)), 4, edge='crop').shape)
+
+    def test_invalid_1(self):
+        voxels = np.ones((4, 4, 4))
+        self.assertRaises(AssertionError, downsample, voxels, 2, method='median')
+        self.assertRaises(AssertionError, downsample, voxels, 1.5)
+
+
+def flood_fill_max_connected(voxels, distance):
+    """ Reference stack flood fill, as util.max_connected was originally written """
+    max_component = np.zeros(voxels.shape, dtype=bool)
+    voxels = np.copy(voxels)
+    for start_x in range(voxels.shape[0]):
+        for start_y in range(voxels.shape[1]):
+            for start_z in range(voxels.shape[2]):
+                if not voxels[start_x, start_y, start_z]:
+                    continue
+                component = np.zeros(voxels.shape, dtype=bool)
+                stack = [[start_x, start_y, start_z]]
+                component[start_x, start_y, start_z] = True
+                voxels[start_x, start_y, start_z] = False
+                while len(stack) > 0:
+                    coord_x, coord_y, coord_z = stack.pop()
+                    for i in range(coord_x-distance, coord_x+distance + 1):
+                        for j in range(coord_y-distance, coord_y+distance + 1):
+                            for k in range(coord_z-distance, coord_z+distance + 1):
+                                if (i-coord_x)**2+(j-coord_y)**2+(k-coord_z)**2 > distance*distance:
+                                    continue
+                                if voxel_exist(voxels, i, j, k):
+                                    voxels[i, j, k] = False
+                                    component[i, j, k] = True
+                                    stack.append([i, j, k])
+                if component.sum() > max_component.sum():
+                    max_component = component
+    return max_component
+
+
+class Test_max_connected(unittest.TestCase):
+
+    def test_valid_1(self):
+        rng = np.random.RandomState(0)
+        for _ in range(20):
+            voxels = rng.rand(*rng.randint(1, 10, 3)) < rng.rand() * 0.3
+            distance = rng.randint(1, 4)
+            a = flood_fill_max_connected(voxels, distance)
+            self.assertTrue(np.array_equal(a, max_connected(voxels, distance)))
+
+    def test_valid_2(self):
+        voxels = np.zeros((6, 1, 1), dtype=bool)
+        voxels[[0, 2, 5]] = True
+        a = np.zeros((6, 1, 1), dtype=bool)
+        a[[0, 2]] = True
+        self.assertTrue(np.array_equal(a, max_connected(voxels, 2)))
+
+    def test_valid_3(self):
+        voxels = np.zeros((4, 4, 4), dtype=bool)
+        self.assertFalse(max_connected(voxels, 1).any())
+
+
+class Test_connected_components(unittest.TestCase):
+
+    def test_valid_1(self):
+        voxels = np.zeros((7, 1, 1), dtype=bool)
+        voxels[[0, 1, 4, 6]] = True
+        labels, sizes = connected_components(voxels, 1)
+        self.assertEqual([1, 1, 0, 0, 2, 0, 3], list(labels.ravel()))
+        self.assertEqual([0, 2, 1, 1], list(sizes))
+
+    def test_valid_2(self):
+        rng = np.random.RandomState(1)
+        voxels = rng.rand(5, 8, 8, 8) < 0.05
+        keep = largest_component(voxels, 2)
+        for ind in range(voxels.shape[0]):
+            a = flood_fill_max_connected(voxels[ind], 2)
+            self.assertTrue(np.array_equal(a, keep[ind]))
+
+
+class Test_SparseVoxels(unittest.TestCase):
+
+    def test_valid_1(self):
+        voxels = np.array([[[1, 0.5], [0.01, 0]], [[0.2, 0], [np.pi, 0]]])
+        sparse = SparseVoxels.from_dense(voxels, threshold=0.1)
+        self.assertEqual(4, len(sparse))
+        self.assertTrue(np.array_equal([[0, 0, 0], [0, 0, 1], [1, 0, 0], [1, 1, 0]], sparse.coords))
+        self.assertTrue(np.array_equal(np.where(voxels >= 0.1, voxels, 0), sparse.to_dense()))
+        self.assertTrue(np.allclose(center_of_mass(voxels, 0.3),
+                                    sparse.threshold(0.3).center_of_mass()))
+
+    def test_valid_2(self):
+        rng = np.random.RandomState(0)
+        voxels = rng.rand(9, 13, 7)
+        sparse = SparseVoxels.from_dense(voxels, threshold=0.4)
+        dense = sparse.to_dense()
+        for method in ('max', 'mean', 'min', 'occupancy'):
+            for edge in ('pad', 'crop'):
+                result = sparse.downsample(2, method=method, edge=edge)
+                expected = downsample(dense, 2, method=method, threshold=0.4, edge=edge)
+                self.assertTrue(np.allclose(expected, result.to_dense(float)))
+
+    def test_valid_3(self):
+        rng = np.random.RandomState(0)
+        occupied = rng.rand(12, 10, 8) >= 0.7
+        sparse = SparseVoxels.from_dense(occupied, threshold=1)
+        for distance in (1, 2):
+            result = sparse.largest_component(distance)
+            self.assertTrue(np.array_equal(max_connected(occupied, distance), result.mask()))
+        self.assertEqual(3, len(generate_all_blocks(sparse, threshold=1)[:3]))
+
+
+class Test_extract_surface(unittest.TestCase):
+
+    def test_valid_1(self):
+        voxels = np.zeros((4, 4, 4), dtype=bool)
+        voxels[1:3, 1:3, 1:3] = True
+        quads, keys, stats = extract_surface(voxels)
+        self.assertEqual(6, len(quads))
+        self.assertEqual({'faces': 48, 'exposed_faces': 24, 'culled_faces': 24,
+                          'quads': 6, 'merged_faces': 18}, stats)
+        self.assertEqual([0]*6, list(keys))
+
+    def test_valid_2(self):
+        rng = np.random.RandomState(0)
+        voxels = rng.rand(9, 7, 8) < 0.4
+        quads, _, stats = extract_surface(voxels)
+        normals = np.cross(quads[:, 1] - quads[:, 0], quads[:, 3] - quads[:, 0])
+        self.assertEqual(stats['exposed_faces'], np.abs(normals).sum())
+        centers = quads.mean(1)
+        unit = normals / np.linalg.norm(normals, axis=1)[:, np.newaxis]
+        inside = np.floor(centers - 0.01 * unit).astype(int)
+        self.assertTrue(voxels[tuple(inside.T)].all())
+        outside = np.floor(centers + 0.01 * unit).astype(int)
+        valid = np.all((outside >= 0) & (outside < voxels.shape), axis=1)
+        self.assertFalse(voxels[tuple(outside[valid].T)].any())
+
+    def test_valid_3(self):
+        voxels = np.zeros((2, 1, 1))
+        voxels[0] = 0.2
+        voxels[1] = 0.9
+        quads, keys, stats = extract_surface(voxels > 0, voxels, levels=10)
+        self.assertEqual(10, stats['quads'])
+        self.assertEqual({2, 9}, set(keys))
+
+
+class Test_VoxelOctree(unittest.TestCase):
+
+    def test_valid_1(self):
+        voxels = np.zeros((8, 8, 8))
+        voxels[0:4, 0:4, 0:4] = 0.5
+        voxels[7, 7, 7] = 1
+        blocks, values = VoxelOctree(voxels, threshold=0.1).blocks()
+        self.assertEqual(2, len(blocks))
+        self.assertTrue(np.array_equal([7.5, 7.5, 7.5, 1, 1, 1], blocks[0]))
+        self.assertTrue(np.array_equal([2, 2, 2, 4, 4, 4], blocks[1]))
+        self.assertTrue(np.allclose([1, 0.5], values))
+
+    def test_valid_2(self):
+        rng = np.random.RandomState(0)
+        voxels = rng.rand(9, 13, 7)
+        voxels[2:8, 2:10, 0:4] = 1
+        occupied = voxels >= 0.5
+        octree = VoxelOctree(voxels, threshold=0.5)
+        points = np.argwhere(np.ones(voxels.shape))
+        self.assertTrue(np.array_equal(occupied.ravel(), octree.occupied(points)))
+        self.assertFalse(octree.occupied([[-1, 0, 0], [9, 0, 0]]).any())
+        self.assertEqual(occupied[1:5, 2:13, 3:6].sum(), octree.count((1, 2, 3), (5, 13, 6)))
+        blocks, _ = octree.blocks()
+        self.assertEqual(occupied.sum(), (blocks[:, 3] ** 3).sum())
+        self.assertLess(len(blocks), occupied.sum())
+
+    def test_valid_3(self):
+        voxels = np.zeros((8, 8, 8))
+        voxels[0:4, 0:4, 0:4] = 0.5
+        actors = generate_all_blocks(voxels, uniform_size=0.9, merge=True, lod=True)
+        bounds = actors[0].GetMapper().GetInput().GetBounds()
+        self.assertTrue(np.allclose((0.05, 3.95, 0.05, 3.95, 0.05, 3.95), bounds))
+        self.assertEqual(1, len(generate_all_blocks(voxels, lod=True)))
+
+
 class Test_block_generation(unittest.TestCase):
 
     def test_valid_1(self):
@@ -173,5 +478,475 @@ class Test_block_generation(unittest.TestCase):
         self.assertEqual(a, block_generation(z_var, offset=offset, ratio=ratio))
 
 
+class Test_generate_merged_blocks(unittest.TestCase):
+
+    def test_valid_1(self):
+        voxels = np.array([[[1, 0.5], [0.01, 0]], [[0.2, 0], [np.pi, 0]]])
+        actor = generate_merged_blocks(voxels, threshold=0.1, use_colormap=True)
+        poly_data = actor.GetMapper().GetInput()
+        self.assertEqual(8 * 4, poly_data.GetNumberOfPoints())
+        self.assertEqual(6 * 4, poly_data.GetNumberOfCells())
+        self.assertEqual(8 * 4, poly_data.GetPointData().GetScalars().GetNumberOfTuples())
+
+    def test_valid_2(self):
+        voxels = np.array([[[1, 0.5], [0.01, 0]], [[0.2, 0], [np.pi, 0]]])
+        actor = generate_merged_blocks(voxels, threshold=0.1, uniform_size=0.5)
+        bounds = actor.GetMapper().GetInput().GetBounds()
+        self.assertEqual((0.25, 1.75, 0.25, 1.75, 0.25, 1.75), bounds)
+        self.assertEqual(1, len(generate_all_blocks(voxels, merge=True)))
+
+    def test_valid_3(self):
+        voxels = np.ones((3, 3, 3))
+        actors = generate_all_blocks(voxels, uniform_size=0.9, use_colormap=True, surface=True)
+        self.assertEqual(1, len(actors))
+        self.assertEqual(6, actors[0].GetMapper().GetInput().GetNumberOfCells())
+
+
+class Test_preprocess(unittest.TestCase):
+
+    def test_valid_1(self):
+        voxels = np.zeros((8, 4, 4))
+        voxels[0:3] = 0.5
+        voxels[6] = 0.9
+        a = np.copy(voxels)
+        a[6] = 0
+        result = preprocess(voxels, threshold=0.1, connect=1)
+        self.assertTrue(np.array_equal(a, result))
+        self.assertEqual(0.9, voxels[6, 0, 0])
+        self.assertEqual((4, 2, 2), preprocess(voxels, connect=1, factor=2).shape)
+
+
+class Test_parse_indices(unittest.TestCase):
+
+    def test_valid_1(self):
+        self.assertEqual([0, 1, 2], parse_indices('all', 3))
+        self.assertEqual([2], parse_indices('3', 3))
+        self.assertEqual([0, 1, 2, 4], parse_indices('1-3,5', 5))
+
+    def test_invalid_1(self):
+        self.assertRaises(ValueError, parse_indices, '4', 3)
+        self.assertRaises(ValueError, parse_indices, '0-2', 3)
+        self.assertRaises(ValueError, parse_indices, '3-1', 3)
+
+
+class Test_isosurface_polydata(unittest.TestCase):
+
+    def test_valid_1(self):
+        voxels = np.zeros((5, 6, 7))
+        voxels[1:4, 2:4, 2:6] = 1
+        poly_data = isosurface_polydata(voxels, threshold=0.5, use_colormap=True)
+        bounds = poly_data.GetBounds()
+        self.assertTrue(np.allclose((1, 4, 2, 4, 2, 6), bounds))
+        self.assertEqual(poly_data.GetNumberOfPoints(),
+                         poly_data.GetPointData().GetScalars().GetNumberOfTuples())
+
+    def test_valid_2(self):
+        directory = tempfile.mkdtemp()
+        try:
+            voxels = np.zeros((6, 6, 6))
+            voxels[1:5, 1:5, 1:5] = 0.8
+            actors = [generate_isosurface(voxels, threshold=0.5, decimate=0.5, smooth=5)]
+            for extension in ('ply', 'stl', 'obj', 'vtp'):
+                filename = os.path.join(directory, 'shape.' + extension)
+                export_mesh(actors, filename)
+                self.assertTrue(os.path.getsize(filename) > 0)
+        finally:
+            shutil.rmtree(directory)
+
+
+class Test_volume_actor(unittest.TestCase):
+
+    def test_valid_1(self):
+        voxels = np.zeros((6, 5, 4))
+        voxels[1:3, 0:2, 0:3] = 0.8
+        volume = volume_actor(voxels, threshold=0.5, use_colormap=True)
+        # voxel centers, matrix axes
+        self.assertTrue(np.allclose((0.5, 5.5, 0.5, 4.5, 0.5, 3.5), volume.GetBounds()))
+        scalars = volume.GetMapper().GetInput().GetPointData().GetScalars()
+        self.assertTrue(np.shares_memory(voxels, numpy_support.vtk_to_numpy(scalars)))
+        opacity = volume.GetProperty().GetScalarOpacity()
+        self.assertEqual(0, opacity.GetValue(0.4))
+        self.assertAlmostEqual(0.8, opacity.GetValue(1))
+
+    def test_valid_2(self):
+        directory = tempfile.mkdtemp()
+        try:
+            voxels = np.zeros((6, 6, 6))
+            voxels[1:5, 1:5, 1:5] = 0.8
+            filename = os.path.join(directory, 'shape.png')
+            visualization(SparseVoxels.from_dense(voxels, 0.1), 0.1, volume=True,
+                          filename=filename, export=os.path.join(directory, 'shape.ply'))
+            self.assertTrue(os.path.getsize(filename) > 0)
+        finally:
+            shutil.rmtree(directory)
+
+
+class Test_InteractiveScene(unittest.TestCase):
+
+    def test_valid_1(self):
+        voxels = np.zeros((6, 5, 4))
+        voxels[0:2, 0:2, 0:3] = 0.8
+        voxels[4, 4, 3] = 0.3
+        scene = InteractiveScene(voxels, threshold=0.1, uniform_size=0.5)
+        self.assertEqual(13, scene.number_of_blocks())
+        self.assertTrue(np.allclose((0.25, 4.75, 0.25, 4.75, 0.25, 3.75), scene.actor.GetBounds()))
+        scene.set_threshold(0.5)
+        self.assertEqual(12, scene.number_of_blocks())
+        scene.set_threshold(0.2)
+        scene.set_largest(True)
+        self.assertEqual(12, scene.number_of_blocks())
+
+
+class Test_ShapeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'voxels.mat')
+        savemat(self.filename, {'voxels': np.ones((2, 1, 3, 3, 3))})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_valid_1(self):
+        cache = ShapeCache(os.path.join(self.directory, 'cache'))
+        key = cache.key(self.filename, index=1, threshold=0.1)
+        self.assertNotEqual(key, cache.key(self.filename, index=1, threshold=0.2))
+        self.assertIsNone(cache.get(key))
+        sparse = SparseVoxels.from_dense(np.eye(3)[np.newaxis].repeat(2, 0), threshold=0.5)
+        cache.put(key, voxels_arrays(sparse))
+        result = arrays_voxels(cache.get(key))
+        self.assertTrue(np.array_equal(sparse.to_dense(), result.to_dense()))
+        report = cache.report()
+        self.assertEqual((1, 1, 1), (report['hits'], report['misses'], report['entries']))
+
+        # a new content gives new keys
+        savemat(self.filename, {'voxels': np.zeros((2, 1, 3, 3, 3))})
+        os.utime(self.filename, (0, 0))
+        self.assertNotEqual(key, cache.key(self.filename, index=1, threshold=0.1))
+
+    def test_valid_2(self):
+        cache = ShapeCache(os.path.join(self.directory, 'cache'))
+        for ind in range(3):
+            cache.put(str(ind), {'voxels': np.full(200, ind, dtype=float)})
+            os.utime(cache.entry_path(str(ind)), (ind, ind))
+        cache.max_bytes = cache.report()['bytes'] + 100
+        cache.get('0')    # most recently used
+        cache.put('3', {'voxels': np.zeros(200)})
+        self.assertIsNotNone(cache.get('0'))
+        self.assertIsNone(cache.get('1'))
+        self.assertTrue(cache.report()['bytes'] <= cache.max_bytes)
+
+
+class Test_gallery(unittest.TestCase):
+
+    def test_valid_1(self):
+        offsets = grid_offsets(5, (4, 2, 3), columns=2, spacing=1.5)
+        self.assertTrue(np.allclose([[0, 0, 0], [-6, 0, 0], [0, 0, -6], [-6, 0, -6], [0, 0, -12]],
+                                    offsets))
+        shapes = [np.eye(4)[:, :, np.newaxis].repeat(2, 2) * 0.8, np.zeros((4, 4, 2))]
+        shapes[1][0, 0, 0] = 0.5
+        centers, sizes, values = page_blocks(shapes, offsets[:2], threshold=0.1, uniform_size=0.9)
+        self.assertEqual(9, len(centers))
+        self.assertTrue(np.allclose([-5.5, 0.5, 0.5], centers[-1]))
+        self.assertTrue(np.allclose(0.9, sizes))
+        self.assertTrue(np.allclose([0.8] * 8 + [0.5], values))
+
+    def test_valid_2(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'voxels.mat')
+            voxels = np.zeros((5, 1, 4, 4, 4))
+            voxels[:, 0, 1:3, 1:3, 0:3] = 0.8
+            savemat(filename, {'voxels': voxels})
+            gallery = Gallery(filename, range(5), page_size=4, connect=0)
+            self.assertEqual(2, gallery.page_count)
+            self.assertEqual([4], gallery.page_indices(1))
+            image = os.path.join(directory, 'page.png')
+            gallery.save_page(0, image, window_size=64)
+            gallery.close()
+            self.assertTrue(os.path.getsize(image) > 0)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_valid_3(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'voxels.mat')
+            voxels = np.zeros((4, 1, 4, 4, 4))
+            voxels[0, 0, 1:3, 1:3, 0:3] = 0.8
+            savemat(filename, {'voxels': voxels})
+            gallery = Gallery(filename, range(4), page_size=4, connect=0)
+            actors = gallery.actors(0)
+            _, center, _ = gallery.camera(actors)
+            gallery.close()
+            # the empty tiles and the labels of the bottom row are framed too
+            labels = np.array([actor.GetPosition() for actor in actors[1:]])
+            self.assertTrue(labels[:, 0].min() < center[0] < labels[:, 0].max())
+            self.assertTrue(center[2] < labels[:2, 2].min())
+            self.assertTrue(center[2] > labels[2:, 2].max())
+        finally:
+            shutil.rmtree(directory)
+
+
+class Test_profiling(unittest.TestCase):
+
+    def tearDown(self):
+        profiling.disable()
+
+    def test_valid_1(self):
+        self.assertIs(profiling.NULL_STAGE, profiling.stage('read'))
+        profiling.count(blocks=1)
+
+        @profiling.profiled('inner')
+        def inner(size):
+            profiling.count(blocks=size)
+            return np.ones(size)
+
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'profile.json')
+            profiling.enable(filename, cprofile='inner')
+            with profiling.stage('outer'):
+                inner(10)
+                inner(2**18)
+            report = profiling.disable().report()
+            self.assertEqual(['outer', 'outer/inner', 'outer/inner'],
+                             [record['name'] for record in report['stages']])
+            self.assertEqual([10 + 2**18, 10, 2**18],
+                             [record['counts']['blocks'] for record in report['stages']])
+            self.assertTrue(report['stages'][0]['peak_bytes'] >= 2**21)
+            self.assertTrue(os.path.exists(os.path.join(directory, 'profile.inner.prof')))
+            with open(filename) as profile:
+                self.assertEqual(3, len(json.load(profile)['stages']))
+        finally:
+            shutil.rmtree(directory)
+
+
+class Test_preprocess_file(unittest.TestCase):
+
+    def test_valid_1(self):
+        self.assertEqual([(0, 2), (2, 4), (4, 5)], chunk_ranges(5, (4, 4, 4), chunk_bytes=1024))
+        self.assertEqual([(0, 3), (3, 5)], chunk_ranges(5, (4, 4, 4), parts=2))
+
+    def test_valid_2(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'voxels.mat')
+            voxels = np.random.RandomState(0).rand(6, 7, 8, 9) ** 4
+            savemat(filename, {'voxels': voxels})
+            outputs = [os.path.join(directory, 'pre_%d.npy' % workers) for workers in (1, 2)]
+            for workers, output in zip((1, 2), outputs):
+                count = preprocess_file(filename, output, threshold=0.3, connect=2, factor=2,
+                                        workers=workers, chunk_bytes=2 * 7 * 8 * 9 * 8)
+                self.assertEqual(6, count)
+            result = np.load(outputs[0])
+            self.assertEqual((6, 4, 4, 5), result.shape)
+            self.assertTrue(np.array_equal(result, np.load(outputs[1])))
+            for ind in range(6):
+                expected = preprocess(voxels[ind], threshold=0.3, connect=2, factor=2)
+                self.assertTrue(np.array_equal(expected, result[ind]))
+            self.assertTrue(np.array_equal(result, read_tensor(outputs[0])))
+        finally:
+            shutil.rmtree(directory)
+
+
+class Test_chunked(unittest.TestCase):
+
+    def test_valid_1(self):
+        self.assertEqual([(0, 4), (4, 8), (8, 9)],
+                         chunked.slab_ranges((9, 4, 4), 'label', 4 * 16 * 32, multiple=2))
+        self.assertEqual([(0, 3), (3, 6), (6, 9)],
+                         chunked.slab_ranges((9, 4, 4), 'label', 16, minimum=3))
+
+    def test_valid_2(self):
+        voxels = np.random.RandomState(0).rand(30, 12, 10) ** 4
+        plane = 12 * 10
+        for budget in (3 * plane * 32, 2**30):
+            for distance in (1, 3):
+                self.assertTrue(np.array_equal(largest_component(voxels >= 0.3, distance),
+                                               chunked.largest_component(voxels, distance, 0.3,
+                                                                         budget=budget)))
+            self.assertEqual(center_of_mass(voxels, 0.3),
+                             chunked.center_of_mass(voxels, 0.3, budget=budget))
+            sparse = chunked.to_sparse(voxels, 0.3, budget=budget)
+            self.assertTrue(np.array_equal(SparseVoxels.from_dense(voxels, 0.3).coords,
+                                           sparse.coords))
+            for method in ('max', 'mean', 'occupancy'):
+                self.assertTrue(np.array_equal(downsample(voxels, 4, method, 0.3, edge='crop'),
+                                               chunked.downsample(voxels, 4, method, 0.3,
+                                                                  edge='crop', budget=budget)))
+
+    def test_valid_3(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'voxels.npy')
+            voxels = np.random.RandomState(1).rand(25, 9, 11) ** 4
+            np.save(filename, voxels)
+            outputs = [os.path.join(directory, 'pre_%d.npy' % workers) for workers in (1, 2)]
+            for workers, output in zip((1, 2), outputs):
+                chunked.preprocess(filename, output, threshold=0.3, connect=2, factor=3,
+                                   budget=3 * 9 * 11 * 40, workers=workers, temp_dir=directory)
+            expected = preprocess(voxels, threshold=0.3, connect=2, factor=3)
+            for output in outputs:
+                self.assertTrue(np.array_equal(expected, np.load(output)))
+            # temporary labels and masks are removed
+            self.assertEqual(['pre_1.npy', 'pre_2.npy', 'voxels.npy'],
+                             sorted(os.listdir(directory)))
+
+            # no downsampling by 1, occupancy keeps the confidences as in util.preprocess
+            expected = preprocess(voxels, threshold=0.3, connect=2, factor=1, method='occupancy')
+            for workers in (1, 2):
+                # without output, worker processes write to a temporary file read back
+                result = chunked.preprocess(filename, None, threshold=0.3, connect=2, factor=1,
+                                            method='occupancy', workers=workers,
+                                            temp_dir=directory)
+                self.assertFalse(isinstance(result, np.memmap))
+                self.assertTrue(np.array_equal(expected, result))
+            self.assertTrue(np.array_equal(voxels >= 0.3,
+                                           chunked.threshold(filename, 0.3, workers=2)))
+            self.assertEqual(['pre_1.npy', 'pre_2.npy', 'voxels.npy'],
+                             sorted(os.listdir(directory)))
+        finally:
+            shutil.rmtree(directory)
+
+
+class Test_mesh(unittest.TestCase):
+
+    def test_valid_1(self):
+        self.assertTrue(np.array_equal([[0, 0, 127], [127, 0, 0], [124, 255, 121]],
+                                       mesh.jet_colors([0, 1, 0.5])))
+        voxels = np.zeros((3, 2, 2))
+        voxels[0:2, 0, 0] = (0.5, 0.2)
+        vertices, quads, colors = mesh.voxels_mesh(voxels, 0.1, mode='cubes', size=1,
+                                                   use_colormap=True)
+        self.assertEqual(((16, 3), (12, 4), (16, 3)), (vertices.shape, quads.shape, colors.shape))
+        vertices, quads, colors = mesh.voxels_mesh(voxels, 0.1, mode='faces')
+        self.assertEqual((6, 4), quads.shape)
+        self.assertIsNone(colors)
+        # counterclockwise from outside: the signed volume is the number of voxels
+        corners = vertices[mesh.triangles(quads)].astype(float)
+        volume = np.einsum('ij,ij->', corners[:, 0], np.cross(corners[:, 1], corners[:, 2])) / 6
+        self.assertAlmostEqual(2, volume)
+
+    def test_valid_2(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'voxels.mat')
+            voxels = np.zeros((2, 4, 4, 4))
+            voxels[:, 1:3, 1:3, 1:3] = 0.8
+            savemat(filename, {'voxels': voxels})
+            # header then 24 vertices and 6 quads, or 84 bytes then 12 triangles
+            for extension, size in (('ply', 230 + 24 * 15 + 6 * 17), ('stl', 84 + 12 * 50),
+                                    ('obj', None)):
+                paths = mesh.export_shapes(filename, directory, extension=extension,
+                                           use_colormap=True)
+                self.assertEqual([os.path.join(directory, 'voxels_%d.%s' % (ind, extension))
+                                  for ind in (1, 2)], paths)
+                if size is not None:
+                    self.assertEqual(size, os.path.getsize(paths[0]))
+            with open(paths[0]) as obj:
+                lines = obj.read().splitlines()
+            self.assertEqual(24 + 6, len(lines))
+            self.assertEqual('f 1 2 3 4', lines[24])
+        finally:
+            shutil.rmtree(directory)
+
+
+class Test_ShapeIndex(unittest.TestCase):
+
+    def test_valid_1(self):
+        voxels = (np.random.RandomState(0).rand(40, 9, 10, 11) > 0.5) * 0.8
+        voxels[7] = voxels[3]
+        voxels[9, :4] = 0
+        voxels[11] = 0
+        voxels[12] = 0
+        index = ShapeIndex.build(voxels, threshold=0.5, cell=4, chunk_size=16)
+        occupied = voxels.reshape(40, -1) >= 0.5
+        self.assertTrue(np.array_equal(occupied.sum(axis=1), index.counts))
+        expected = (occupied & occupied[9]).sum(axis=1) / \
+                   np.maximum((occupied | occupied[9]).sum(axis=1), 1)
+        expected[[11, 12]] = 0
+        self.assertTrue(np.allclose(expected, index.iou(9, np.arange(40))))
+        expected[9] = -1
+        indices, ious = index.query(9, k=5)
+        self.assertTrue(np.allclose(np.sort(expected)[::-1][:5], ious))
+        self.assertEqual([3, 7], list(index.query(voxels[3], k=2)[0]))
+        self.assertEqual(([11], [1.]), tuple(map(list, index.query(12, k=1))))
+        for k in (0, -1):
+            self.assertEqual(([], []), tuple(map(list, index.query(9, k=k))))
+        pairs, ious, groups = index.duplicates(0.99)
+        self.assertEqual([[3, 7], [11, 12]], pairs.tolist())
+        self.assertEqual([[3, 7], [11, 12]], [list(group) for group in groups])
+
+    def test_valid_2(self):
+        latent = np.random.RandomState(1).randn(6, 4)
+        latent[5] = latent[2] * 2
+        index = ShapeIndex.build(np.zeros((6, 2, 2, 2)), latent=latent[:, :, np.newaxis])
+        indices, distances = index.nearest_latent(2, k=2)
+        self.assertEqual(2, len(indices))
+        self.assertTrue(np.allclose(np.sort(np.linalg.norm(latent - latent[2], axis=1))[1:3],
+                                    distances))
+        indices, distances = index.nearest_latent(2, k=1, metric='cosine')
+        self.assertEqual([5], list(indices))
+        self.assertAlmostEqual(0, distances[0])
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'index.npz')
+            index.save(filename)
+            self.assertTrue(np.array_equal(latent, ShapeIndex.load(filename).latent))
+        finally:
+            shutil.rmtree(directory)
+
+
+class Test_Watcher(unittest.TestCase):
+
+    def test_valid_1(self):
+        import asyncio
+        directory = tempfile.mkdtemp()
+        try:
+            voxels = np.zeros((3, 4, 4, 4))
+            voxels[:, 1:3, 1:3, 0:3] = 0.8
+            savemat(os.path.join(directory, 'chair_sample.mat'), {'voxels': voxels})
+            watcher = Watcher(directory, shapes='1', jobs=1)
+            asyncio.run(watcher.run(once=True))
+            results = os.path.join(directory, 'processed')
+            self.assertTrue(np.array_equal(voxels, np.load(os.path.join(results,
+                                                                        'chair_sample.pre.npy'))))
+            self.assertTrue(os.path.exists(os.path.join(results, 'chair_sample.stats.csv')))
+            self.assertEqual(['chair_sample_1.png'],
+                             os.listdir(os.path.join(results, 'chair_sample')))
+
+            # done stages are skipped, also by a new watcher
+            stats_path = os.path.join(results, 'chair_sample.stats.csv')
+            os.utime(stats_path, (0, 0))
+            asyncio.run(Watcher(directory, stages=('stats',)).run(once=True))
+            self.assertEqual(0, os.path.getmtime(stats_path))
+            savemat(os.path.join(directory, 'chair_sample.mat'), {'voxels': voxels[:2]})
+            asyncio.run(Watcher(directory, stages=('stats',)).run(once=True))
+            self.assertNotEqual(0, os.path.getmtime(stats_path))
+
+            # as are stages run with other parameters
+            os.utime(stats_path, (0, 0))
+            asyncio.run(Watcher(directory, stages=('stats',), threshold=0.5).run(once=True))
+            self.assertNotEqual(0, os.path.getmtime(stats_path))
+        finally:
+            shutil.rmtree(directory)
+
+
+class Test_save_image(unittest.TestCase):
+
+    def test_valid_1(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'shape_1.png')
+            voxels = np.zeros((4, 4, 4))
+            voxels[1:3, 1:3, 0:3] = 0.8
+            ren_win = visualization(voxels, 0.1, uniform_size=0.9, merge=True, filename=filename)
+            self.assertTrue(os.path.getsize(filename) > 0)
+            self.assertEqual(1, ren_win.GetOffScreenRendering())
+        finally:
+            shutil.rmtree(directory)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,124 @@
+"""
+Batch preprocessing of the shapes of a voxel file on all cores
+"""
+
+import time
+import multiprocessing
+import numpy as np
+from util import read_tensor, preprocess
+
+# state of a preprocessing worker: the open input tensor, the output memory map and the options
+WORKER = {}
+
+def output_shape(shape, factor=1):
+    """ Shape of the batch of shape (4D) once downsampled by factor (see util.downsample) """
+    return (shape[0],) + tuple(-(-dim // factor) for dim in shape[1:])
+
+def chunk_ranges(count, shape, chunk_bytes=32 * 2**20, parts=1):
+    """
+    (start, stop) ranges of consecutive shapes, of at most chunk_bytes of float64 voxels each,
+    and at least parts ranges when there are enough shapes.
+    """
+    step = max(1, min(chunk_bytes // max(1, int(np.prod(shape)) * 8), -(-count // parts)))
+    return [(start, min(start + step, count)) for start in range(0, count, step)]
+
+def init_worker(filename, varname, output, cache, options):
+    """ Open the input tensor and the output memory map once per worker process """
+    WORKER['tensor'] = read_tensor(filename, varname, lazy=True, cache=cache)
+    WORKER['output'] = np.load(output, mmap_mode='r+')
+    WORKER['options'] = options
+
+def preprocess_chunk(bounds):
+    """
+    Preprocess the shapes start to stop of the worker's tensor, read in one go, and write
+    them to the output memory map. Only the bounds travel between processes.
+    """
+    start, stop = bounds
+    voxels = WORKER['tensor'][start:stop]
+    # one shape at a time, the labeling of a 4D batch being slower than a loop of 3D ones
+    for ind in range(stop - start):
+        WORKER['output'][start + ind] = preprocess(voxels[ind], **WORKER['options'])
+    return stop - start
+
+def preprocess_file(filename, output, varname='voxels', threshold=0.1, connect=3, factor=1,
+                    method='max', workers=None, chunk_bytes=32 * 2**20, dtype=np.float64,
+                    cache=False):
+    """
+    Apply the preprocessing of visualize.py (see util.preprocess: max connected component of
+    voxels above threshold, then downsample) to every shape of a tensor file, and write the
+    result as a single 4D .npy file at output, which read_tensor and visualize.py open too.
+    The shapes are split in chunks of about chunk_bytes, spread over a pool of workers
+    processes (all cores if None, the current process if 1). Workers read the input through a
+    memory map (uncompressed MATLAB v5 files, or the .npy copy kept with cache, see
+    util.open_tensor) and write their chunks in place in the memory mapped output, so no
+    voxels are pickled between processes.
+    Return the number of shapes.
+    """
+    assert output[-4:] == '.npy'
+    # only the shape is needed here, the file is not kept open while the workers read it
+    with read_tensor(filename, varname, lazy=True, cache=cache) as tensor:
+        shape = tensor.shape
+    result = np.lib.format.open_memmap(output, mode='w+', dtype=dtype,
+                                       shape=output_shape(shape, factor))
+    del result
+    options = {'threshold': threshold, 'connect': connect, 'factor': factor, 'method': method}
+    # a few chunks per worker, so that workers finishing early pick up the remaining ones
+    chunks = chunk_ranges(shape[0], shape[1:], chunk_bytes,
+                          parts=4 * (workers or multiprocessing.cpu_count()))
+
+    start = time.time()
+    if workers == 1:
+        init_worker(filename, varname, output, cache, options)
+        done = sum(preprocess_chunk(bounds) for bounds in chunks)
+        WORKER.clear()
+    else:
+        context = multiprocessing.get_context('spawn')
+        pool = context.Pool(workers, initializer=init_worker,
+                            initargs=(filename, varname, output, cache, options))
+        try:
+            done = sum(pool.imap_unordered(preprocess_chunk, chunks))
+        finally:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - start
+    print("%d shapes preprocessed in %.1f s, %.1f shapes per second"
+          % (done, elapsed, done / elapsed))
+    return done
+
+if __name__ == '__main__':
+    import argparse
+    CMD_PARSER = argparse.ArgumentParser(description="""Preprocessing all shapes of a .mat
+                                         voxel file or .npz archive on all cores, to a .npy
+                                         file. """)
+    CMD_PARSER.add_argument('filename', metavar='filename', type=str,
+                            help='name of .mat file or .npz archive')
+    CMD_PARSER.add_argument('output', metavar='output', type=str,
+                            help='name of the .npy file of the preprocessed shapes')
+    CMD_PARSER.add_argument('-t', '--threshold', metavar='threshold', type=float, default=0.1,
+                            help='voxels with confidence lower than the threshold\
+                            are not part of the max connected component')
+    CMD_PARSER.add_argument('-mc', '--max-component', metavar='max_component', type=int, default=3,
+                            help='keep only the maximal connected component, where voxels of\
+                            distance no larger than `DISTANCE` are considered connected.\
+                            Set to 0 to disable this function.')
+    CMD_PARSER.add_argument('-df', '--downsample-factor', metavar='factor', type=int, default=1,
+                            help='downsample factor')
+    CMD_PARSER.add_argument('-dm', '--downsample-method', metavar='downsample_method', type=str,
+                            default='max', help='downsample method: max, mean, min or occupancy')
+    CMD_PARSER.add_argument('-j', '--jobs', metavar='jobs', type=int, default=None,
+                            help='number of worker processes, all cores by default')
+    CMD_PARSER.add_argument('--chunk-size', metavar='size', type=float, default=32,
+                            help='size in MB of the chunks of shapes given to the workers')
+    CMD_PARSER.add_argument('--float32', action="store_true",
+                            help='write single precision voxels, half the size')
+    CMD_PARSER.add_argument('-nc', '--npy-cache', action="store_true",
+                            help='keep a memory mapped .npy copy of the voxels next to the\
+                            input file, that workers read instead of the input file')
+
+    ARGS = CMD_PARSER.parse_args()
+    assert ARGS.downsample_method in ('max', 'mean', 'min', 'occupancy')
+    preprocess_file(ARGS.filename, ARGS.output, threshold=ARGS.threshold,
+                    connect=ARGS.max_component, factor=ARGS.downsample_factor,
+                    method=ARGS.downsample_method, workers=ARGS.jobs,
+                    chunk_bytes=int(ARGS.chunk_size * 2**20),
+                    dtype=np.float32 if ARGS.float32 else np.float64, cache=ARGS.npy_cache)
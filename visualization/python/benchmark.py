@@ -0,0 +1,253 @@
+"""
+Benchmarks for the visualization utilities
+
+Run all cases and save the results as a baseline, then compare later runs against it:
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json
+"""
+
+import io
+import os
+import json
+import time
+import shutil
+import tempfile
+import tracemalloc
+import contextlib
+import numpy as np
+from scipy import ndimage
+from scipy.io import savemat
+from util import read_tensor, downsample, max_connected, center_of_mass
+
+############################################################################
+### Synthetic voxel generators, all returning (batch, size, size, size) in [0, 1]
+############################################################################
+def solid_blobs(size, batch, rng):
+    """ Large solid ellipsoids, the easy case with a dense interior """
+    grid = (np.arange(size) + 0.5) / size - 0.5
+    coords = np.meshgrid(grid, grid, grid, indexing='ij')
+    result = np.empty((batch, size, size, size))
+    for ind in range(batch):
+        radii = rng.uniform(0.25, 0.45, 3)
+        dist = sum((coord / radius) ** 2 for coord, radius in zip(coords, radii))
+        result[ind] = dist <= 1
+    return result
+
+def chairs(size, batch, rng):
+    """ Thin chair-like structures: a seat, four legs and a back """
+    result = np.zeros((batch, size, size, size))
+    unit = size / 16.
+    for ind in range(batch):
+        thick = max(1, int(round(unit * rng.uniform(0.5, 1))))
+        low, high = int(3 * unit), int(13 * unit)
+        seat = int(size / 2 + rng.uniform(-1, 1) * unit)
+        shape = result[ind]
+        shape[low:high, low:high, seat:seat + thick] = 1
+        for leg_x in (low, high - thick):
+            for leg_y in (low, high - thick):
+                shape[leg_x:leg_x + thick, leg_y:leg_y + thick, 0:seat] = 1
+        shape[low:high, high - thick:high, seat:size - int(unit)] = 1
+    return result
+
+def gan_fields(size, batch, rng):
+    """ Noisy probability fields, like raw generator outputs: blurred chairs plus noise """
+    result = chairs(size, batch, rng)
+    for ind in range(batch):
+        field = ndimage.gaussian_filter(result[ind], size / 64.) + 0.15 * rng.rand(size, size, size)
+        result[ind] = 1. / (1. + np.exp(-12 * (field - 0.4)))
+    return result
+
+GENERATORS = {'blob': solid_blobs, 'chair': chairs, 'gan': gan_fields}
+
+############################################################################
+### Measurement
+############################################################################
+def time_call(func, *args, **kwargs):
+    """ Return the best wall time in seconds of three calls of func """
+    best = float('inf')
+    for _ in range(3):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def measure(func, *args, **kwargs):
+    """ Return (best wall time in seconds, peak traced memory in bytes) of func """
+    with contextlib.redirect_stdout(io.StringIO()):
+        seconds = time_call(func, *args, **kwargs)
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return seconds, peak
+
+def case_name(function, params):
+    """ Unique name of a benchmark case, used to compare with a baseline """
+    return '%s[%s]' % (function, ','.join('%s=%s' % item for item in sorted(params.items())))
+
+def run_cases(sizes=(32, 64, 128), batches=(1, 10, 100, 1000), max_bytes=2**30, quick=False):
+    """
+    Run all benchmark cases and return a list of results, one dict per case with
+    name, function, params, seconds and peak_bytes.
+    Batches whose float64 input would exceed max_bytes are skipped.
+    quick restricts parameters to one value each.
+    """
+    rng = np.random.RandomState(0)
+    thresholds = (0.5,) if quick else (0.1, 0.5)
+    distances = (2,) if quick else (1, 2, 3)
+    steps = (2,) if quick else (2, 4)
+    results = []
+    directory = tempfile.mkdtemp()
+
+    def run(function, params, func, *args, **kwargs):
+        seconds, peak = measure(func, *args, **kwargs)
+        results.append({'name': case_name(function, params), 'function': function,
+                        'params': params, 'seconds': seconds, 'peak_bytes': peak})
+        print("%-72s %10.2f ms %9.1f MB" % (results[-1]['name'], seconds * 1e3, peak / 2.**20))
+
+    try:
+        for size in sizes:
+            for batch in batches:
+                if batch * size ** 3 * 8 > max_bytes:
+                    print("skipping %d x %d^3, above --max-bytes" % (batch, size))
+                    continue
+                for kind, generator in sorted(GENERATORS.items()):
+                    voxels = generator(size, batch, rng)
+                    base = {'shape': kind, 'size': size, 'batch': batch}
+                    for threshold in thresholds:
+                        occupied = voxels >= threshold
+                        for distance in distances:
+                            params = dict(base, threshold=threshold, distance=distance)
+                            if batch == 1:
+                                run('max_connected', params, max_connected, occupied[0], distance)
+                            else:
+                                run('max_connected', params, max_connected, occupied, distance)
+                        if batch == 1:
+                            run('center_of_mass', dict(base, threshold=threshold),
+                                center_of_mass, voxels[0], threshold)
+                    for step in steps:
+                        for method in ('max',) if quick else ('max', 'mean'):
+                            run('downsample', dict(base, step=step, method=method),
+                                downsample, voxels, step, method)
+                    if kind == 'gan':
+                        filename = os.path.join(directory, 'voxels.mat')
+                        savemat(filename, {'voxels': voxels[:, np.newaxis]})
+                        run('read_tensor', base, read_tensor, filename)
+                        run('read_tensor', dict(base, lazy=True),
+                            lambda: read_tensor(filename, lazy=True)[batch // 2])
+                        os.remove(filename)
+                    if batch == 1:
+                        run_vtk_cases(run, voxels[0], base, thresholds)
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+def run_vtk_cases(run, voxels, base, thresholds):
+    """ Benchmark block generation, skipped when VTK is not installed """
+    try:
+        from util_vtk import generate_all_blocks
+    except ImportError:
+        print("skipping generate_all_blocks, VTK is not installed")
+        return
+    for threshold in thresholds:
+        params = dict(base, threshold=threshold)
+        run('generate_all_blocks', dict(params, mode='merge'), generate_all_blocks,
+            voxels, threshold, uniform_size=0.9, merge=True)
+        run('generate_all_blocks', dict(params, mode='surface'), generate_all_blocks,
+            voxels, threshold, uniform_size=0.9, surface=True)
+        if base['size'] <= 32:
+            run('generate_all_blocks', dict(params, mode='actors'), generate_all_blocks,
+                voxels, threshold, uniform_size=0.9)
+
+def compare(results, baseline, tolerance=1.5):
+    """
+    Compare results with a baseline, print the cases whose time or peak memory grew by more
+    than tolerance times. Return the names of the regressed cases.
+    """
+    previous = dict((case['name'], case) for case in baseline)
+    regressions = []
+    for case in results:
+        if case['name'] not in previous:
+            continue
+        old = previous[case['name']]
+        time_ratio = case['seconds'] / max(old['seconds'], 1e-9)
+        memory_ratio = case['peak_bytes'] / float(max(old['peak_bytes'], 1))
+        if time_ratio > tolerance or memory_ratio > tolerance:
+            regressions.append(case['name'])
+            print("REGRESSION %-61s time x%.2f memory x%.2f"
+                  % (case['name'], time_ratio, memory_ratio))
+    print("%d cases compared, %d regressions" % (len(results), len(regressions)))
+    return regressions
+
+############################################################################
+### Comparison with the original label based downsample
+############################################################################
+def downsample_labels(voxels, step, method='max'):
+    """
+    Label based pooling of a 3D voxels matrix, as util.downsample was originally written.
+    Kept as a reference for benchmarking. Sizes must be multiples of step.
+    """
+    assert voxels.ndim == 3
+    s_x, s_y, s_z = voxels.shape
+    r_x, r_y, r_z = np.ogrid[0:s_x, 0:s_y, 0:s_z]
+    regions = s_z//step * s_y//step * (r_x//step) + s_z//step * (r_y//step) + r_z//step
+    if method == 'max':
+        res = ndimage.maximum(voxels, labels=regions, index=np.arange(regions.max() + 1))
+    else:
+        res = ndimage.mean(voxels, labels=regions, index=np.arange(regions.max() + 1))
+    res.shape = (s_x//step, s_y//step, s_z//step)
+    return res
+
+def benchmark_downsample(sizes=(64, 128), steps=(2, 4), methods=('max', 'mean')):
+    """ Compare the strided downsample against the label based version """
+    rng = np.random.RandomState(0)
+    rows = []
+    for size in sizes:
+        voxels = rng.rand(size, size, size)
+        for step in steps:
+            for method in methods:
+                old = time_call(downsample_labels, voxels, step, method)
+                new = time_call(downsample, voxels, step, method)
+                rows.append((size, step, method, old, new))
+                print("%d^3 step %d %-4s  labels %8.2f ms  strided %7.2f ms  speedup %6.1fx"
+                      % (size, step, method, old * 1e3, new * 1e3, old / new))
+    return rows
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+    CMD_PARSER = argparse.ArgumentParser(description="""Benchmarking the visualization
+                                         utilities on synthetic voxels. """)
+    CMD_PARSER.add_argument('-s', '--sizes', metavar='size', type=int, nargs='+',
+                            default=[32, 64, 128], help='grid resolutions')
+    CMD_PARSER.add_argument('-b', '--batches', metavar='batch', type=int, nargs='+',
+                            default=[1, 10, 100, 1000], help='numbers of shapes per call')
+    CMD_PARSER.add_argument('-m', '--max-bytes', metavar='max_bytes', type=int, default=2**30,
+                            help='skip batches whose float64 voxels exceed MAX_BYTES')
+    CMD_PARSER.add_argument('-q', '--quick', action="store_true",
+                            help='a single value per parameter')
+    CMD_PARSER.add_argument('--save', metavar='filename', type=str, default=None,
+                            help='save the results as a json baseline')
+    CMD_PARSER.add_argument('--compare', metavar='filename', type=str, default=None,
+                            help='compare the results with a json baseline, and exit with\
+                            status 1 on regressions')
+    CMD_PARSER.add_argument('--tolerance', metavar='tolerance', type=float, default=1.5,
+                            help='time or memory ratio above which a case has regressed')
+    CMD_PARSER.add_argument('--labels', action="store_true",
+                            help='only compare downsample with the original label based version')
+
+    ARGS = CMD_PARSER.parse_args()
+    if ARGS.labels:
+        benchmark_downsample()
+        sys.exit(0)
+
+    RESULTS = run_cases(ARGS.sizes, ARGS.batches, ARGS.max_bytes, ARGS.quick)
+    if ARGS.save is not None:
+        with open(ARGS.save, 'w') as result_file:
+            json.dump(RESULTS, result_file, indent=1)
+    if ARGS.compare is not None:
+        with open(ARGS.compare) as baseline_file:
+            if compare(RESULTS, json.load(baseline_file), ARGS.tolerance):
+                sys.exit(1)
@@ -0,0 +1,235 @@
+"""
+On-disk cache of preprocessed shapes and their meshes
+
+Entries are .npz files named after the hash of the content of the input file and of the
+parameters that produced them, so a cached shape is found again whatever the file name
+and is never reused once the file changed. The cache is bounded in size: the least
+recently used entries are removed first. Entries are written to a temporary file then
+renamed, so processes sharing a cache directory never see a partial entry.
+"""
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import numpy as np
+from util import SparseVoxels
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# bump to invalidate the entries written by older versions of the preprocessing
+CACHE_VERSION = 1
+
+class ShapeCache(object):
+    """
+    Size bounded LRU cache of arrays in directory, shared by any number of processes.
+    hits and misses count the lookups of this object, report() adds the totals of all
+    processes since the cache was created.
+    """
+
+    def __init__(self, directory, max_bytes=2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        for sub in ('entries', 'files'):
+            path = os.path.join(directory, sub)
+            if not os.path.isdir(path):
+                os.makedirs(path, exist_ok=True)
+
+    def file_hash(self, filename, chunk_bytes=16 * 2**20):
+        """
+        SHA-1 of the content of filename. It is remembered for the path, size and
+        modification time of the file, so unchanged files are only read once.
+        """
+        stat = os.stat(filename)
+        identity = '%s|%d|%d' % (os.path.realpath(filename), stat.st_size, stat.st_mtime_ns)
+        memo = os.path.join(self.directory, 'files',
+                            hashlib.sha1(identity.encode()).hexdigest() + '.txt')
+        if os.path.exists(memo):
+            with open(memo) as memo_file:
+                return memo_file.read().strip()
+
+        digest = hashlib.sha1()
+        with open(filename, 'rb') as data:
+            for chunk in iter(lambda: data.read(chunk_bytes), b''):
+                digest.update(chunk)
+        self._write_atomic(memo, lambda output: output.write(digest.hexdigest().encode()))
+        return digest.hexdigest()
+
+    def key(self, filename, **params):
+        """ Key of the entry computed from the content of filename with params """
+        description = json.dumps(dict(params, file=self.file_hash(filename),
+                                       version=CACHE_VERSION), sort_keys=True)
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def entry_path(self, key):
+        """ Path of the entry of key """
+        return os.path.join(self.directory, 'entries', key + '.npz')
+
+    def get(self, key):
+        """ The dict of arrays stored at key, or None """
+        path = self.entry_path(key)
+        try:
+            with np.load(path) as entry:
+                arrays = dict((name, entry[name]) for name in entry.files)
+            os.utime(path)    # most recently used
+        except (IOError, OSError, ValueError):
+            # missing, removed by another process, or unreadable
+            arrays = None
+        if arrays is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        self._count('hits' if arrays is not None else 'misses')
+        return arrays
+
+    def put(self, key, arrays):
+        """ Store the dict of arrays at key, then evict entries above max_bytes """
+        self._write_atomic(self.entry_path(key), lambda output: np.savez(output, **arrays))
+        self.evict()
+
+    def entries(self):
+        """ (modification time, size, path) of every entry, least recently used first """
+        result = []
+        directory = os.path.join(self.directory, 'entries')
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if name.endswith('.npz'):
+                result.append((stat.st_mtime, stat.st_size, path))
+            elif stat.st_mtime < time.time() - 3600:
+                # temporary file left by a process that died while writing
+                remove(path)
+        return sorted(result)
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache fits in max_bytes """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            remove(path)
+            total -= size
+
+    def clear(self):
+        """ Remove all entries """
+        for _, _, path in self.entries():
+            remove(path)
+
+    def report(self):
+        """ Hits and misses of this object and of all processes, entries and size """
+        entries = self.entries()
+        totals = self._count()
+        return {'hits': self.hits, 'misses': self.misses,
+                'total_hits': totals.get('hits', 0), 'total_misses': totals.get('misses', 0),
+                'entries': len(entries), 'bytes': sum(size for _, size, _ in entries),
+                'max_bytes': self.max_bytes}
+
+    def _count(self, name=None):
+        """ Increment the counter name shared by all processes, return all counters """
+        path = os.path.join(self.directory, 'stats.json')
+        with open(path, 'a+') as stats_file:
+            if fcntl is not None:
+                fcntl.flock(stats_file, fcntl.LOCK_EX)
+            stats_file.seek(0)
+            content = stats_file.read()
+            counts = json.loads(content) if content else {}
+            if name is not None:
+                counts[name] = counts.get(name, 0) + 1
+                stats_file.seek(0)
+                stats_file.truncate()
+                json.dump(counts, stats_file)
+        return counts
+
+    def _write_atomic(self, path, write):
+        """ Write path with write(file object) through a temporary file in the same directory """
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as output:
+                write(output)
+            os.replace(temp_path, path)
+        except BaseException:
+            remove(temp_path)
+            raise
+
+def remove(path):
+    """ Remove a file that another process may have removed already """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def voxels_arrays(voxels):
+    """ Arrays to cache a dense matrix or SparseVoxels """
+    if isinstance(voxels, SparseVoxels):
+        return {'shape': np.array(voxels.shape), 'coords': voxels.coords, 'values': voxels.values}
+    return {'voxels': np.asarray(voxels)}
+
+def arrays_voxels(arrays):
+    """ The dense matrix or SparseVoxels cached as arrays by voxels_arrays """
+    if 'voxels' in arrays:
+        return arrays['voxels']
+    return SparseVoxels(arrays['shape'], arrays['coords'], arrays['values'])
+
+def cached_voxels(cache, key, compute):
+    """ The voxels cached at key, or the voxels returned by compute(), then stored at key """
+    arrays = cache.get(key)
+    if arrays is not None:
+        return arrays_voxels(arrays)
+    voxels = compute()
+    cache.put(key, voxels_arrays(voxels))
+    return voxels
+
+def cached_actors(cache, key, generate):
+    """
+    The actor of the mesh cached at key, or the actors returned by generate(),
+    whose mesh is stored at key if they are a single mesh (see util_vtk.polydata_arrays).
+    Volumes, which are drawn from the voxels without a mesh, are not cached.
+    """
+    import vtk
+    from util_vtk import polydata_arrays, arrays_actor
+    arrays = cache.get(key)
+    if arrays is not None:
+        return [arrays_actor(arrays)]
+    actors = generate()
+    if len(actors) == 1 and isinstance(actors[0], vtk.vtkActor):
+        arrays = polydata_arrays(actors[0].GetMapper().GetInput())
+        if arrays is not None:
+            cache.put(key, arrays)
+    return actors
+
+def print_report(report):
+    """ Print a hit/miss report of ShapeCache.report() """
+    lookups = max(report['total_hits'] + report['total_misses'], 1)
+    print("cache: %d hits, %d misses in this run; %d hits, %d misses (%.0f%% hits) in total; "
+          "%d entries, %.1f of %.1f MB" % (report['hits'], report['misses'], report['total_hits'],
+                                            report['total_misses'],
+                                            100. * report['total_hits'] / lookups,
+                                            report['entries'], report['bytes'] / 2.**20,
+                                            report['max_bytes'] / 2.**20))
+
+if __name__ == '__main__':
+    import argparse
+    CMD_PARSER = argparse.ArgumentParser(description="""Reporting on or clearing a cache of
+                                         preprocessed shapes. """)
+    CMD_PARSER.add_argument('directory', metavar='directory', type=str,
+                            help='cache directory, as given to visualize.py --cache')
+    CMD_PARSER.add_argument('-s', '--size', metavar='size', type=float, default=1024,
+                            help='size of the cache in MB, least recently used entries above it\
+                            are removed')
+    CMD_PARSER.add_argument('--clear', action="store_true", help='remove all entries')
+
+    ARGS = CMD_PARSER.parse_args()
+    CACHE = ShapeCache(ARGS.directory, max_bytes=int(ARGS.size * 2**20))
+    if ARGS.clear:
+        CACHE.clear()
+    CACHE.evict()
+    print_report(CACHE.report())
@@ -0,0 +1,399 @@
+"""
+Out-of-core processing of single voxel grids too large for memory (e.g. 512^3 float64),
+one slab of planes at a time
+"""
+
+import os
+import mmap
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components as graph_components
+from util import SparseVoxels, plane_sums, sums_center, downsample as downsample_dense, \
+    connected_components
+
+# bytes per voxel of a slab while it is processed, input included, measured with tracemalloc
+SLAB_BYTES = {'threshold': 10, 'sparse': 12, 'center': 16, 'downsample': 32, 'label': 32,
+              'preprocess': 40}
+
+# state of a worker: the input volume, the other arrays it reads or writes and the options
+WORKER = {}
+
+def open_volume(volume, mode='r'):
+    """ The 3D matrix of volume, opened as a memory map if it is the path of a .npy file """
+    if isinstance(volume, str):
+        return np.load(volume, mmap_mode=mode)
+    if isinstance(volume, tuple):
+        filename, dtype, offset, shape = volume
+        return np.memmap(filename, dtype=dtype, mode=mode, offset=offset, shape=shape)
+    return volume
+
+def volume_source(volume):
+    """
+    What worker processes open to read volume: its path, or the file, dtype, offset and
+    shape of a memory map. Other arrays would be pickled whole, so they are refused.
+    """
+    if isinstance(volume, str):
+        return volume
+    assert isinstance(volume, np.memmap) and isinstance(volume.base, mmap.mmap), \
+        'worker processes need a .npy file or a whole memory map'
+    return (volume.filename, volume.dtype.str, volume.offset, volume.shape)
+
+def slab_ranges(shape, operation, budget, workers=1, multiple=1, minimum=1):
+    """
+    (start, stop) ranges of planes (first axis) of a volume of shape, each of a thickness
+    multiple of multiple and at least minimum, such that workers slabs processed by operation
+    at once (see SLAB_BYTES) fit in budget bytes, unless a single plane does not.
+    """
+    plane_bytes = int(np.prod(shape[1:])) * SLAB_BYTES[operation]
+    workers = workers or multiprocessing.cpu_count()
+    thickness = budget // (workers * plane_bytes) // multiple * multiple
+    thickness = max(thickness, -(-minimum // multiple) * multiple, multiple)
+    return [(start, min(start + thickness, shape[0])) for start in range(0, shape[0], thickness)]
+
+def init_worker(volume, arrays, options):
+    """ Open the volume and the other arrays once per worker process """
+    WORKER['volume'] = open_volume(volume)
+    WORKER['arrays'] = dict((name, open_volume(array, 'r+')) for name, array in arrays.items())
+    WORKER['options'] = options
+
+def imap_slabs(function, items, volume, arrays=None, workers=1, **options):
+    """
+    Iterate over the results of function on items (each starting with the (start, stop)
+    range of a slab), in order. function reads the volume and arrays from WORKER, opened in a
+    pool of workers processes (all cores if None), or in the current process if workers is 1.
+    """
+    arrays = arrays or {}
+    if workers == 1:
+        init_worker(volume, arrays, options)
+        try:
+            for item in items:
+                yield function(item)
+        finally:
+            WORKER.clear()
+        return
+    context = multiprocessing.get_context('spawn')
+    pool = context.Pool(workers, initializer=init_worker,
+                        initargs=(volume_source(volume),
+                                  dict((name, volume_source(array))
+                                       for name, array in arrays.items()), options))
+    try:
+        for result in pool.imap(function, items):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+def map_slabs(function, items, volume, arrays=None, workers=1, **options):
+    """ The list of the results of function on items, see imap_slabs """
+    return list(imap_slabs(function, items, volume, arrays, workers, **options))
+
+def create_output(output, shape, dtype, workers=1, temp_dir=None):
+    """
+    The .npy file at output opened as a memory map for writing. If output is None, a new array,
+    or with worker processes, which cannot write to it, a memory map of a temporary .npy file
+    in temp_dir, read back into memory by finish_output.
+    """
+    if output is None:
+        if workers == 1:
+            return np.zeros(shape, dtype=dtype)
+        handle, output = tempfile.mkstemp(suffix='.npy', dir=temp_dir)
+        os.close(handle)
+    return np.lib.format.open_memmap(output, mode='w+', dtype=dtype, shape=shape)
+
+def finish_output(result, output):
+    """
+    The result of create_output(output, ...) as returned to the caller: the memory map of
+    output, or an array if output is None, the temporary file being removed.
+    """
+    if output is None and isinstance(result, np.memmap):
+        filename = result.filename
+        try:
+            result = np.array(result)
+        finally:
+            os.remove(filename)
+    return result
+
+def threshold_slab(bounds):
+    """ Write the mask of a slab of the worker's volume """
+    start, stop = bounds
+    WORKER['arrays']['output'][start:stop] = \
+        WORKER['volume'][start:stop] >= WORKER['options']['threshold']
+
+def threshold(volume, threshold=0.1, output=None, budget=256 * 2**20, workers=1):
+    """
+    The mask of the voxels of volume (a 3D matrix, memory map or path of a .npy file) with a
+    confidence no lower than threshold, written to the .npy file output (returned as a
+    memory map) or to a new array if None. Slabs of volume are read so that budget bytes are
+    used at most, spread over workers processes (see map_slabs).
+    """
+    volume = open_volume(volume)
+    result = create_output(output, volume.shape, bool, workers)
+    try:
+        map_slabs(threshold_slab, slab_ranges(volume.shape, 'threshold', budget, workers),
+                  volume, {'output': result}, workers, threshold=threshold)
+    finally:
+        result = finish_output(result, output)
+    return result
+
+def sparse_slab(bounds):
+    """ Coordinates (in the slab) and values of the voxels of a slab above the threshold """
+    start, stop = bounds
+    voxels = SparseVoxels.from_dense(WORKER['volume'][start:stop], WORKER['options']['threshold'])
+    return voxels.coords, voxels.values
+
+def to_sparse(volume, threshold=0.1, budget=256 * 2**20, workers=1):
+    """
+    The voxels of volume with a confidence no lower than threshold as SparseVoxels, the same
+    as SparseVoxels.from_dense, reading slabs of volume within budget bytes (see threshold).
+    """
+    volume = open_volume(volume)
+    ranges = slab_ranges(volume.shape, 'sparse', budget, workers)
+    parts = map_slabs(sparse_slab, ranges, volume, workers=workers, threshold=threshold)
+    dtype = np.int16 if max(volume.shape) <= np.iinfo(np.int16).max else np.int32
+    coords = [part[0].astype(dtype) + np.array([start, 0, 0], dtype=dtype)
+              for (start, _), part in zip(ranges, parts)]
+    return SparseVoxels(volume.shape, np.concatenate(coords),
+                        np.concatenate([part[1] for part in parts]))
+
+def center_slab(bounds):
+    """ plane_sums of a slab of the worker's volume """
+    start, stop = bounds
+    return plane_sums(WORKER['volume'][start:stop], WORKER['options']['threshold'])
+
+def center_of_mass(volume, threshold=0.1, budget=256 * 2**20, workers=1):
+    """
+    Center of mass of volume as util.center_of_mass, from the plane_sums of its slabs read
+    within budget bytes (see threshold), without a thresholded copy of the whole volume.
+    """
+    volume = open_volume(volume)
+    sums = map_slabs(center_slab, slab_ranges(volume.shape, 'center', budget, workers), volume,
+                     workers=workers, threshold=threshold)
+    return sums_center(volume.shape, np.concatenate([rows for rows, _ in sums]),
+                       np.concatenate([cols for _, cols in sums]))
+
+def downsample_slab(bounds):
+    """
+    Downsample a slab of the worker's volume. When preprocessing, the slab is converted to
+    float and zeroed outside of the mask if there is one, as util.preprocess does.
+    """
+    start, stop = bounds
+    options = WORKER['options']
+    voxels = WORKER['volume'][start:stop]
+    if options['preprocess']:
+        voxels = np.array(voxels, dtype=float)
+        if 'mask' in WORKER['arrays']:
+            voxels[np.logical_not(WORKER['arrays']['mask'][start:stop])] = 0
+    step = options['step']
+    if options['preprocess'] and step == 1:
+        # util.preprocess does not downsample by 1, which turns occupancy into a mask
+        WORKER['arrays']['output'][start:stop] = voxels
+        return
+    WORKER['arrays']['output'][start // step:-(-stop // step)] = \
+        downsample_dense(voxels, step, method=options['method'], threshold=options['threshold'],
+                         edge=options['edge'])
+
+def downsample(volume, step, method='max', threshold=0.1, edge='pad', output=None,
+               budget=256 * 2**20, workers=1):
+    """
+    Downsample volume by a factor of step as util.downsample, writing the result to the .npy
+    file output (returned as a memory map) or to a new array if None. Slabs are a multiple of
+    step thick, so every block is reduced within a slab exactly as on the whole volume.
+    """
+    assert step > 0 and int(step) == step
+    assert method in ('max', 'mean', 'min', 'occupancy')
+    assert edge in ('pad', 'crop')
+    step = int(step)
+    volume = open_volume(volume)
+    if edge == 'crop':
+        # the trailing planes are left out of the slabs, the other axes cropped in each slab
+        shape = tuple(dim // step for dim in volume.shape)
+        planes = (shape[0] * step,) + volume.shape[1:]
+    else:
+        shape = tuple(-(-dim // step) for dim in volume.shape)
+        planes = volume.shape
+    dtype = volume.dtype if method in ('max', 'min') else np.float64
+    result = create_output(output, shape, dtype, workers)
+    try:
+        map_slabs(downsample_slab, slab_ranges(planes, 'downsample', budget, workers, step),
+                  volume, {'output': result}, workers, step=step, method=method,
+                  threshold=threshold, edge=edge, preprocess=False)
+    finally:
+        result = finish_output(result, output)
+    return result
+
+def label_slab(bounds):
+    """
+    Label the components of the voxels of a slab above the threshold, writing the labels
+    to the worker's labels array. Return the component sizes and the labels of the first
+    and last distance planes, which are compared across seams.
+    """
+    start, stop = bounds
+    options = WORKER['options']
+    distance = options['distance']
+    labels, sizes = connected_components(WORKER['volume'][start:stop] >= options['threshold'],
+                                         distance)
+    WORKER['arrays']['labels'][start:stop] = labels
+    # copies, views would keep the labels of the whole slab
+    return (sizes[1:].copy(), labels[:distance].astype(np.int32),
+            labels[-distance:].astype(np.int32))
+
+def keep_slab(item):
+    """ Write the mask of the kept components of a slab, given by label """
+    (start, stop), keep = item
+    WORKER['arrays']['output'][start:stop] = keep[WORKER['arrays']['labels'][start:stop]]
+
+def global_labels(labels, offset):
+    """ Labels of a slab numbered after the offset labels of the slabs before it """
+    return np.where(labels > 0, labels.astype(np.int64) + offset, 0)
+
+def seam_links(tail, head, distance):
+    """
+    (component of the seam, label) pairs of the labels (0 for empty) of the last planes of a
+    slab and the first planes of the next one. Voxels closer than distance across the seam
+    are both within distance planes of it, so they are in the same component of the seam.
+    """
+    seam = np.concatenate([tail, head])
+    occupied = seam > 0
+    seam_labels, _ = connected_components(occupied, distance)
+    return seam_labels[occupied], seam[occupied]
+
+def largest_component(volume, distance, threshold=0.1, output=None, budget=256 * 2**20,
+                      workers=1, temp_dir=None):
+    """
+    The mask of the max connected component of the voxels of volume above threshold, the same
+    as util.largest_component(volume >= threshold, distance), written to the .npy file output
+    (returned as a memory map) or to a new array if None.
+    Slabs of volume, at least distance planes thick, are labeled independently (in workers
+    processes, see map_slabs), their labels kept in a temporary file in temp_dir. Components
+    are then joined across each seam by labeling the distance planes on both of its sides,
+    and the joined components merged as the base components of util.connected_components.
+    Ties are broken in favor of the component found first in scan order.
+    """
+    assert distance > 0
+    volume = open_volume(volume)
+    ranges = slab_ranges(volume.shape, 'label', budget, workers, minimum=distance)
+    directory = tempfile.mkdtemp(dir=temp_dir)
+    try:
+        result = create_output(output, volume.shape, bool, workers, directory)
+        labels = np.lib.format.open_memmap(os.path.join(directory, 'labels.npy'), mode='w+',
+                                           dtype=np.int32, shape=volume.shape)
+        # labels of the slabs follow each other, so that they are in scan order as a whole.
+        # Each component of a seam is a node linking the labels it holds, seams are labeled
+        # as the slabs come, so that only the last planes of the previous slab are kept.
+        sizes = [np.zeros(1, dtype=np.int64)]
+        offsets = [0]
+        rows, cols = [], []
+        seam_nodes = 0
+        tail = None
+        for slab_sizes, head, next_tail in imap_slabs(label_slab, ranges, volume,
+                                                      {'labels': labels}, workers,
+                                                      threshold=threshold, distance=distance):
+            if tail is not None:
+                seam, slab_labels = seam_links(tail, global_labels(head, offsets[-1]), distance)
+                if len(seam):
+                    # one link per (seam component, label) pair instead of one per voxel
+                    base = slab_labels.max() + 1
+                    pairs = np.unique(seam * base + slab_labels)
+                    rows.append(pairs // base + seam_nodes)
+                    cols.append(pairs % base)
+                    seam_nodes += seam.max()
+            tail = global_labels(next_tail, offsets[-1])
+            sizes.append(slab_sizes)
+            offsets.append(offsets[-1] + len(slab_sizes))
+        sizes = np.concatenate(sizes)
+        count = offsets[-1]
+        if count == 0:
+            result[...] = False
+            return finish_output(result, output)
+
+        # seam nodes are numbered after the labels
+        rows = np.concatenate(rows) + count if rows else np.zeros(0, dtype=np.int64)
+        cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int64)
+        nodes = count + seam_nodes + 1
+        graph = coo_matrix((np.ones(rows.size, dtype=np.int8), (rows, cols)),
+                           shape=(nodes, nodes))
+        _, merged = graph_components(graph, directed=False)
+
+        # the first label of a component is its first voxel in scan order
+        merged = merged[1:count + 1]
+        _, first, inverse = np.unique(merged, return_index=True, return_inverse=True)
+        component_sizes = np.bincount(inverse.ravel(), weights=sizes[1:])
+        best = np.lexsort((first, -component_sizes))[0]
+        keep = np.r_[False, inverse.ravel() == best]
+
+        items = [(bounds, np.r_[False, keep[offsets[index] + 1:offsets[index + 1] + 1]])
+                 for index, bounds in enumerate(ranges)]
+        map_slabs(keep_slab, items, volume, {'labels': labels, 'output': result}, workers)
+        del labels
+        result = finish_output(result, output)
+    finally:
+        shutil.rmtree(directory)
+    return result
+
+def preprocess(volume, output, threshold=0.1, connect=0, factor=1, method='max',
+               budget=256 * 2**20, workers=1, temp_dir=None):
+    """
+    Prepare volume for rendering as util.preprocess does (max connected component of the voxels
+    above threshold if connect > 0, then downsample by factor with method), writing the result
+    to the .npy file output (returned as a memory map) or to a new array if None, reading
+    slabs within budget bytes. The mask of the component is kept in a temporary file in temp_dir.
+    """
+    volume = open_volume(volume)
+    directory = tempfile.mkdtemp(dir=temp_dir)
+    try:
+        arrays = {}
+        if connect > 0:
+            # compared in double precision, as the float copy of util.preprocess
+            arrays['mask'] = largest_component(volume, connect, np.float64(threshold),
+                                               os.path.join(directory, 'mask.npy'), budget,
+                                               workers, temp_dir=directory)
+        shape = tuple(-(-dim // factor) for dim in volume.shape)
+        arrays['output'] = create_output(output, shape, np.float64, workers, directory)
+        map_slabs(downsample_slab,
+                  slab_ranges(volume.shape, 'preprocess', budget, workers, factor),
+                  volume, arrays, workers, step=factor, method=method, threshold=threshold,
+                  edge='pad', preprocess=True)
+        result = finish_output(arrays.pop('output'), output)
+        arrays.clear()
+    finally:
+        shutil.rmtree(directory)
+    return result
+
+if __name__ == '__main__':
+    import time
+    import argparse
+    CMD_PARSER = argparse.ArgumentParser(description="""Preprocessing a single large voxel
+                                         grid (.npy file) slab by slab within a memory
+                                         budget. """)
+    CMD_PARSER.add_argument('filename', metavar='filename', type=str,
+                            help='name of the .npy file of the voxel grid')
+    CMD_PARSER.add_argument('output', metavar='output', type=str,
+                            help='name of the .npy file of the preprocessed grid')
+    CMD_PARSER.add_argument('-t', '--threshold', metavar='threshold', type=float, default=0.1,
+                            help='voxels with confidence lower than the threshold\
+                            are not part of the max connected component')
+    CMD_PARSER.add_argument('-mc', '--max-component', metavar='max_component', type=int, default=3,
+                            help='keep only the maximal connected component, where voxels of\
+                            distance no larger than `DISTANCE` are considered connected.\
+                            Set to 0 to disable this function.')
+    CMD_PARSER.add_argument('-df', '--downsample-factor', metavar='factor', type=int, default=1,
+                            help='downsample factor')
+    CMD_PARSER.add_argument('-dm', '--downsample-method', metavar='downsample_method', type=str,
+                            default='max', help='downsample method: max, mean, min or occupancy')
+    CMD_PARSER.add_argument('-m', '--memory', metavar='memory', type=float, default=256,
+                            help='memory budget in MB of the slabs processed at once')
+    CMD_PARSER.add_argument('-j', '--jobs', metavar='jobs', type=int, default=1,
+                            help='number of worker processes, sharing the memory budget')
+    CMD_PARSER.add_argument('--temp-dir', metavar='temp_dir', type=str, default=None,
+                            help='directory of the temporary labels and mask files')
+
+    ARGS = CMD_PARSER.parse_args()
+    assert ARGS.downsample_method in ('max', 'mean', 'min', 'occupancy')
+    START = time.time()
+    preprocess(ARGS.filename, ARGS.output, threshold=ARGS.threshold, connect=ARGS.max_component,
+               factor=ARGS.downsample_factor, method=ARGS.downsample_method,
+               budget=int(ARGS.memory * 2**20), workers=ARGS.jobs, temp_dir=ARGS.temp_dir)
+    print("%s preprocessed in %.1f s" % (ARGS.filename, time.time() - START))
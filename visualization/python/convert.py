@@ -0,0 +1,49 @@
+"""
+Conversion of .mat voxel files to compact .npz archives
+"""
+
+import os
+import time
+import numpy as np
+from util import read_tensor, read_inputs, write_voxel_archive
+
+if __name__ == '__main__':
+    import argparse
+    CMD_PARSER = argparse.ArgumentParser(description="""Converting a .mat voxel file written by
+                                         main.lua to a compact .npz archive. """)
+    CMD_PARSER.add_argument('filename', metavar='filename', type=str,
+                            help='name of .mat file to be converted')
+    CMD_PARSER.add_argument('output', metavar='output', type=str,
+                            help='name of the .npz archive to write')
+    CMD_PARSER.add_argument('-e', '--encoding', metavar='encoding', type=str, default='uint8',
+                            help='uint8 to quantize confidences to 256 levels, or bits to keep\
+                            only the occupancy at the threshold')
+    CMD_PARSER.add_argument('-t', '--threshold', metavar='threshold', type=float, default=0.1,
+                            help='occupancy threshold of the bits encoding')
+
+    ARGS = CMD_PARSER.parse_args()
+    assert ARGS.encoding in ('uint8', 'bits')
+
+    print("==> Converting "+ARGS.filename+" to "+ARGS.output+" ("+ARGS.encoding+")")
+    # one pass over the file to the C ordered .npy copy next to it (see util.open_tensor),
+    # the archive and the error check then read every shape contiguously
+    VOXELS = read_tensor(ARGS.filename, lazy=True, cache=True)
+    write_voxel_archive(ARGS.output, VOXELS, inputs=read_inputs(ARGS.filename),
+                        encoding=ARGS.encoding, threshold=ARGS.threshold)
+    RATIO = os.path.getsize(ARGS.filename) / float(os.path.getsize(ARGS.output))
+    print("Done: %d shapes, %.1fx smaller" % (VOXELS.shape[0], RATIO))
+
+    # decode throughput, then error of the archive
+    ARCHIVE = read_tensor(ARGS.output, lazy=True)
+    START = time.time()
+    for IND in range(ARCHIVE.shape[0]):
+        ARCHIVE[IND]
+    print("Decoded %.0f shapes/s" % (ARCHIVE.shape[0] / (time.time() - START)))
+    ERROR = 0
+    for IND in range(ARCHIVE.shape[0]):
+        if ARGS.encoding == 'uint8':
+            EXPECTED = np.clip(VOXELS[IND], 0, 1)
+        else:
+            EXPECTED = VOXELS[IND] >= ARGS.threshold
+        ERROR = max(ERROR, np.abs(ARCHIVE[IND] - EXPECTED).max())
+    print("Max round-trip error: %g" % ERROR)
@@ -0,0 +1,173 @@
+"""
+Gallery of the shapes of a voxel file, many shapes per window
+"""
+
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from util import read_tensor, preprocess, to_sparse
+from util_vtk import vtk, glyph_actor, offscreen_window, save_image
+
+def grid_offsets(count, shape, columns, spacing=1.25):
+    """
+    Offsets (count, 3) of the shapes of a page, laid out in rows of columns shapes.
+    Shapes are seen from +y with z up (see util_vtk.camera_setup), so columns run along -x
+    and rows along -z, each cell being spacing times the largest dimension of shape.
+    """
+    cell = spacing * max(shape)
+    ind = np.arange(count)
+    return np.stack([-(ind % columns) * cell, np.zeros(count), -(ind // columns) * cell],
+                    axis=1)
+
+def page_blocks(shapes, offsets, threshold=0.1, uniform_size=0.9):
+    """
+    Blocks of all shapes of a page as (centers, sizes, values), one row per occupied voxel,
+    each shape translated by its row of offsets.
+    """
+    centers, sizes, values = [], [], []
+    for voxels, offset in zip(shapes, offsets):
+        sparse = to_sparse(voxels, threshold)
+        centers.append(sparse.coords + 0.5 + offset)
+        values.append(sparse.values.astype(float))
+        if 0 < uniform_size <= 1:
+            sizes.append(np.full(len(sparse), float(uniform_size)))
+        else:
+            sizes.append(values[-1])
+    if not centers:
+        return np.zeros((0, 3)), np.zeros(0), np.zeros(0)
+    return np.vstack(centers), np.concatenate(sizes), np.concatenate(values)
+
+class Gallery(object):
+    """
+    Pages of page_size shapes of a tensor file, drawn as a grid in one renderer with a shared
+    camera. All blocks of a page are a single instanced actor (see util_vtk.glyph_actor).
+    The shapes of the next page are read and preprocessed by a background thread while
+    the current page is on screen.
+    """
+
+    def __init__(self, filename, indices, varname='voxels', page_size=16, columns=None,
+                 threshold=0.1, connect=3, factor=1, method='max', uniform_size=0.9,
+                 use_colormap=False, cache=False):
+        self.tensor = read_tensor(filename, varname, lazy=True, cache=cache)
+        self.indices = list(indices)
+        self.page_size = page_size
+        self.columns = columns or int(math.ceil(math.sqrt(page_size)))
+        self.preprocessing = {'threshold': threshold, 'connect': connect, 'factor': factor,
+                              'method': method}
+        self.uniform_size = uniform_size
+        self.use_colormap = use_colormap
+        self.page_count = -(-len(self.indices) // page_size)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def page_indices(self, page):
+        """ Zero based shape indices of page """
+        return self.indices[page * self.page_size:(page + 1) * self.page_size]
+
+    def load(self, page):
+        """ Read and preprocess the shapes of page, return (indices, offsets, blocks) """
+        indices = self.page_indices(page)
+        shapes = [preprocess(self.tensor[ind], **self.preprocessing) for ind in indices]
+        shape = shapes[0].shape if shapes else (1, 1, 1)
+        offsets = grid_offsets(len(shapes), shape, self.columns)
+        blocks = page_blocks(shapes, offsets, self.preprocessing['threshold'], self.uniform_size)
+        return indices, offsets, shape, blocks
+
+    def prefetch(self, page):
+        """ Start loading page in the background, if it exists and is not loading already """
+        with self.lock:
+            if 0 <= page < self.page_count and page not in self.pending:
+                self.pending[page] = self.executor.submit(self.load, page)
+
+    def get(self, page):
+        """ The loaded page, waiting for the background thread if needed """
+        self.prefetch(page)
+        with self.lock:
+            future = self.pending.pop(page)
+        return future.result()
+
+    def actors(self, page):
+        """ Actors of page: the blocks of all shapes, and the one based index under each shape """
+        indices, offsets, shape, (centers, sizes, values) = self.get(page)
+        self.prefetch(page + 1)
+        actors = [glyph_actor(centers, sizes, values, use_colormap=self.use_colormap)]
+        for ind, offset in zip(indices, offsets):
+            label = vtk.vtkBillboardTextActor3D()
+            label.SetInput(str(ind + 1))
+            label.SetPosition(offset[0] + shape[0] / 2., offset[1] + shape[1] / 2.,
+                              offset[2] - 0.1 * shape[2])
+            label.GetTextProperty().SetColor(0, 0, 0)
+            label.GetTextProperty().SetFontSize(16)
+            actors.append(label)
+        return actors
+
+    def camera(self, actors):
+        """
+        Camera position, focal point and view up showing the whole grid of actors:
+        the blocks of all tiles and the labels under them, with a margin for the label text.
+        """
+        points = [actor.GetPosition() for actor in actors[1:]]
+        if actors[0].GetMapper().GetInput().GetNumberOfPoints():
+            bounds = actors[0].GetBounds()
+            points += [bounds[0::2], bounds[1::2]]
+        points = np.array(points) if points else np.zeros((1, 3))
+        lower, upper = points.min(0), points.max(0)
+        center = (lower + upper) / 2
+        extent = max(max(upper - lower), 1) * 1.1
+        rad = math.pi * 0.43
+        direction = np.array([math.cos(rad), math.sin(rad), 0.3])
+        return list(center + 2 * extent * direction), list(center), (0, 0, 1)
+
+    def save_page(self, page, filename, ren_win=None, window_size=1024):
+        """ Render page offscreen to filename, return the render window """
+        actors = self.actors(page)
+        if ren_win is None:
+            ren_win = offscreen_window()
+        return save_image(actors, *self.camera(actors), filename=filename, ren_win=ren_win,
+                          window_size=window_size)
+
+    def display(self, page=0, title=None):
+        """ Show page in a window. Right / Page Down and Left / Page Up change pages. """
+        ren_win = vtk.vtkRenderWindow()
+        ren_win.SetSize(1024, 1024)
+        renderer = vtk.vtkRenderer()
+        renderer.SetBackground(1, 1, 1)
+        ren_win.AddRenderer(renderer)
+        iren = vtk.vtkRenderWindowInteractor()
+        iren.SetInteractorStyle(vtk.vtkInteractorStyleTrackballCamera())
+        iren.SetRenderWindow(ren_win)
+        current = [page]
+
+        def show(page):
+            renderer.RemoveAllViewProps()
+            actors = self.actors(page)
+            for actor in actors:
+                renderer.AddActor(actor)
+            cam_pos, center, cam_up = self.camera(actors)
+            camera = renderer.GetActiveCamera()
+            camera.SetFocalPoint(*center)
+            camera.SetPosition(*cam_pos)
+            camera.SetViewUp(*cam_up)
+            renderer.ResetCamera()
+            ren_win.SetWindowName('%s page %d/%d' % (title or 'gallery', page + 1,
+                                                     self.page_count))
+            ren_win.Render()
+            current[0] = page
+
+        def key_press(caller, event):
+            key = caller.GetKeySym()
+            if key in ('Right', 'Next') and current[0] + 1 < self.page_count:
+                show(current[0] + 1)
+            elif key in ('Left', 'Prior') and current[0] > 0:
+                show(current[0] - 1)
+
+        iren.AddObserver('KeyPressEvent', key_press)
+        show(page)
+        iren.Initialize()
+        iren.Start()
+
+    def close(self):
+        """ Stop the background thread """
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,224 @@
+"""
+Mesh files of voxel shapes, built with NumPy only (no VTK nor matplotlib)
+"""
+
+import os
+import time
+import numpy as np
+from util import read_tensor, preprocess, to_sparse, extract_surface, CUBE_CORNERS, CUBE_FACES
+
+# segments of the matplotlib jet colormap: (position, value) of each channel
+JET_DATA = {'red': ((0., 0.), (0.35, 0.), (0.66, 1.), (0.89, 1.), (1., 0.5)),
+            'green': ((0., 0.), (0.125, 0.), (0.375, 1.), (0.64, 1.), (0.91, 0.), (1., 0.)),
+            'blue': ((0., 0.5), (0.11, 1.), (0.34, 1.), (0.65, 0.), (1., 0.))}
+
+def jet_colors(values, levels=256):
+    """
+    (n, 3) uint8 colors of values in [0, 1] with the jet colormap, quantized to levels
+    colors like matplotlib's jet (util_vtk.get_colormap('jet')).
+    """
+    grid = np.linspace(0, 1, levels)
+    table = np.stack([np.interp(grid, *zip(*JET_DATA[channel]))
+                      for channel in ('red', 'green', 'blue')], axis=1)
+    table = (table * 255).astype(np.uint8)
+    index = np.clip((np.asarray(values, dtype=float) * levels).astype(np.int64), 0, levels - 1)
+    return table[index]
+
+def cube_mesh(voxels, threshold=0.1, size=0.9):
+    """
+    One cube per voxel above threshold (a dense matrix or SparseVoxels), of side size or of
+    side the voxel confidence if size is not in (0, 1], voxel (i, j, k) centered at
+    (i + 0.5, j + 0.5, k + 0.5) as in util_vtk.generate_merged_blocks.
+    Return (vertices (8n, 3), quads (6n, 4), values (8n,)): vertices are not shared between
+    cubes, values is the confidence of the voxel of each vertex.
+    """
+    sparse = to_sparse(voxels, threshold)
+    values = sparse.values.astype(np.float32)
+    sizes = np.full(len(sparse), size, dtype=np.float32) if 0 < size <= 1 else values
+    vertices = (sparse.coords + np.float32(0.5))[:, np.newaxis, :] + \
+               CUBE_CORNERS.astype(np.float32)[np.newaxis] * sizes[:, np.newaxis, np.newaxis]
+    quads = CUBE_FACES[np.newaxis] + 8 * np.arange(len(sparse))[:, np.newaxis, np.newaxis]
+    return vertices.reshape(-1, 3), quads.reshape(-1, 4), np.repeat(values, 8)
+
+def face_mesh(voxels, threshold=0.1, colored=False, levels=256):
+    """
+    The faces between occupied (above threshold) and empty voxels, coplanar neighbors merged
+    into rectangles (see util.extract_surface), voxel (i, j, k) spanning [i, i+1] x [j, j+1] x
+    [k, k+1]. If colored is set, faces of voxels of different confidences, quantized to levels
+    bins, are not merged.
+    Return (vertices (4m, 3), quads (m, 4), values (4m,) or None), values being the
+    confidence of the bin of each vertex.
+    """
+    if not isinstance(voxels, np.ndarray):
+        voxels = voxels.to_dense()
+    corners, keys, _ = extract_surface(voxels >= threshold, voxels if colored else None,
+                                       levels=levels)
+    values = np.repeat((keys + 0.5) / levels, 4) if colored else None
+    return (corners.reshape(-1, 3).astype(np.float32),
+            np.arange(4 * len(corners)).reshape(-1, 4), values)
+
+def voxels_mesh(voxels, threshold=0.1, mode='faces', size=0.9, use_colormap=False):
+    """
+    Mesh of voxels as (vertices, quads, colors): mode 'faces' draws only the outer surface
+    (see face_mesh), 'cubes' one cube of side size per voxel (see cube_mesh).
+    colors are (n, 3) uint8 per-vertex colors of the confidence with the jet colormap if
+    use_colormap is set, None otherwise.
+    """
+    assert mode in ('faces', 'cubes')
+    if mode == 'faces':
+        vertices, quads, values = face_mesh(voxels, threshold, colored=use_colormap)
+    else:
+        vertices, quads, values = cube_mesh(voxels, threshold, size=size)
+    colors = jet_colors(values) if use_colormap else None
+    return vertices, quads, colors
+
+def triangles(quads):
+    """ Split quads (m, 4) into triangles (2m, 3) with the same orientation """
+    return quads[:, [0, 1, 2, 0, 2, 3]].reshape(-1, 3)
+
+def write_ply(output, vertices, quads, colors=None):
+    """ Write a binary little endian PLY mesh of quads to the file object output """
+    header = ['ply', 'format binary_little_endian 1.0', 'element vertex %d' % len(vertices),
+              'property float x', 'property float y', 'property float z']
+    fields = [('position', '<f4', (3,))]
+    if colors is not None:
+        header += ['property uchar red', 'property uchar green', 'property uchar blue']
+        fields.append(('color', 'u1', (3,)))
+    header += ['element face %d' % len(quads), 'property list uchar int vertex_indices',
+               'end_header']
+    output.write(('\n'.join(header) + '\n').encode('ascii'))
+
+    vertex_data = np.empty(len(vertices), dtype=fields)
+    vertex_data['position'] = vertices
+    if colors is not None:
+        vertex_data['color'] = colors
+    output.write(vertex_data.tobytes())
+    face_data = np.empty(len(quads), dtype=[('count', 'u1'), ('indices', '<i4', (4,))])
+    face_data['count'] = 4
+    face_data['indices'] = quads
+    output.write(face_data.tobytes())
+
+def write_stl(output, vertices, quads, colors=None):
+    """ Write a binary STL mesh of the triangles of quads to the file object output """
+    corners = vertices[triangles(quads)]
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+    data = np.zeros(len(corners), dtype=[('normal', '<f4', (3,)), ('corners', '<f4', (3, 3)),
+                                         ('attribute', '<u2')])
+    data['normal'] = normals
+    data['corners'] = corners
+    output.write(b'binary STL written by mesh.py'.ljust(80, b' '))
+    output.write(np.array([len(data)], dtype='<u4').tobytes())
+    output.write(data.tobytes())
+
+def write_rows(output, row_format, rows, chunk_size=2**16):
+    """
+    Write rows (2D array) to the file object output as text, each with row_format, formatting
+    chunk_size rows with a single % instead of one call per row.
+    """
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        output.write(((row_format + '\n') * len(chunk) % tuple(chunk.ravel().tolist()))
+                     .encode('ascii'))
+
+def write_obj(output, vertices, quads, colors=None):
+    """
+    Write a Wavefront OBJ mesh of quads to the file object output. OBJ has no binary form;
+    colors are written after the vertex coordinates, as read by MeshLab and Blender.
+    """
+    if colors is None:
+        write_rows(output, 'v %.6g %.6g %.6g', vertices)
+    else:
+        write_rows(output, 'v %.6g %.6g %.6g %.4g %.4g %.4g',
+                   np.hstack([vertices, colors / 255.]))
+    write_rows(output, 'f %d %d %d %d', quads + 1)
+
+MESH_WRITERS = {'ply': write_ply, 'stl': write_stl, 'obj': write_obj}
+
+def write_mesh(filename, vertices, quads, colors=None):
+    """ Write a mesh at filename, as PLY, STL or OBJ after its extension """
+    extension = filename.lower().rsplit('.', 1)[-1]
+    assert extension in MESH_WRITERS, 'unknown mesh format: ' + filename
+    with open(filename, 'wb') as output:
+        MESH_WRITERS[extension](output, vertices, quads, colors)
+
+def export_shapes(filename, output_dir, indices=None, varname='voxels', threshold=0.1, connect=3,
+                  factor=1, method='max', mode='faces', size=0.9, use_colormap=False,
+                  extension='ply', pattern=None, cache=False):
+    """
+    Write a mesh file in output_dir for each shape at indices (zero based, all if None) of a
+    tensor file, preprocessed as in visualize.py (see util.preprocess) then meshed with
+    voxels_mesh. Shapes are read, meshed and written one at a time, so memory stays bounded
+    by a single shape whatever the size of the file.
+    Files are named after pattern with the one based index (default: file name followed by
+    _%d and extension). Return the paths of the files.
+    """
+    tensor = read_tensor(filename, varname, lazy=True, cache=cache)
+    if indices is None:
+        indices = range(tensor.shape[0])
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    if pattern is None:
+        pattern = os.path.splitext(os.path.basename(filename))[0] + '_%d.' + extension
+
+    start = time.time()
+    paths = []
+    faces = 0
+    for index in indices:
+        voxels = preprocess(tensor[index], threshold=threshold, connect=connect, factor=factor,
+                            method=method)
+        vertices, quads, colors = voxels_mesh(voxels, threshold, mode=mode, size=size,
+                                              use_colormap=use_colormap)
+        path = os.path.join(output_dir, pattern % (index + 1))
+        write_mesh(path, vertices, quads, colors)
+        paths.append(path)
+        faces += len(quads)
+    elapsed = time.time() - start
+    print("%d meshes, %d faces written in %.1f s, %.1f shapes per second"
+          % (len(paths), faces, elapsed, len(paths) / max(elapsed, 1e-9)))
+    return paths
+
+if __name__ == '__main__':
+    import argparse
+    from render import parse_indices
+    CMD_PARSER = argparse.ArgumentParser(description="""Writing the shapes of a .mat voxel
+                                         file or .npz archive as PLY, STL or OBJ meshes. """)
+    CMD_PARSER.add_argument('filename', metavar='filename', type=str,
+                            help='name of .mat file, .npz archive or .npy file')
+    CMD_PARSER.add_argument('output_dir', metavar='output_dir', type=str,
+                            help='directory of the mesh files')
+    CMD_PARSER.add_argument('-f', '--format', metavar='format', type=str, default='ply',
+                            help='mesh format: ply (binary, with colors), stl (binary) or obj')
+    CMD_PARSER.add_argument('-m', '--mode', metavar='mode', type=str, default='faces',
+                            help='faces for the outer surface only, with coplanar faces merged,\
+                            or cubes for one cube per voxel')
+    CMD_PARSER.add_argument('-r', '--range', metavar='range', type=str, default='all',
+                            help='shapes to export (one based): all, an index, a range such\
+                            as 1-100, or a comma separated list')
+    CMD_PARSER.add_argument('-t', '--threshold', metavar='threshold', type=float, default=0.1,
+                            help='voxels with confidence lower than the threshold are empty')
+    CMD_PARSER.add_argument('-mc', '--max-component', metavar='max_component', type=int, default=3,
+                            help='keep only the maximal connected component, where voxels of\
+                            distance no larger than `DISTANCE` are considered connected.\
+                            Set to 0 to disable this function.')
+    CMD_PARSER.add_argument('-df', '--downsample-factor', metavar='factor', type=int, default=1,
+                            help='downsample factor')
+    CMD_PARSER.add_argument('-dm', '--downsample-method', metavar='downsample_method', type=str,
+                            default='max', help='downsample method: max, mean, min or occupancy')
+    CMD_PARSER.add_argument('-u', '--uniform-size', metavar='uniform_size', type=float, default=0.9,
+                            help='side of the cubes in cubes mode, the confidence if not in (0, 1]')
+    CMD_PARSER.add_argument('-cm', '--colormap', action="store_true",
+                            help='color vertices by confidence with the jet colormap')
+    CMD_PARSER.add_argument('-nc', '--npy-cache', action="store_true",
+                            help='keep a memory mapped .npy copy of the voxels next to the\
+                            input file')
+
+    ARGS = CMD_PARSER.parse_args()
+    assert ARGS.format in MESH_WRITERS
+    assert ARGS.mode in ('faces', 'cubes')
+    COUNT = read_tensor(ARGS.filename, lazy=True, cache=ARGS.npy_cache).shape[0]
+    export_shapes(ARGS.filename, ARGS.output_dir, parse_indices(ARGS.range, COUNT),
+                  threshold=ARGS.threshold, connect=ARGS.max_component,
+                  factor=ARGS.downsample_factor, method=ARGS.downsample_method, mode=ARGS.mode,
+                  size=ARGS.uniform_size, use_colormap=ARGS.colormap, extension=ARGS.format,
+                  cache=ARGS.npy_cache)
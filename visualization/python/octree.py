@@ -0,0 +1,112 @@
+"""
+Sparse octree of a voxel matrix, with level of detail block lists
+"""
+
+import numpy as np
+from util import downsample
+
+class VoxelOctree(object):
+    """
+    Sparse octree of the voxels of a 3D matrix with a confidence no lower than threshold.
+    The matrix is padded to a cube of side 2^depth. A node of level l covers a block of
+    2^l voxels per side; level 0 holds single voxels and level depth the whole cube.
+    Uniform subtrees are collapsed: only the full nodes whose parent is not full (leaves)
+    and the mixed nodes (partly occupied) are kept, as sorted linear codes per level,
+    so memory grows with the surface of the shape rather than with the grid.
+    """
+
+    def __init__(self, voxels, threshold=0.1):
+        assert voxels.ndim == 3
+        self.shape = voxels.shape
+        self.threshold = threshold
+        self.depth = int(np.ceil(np.log2(max(max(voxels.shape), 1))))
+        side = 2 ** self.depth
+        padding = [(0, side - dim) for dim in voxels.shape]
+        occupied = voxels >= threshold
+        full = np.pad(occupied, padding, mode='constant')
+        partial = full
+        values = np.pad(np.where(occupied, voxels, 0).astype(float), padding, mode='constant')
+
+        # pyramid of full, partly occupied and mean confidence per level, coarsest last
+        pyramid = [(full, partial, values)]
+        for _ in range(self.depth):
+            full, partial, values = pyramid[-1]
+            pyramid.append((downsample(full, 2, method='min'), downsample(partial, 2, method='max'),
+                            downsample(values, 2, method='mean')))
+
+        self.leaf_codes, self.leaf_values, self.mixed_codes = [], [], []
+        for level, (full, partial, values) in enumerate(pyramid):
+            if level < self.depth:
+                parent_full = pyramid[level + 1][0].repeat(2, 0).repeat(2, 1).repeat(2, 2)
+            else:
+                parent_full = np.zeros(full.shape, dtype=bool)
+            leaves = np.flatnonzero(full & ~parent_full)
+            self.leaf_codes.append(leaves)
+            # mean confidence of the occupied voxels of each leaf, all of its voxels being occupied
+            self.leaf_values.append(values.ravel()[leaves])
+            self.mixed_codes.append(np.flatnonzero(partial & ~full))
+
+    @property
+    def nbytes(self):
+        """ Memory used by the nodes of the octree """
+        return sum(codes.nbytes for codes in self.leaf_codes + self.leaf_values + self.mixed_codes)
+
+    def level_side(self, level):
+        """ Number of nodes per side at level """
+        return 2 ** (self.depth - level)
+
+    def leaf_coords(self, level):
+        """ Lower corner, in voxels, of the leaves of level """
+        side = self.level_side(level)
+        return np.stack(np.unravel_index(self.leaf_codes[level], (side,) * 3), axis=1) << level
+
+    def occupied(self, points):
+        """ Whether each of the integer points (k, 3) is an occupied voxel """
+        points = np.asarray(points, dtype=np.int64).reshape(-1, 3)
+        inside = np.all((points >= 0) & (points < self.shape), axis=1)
+        result = np.zeros(len(points), dtype=bool)
+        undecided = inside.copy()
+        for level in range(self.depth, -1, -1):
+            side = self.level_side(level)
+            codes = np.ravel_multi_index(tuple((points[undecided] >> level).T), (side,) * 3)
+            is_leaf = sorted_member(self.leaf_codes[level], codes)
+            is_mixed = sorted_member(self.mixed_codes[level], codes)
+            positions = np.nonzero(undecided)[0]
+            result[positions[is_leaf]] = True
+            undecided[positions[~is_mixed]] = False
+            if not undecided.any():
+                break
+        return result
+
+    def count(self, lower, upper):
+        """ Number of occupied voxels with lower <= (x, y, z) < upper """
+        lower = np.asarray(lower)
+        upper = np.asarray(upper)
+        total = 0
+        for level in range(self.depth + 1):
+            corners = self.leaf_coords(level)
+            overlap = np.minimum(corners + (1 << level), upper) - np.maximum(corners, lower)
+            total += int(np.prod(np.maximum(overlap, 0), axis=1).sum())
+        return total
+
+    def blocks(self):
+        """
+        Multi-resolution block list covering the occupied voxels: one block per leaf,
+        large solid regions becoming single big blocks and thin parts staying at voxel size.
+        Return (blocks, values): blocks is (m, 6) in center rep (center coordinates, then
+        size in 3 dims, see util.blocktrans_cen2side), values the mean confidence of each block.
+        """
+        blocks, values = [], []
+        for level in range(self.depth + 1):
+            size = float(1 << level)
+            centers = self.leaf_coords(level) + size / 2
+            blocks.append(np.hstack([centers, np.full((len(centers), 3), size)]))
+            values.append(self.leaf_values[level])
+        return np.vstack(blocks), np.concatenate(values)
+
+def sorted_member(sorted_codes, codes):
+    """ Whether each of codes is in the sorted array sorted_codes """
+    if len(sorted_codes) == 0:
+        return np.zeros(len(codes), dtype=bool)
+    positions = np.minimum(np.searchsorted(sorted_codes, codes), len(sorted_codes) - 1)
+    return sorted_codes[positions] == codes
@@ -0,0 +1,216 @@
+"""
+Stage level profiling of the visualization pipeline
+
+Code marks its stages with `with stage('name'):` or the profiled('name') decorator, and
+reports what it produced with count(blocks=..., triangles=...). Nothing is measured until
+enable() is called, these are then a global lookup and an empty call, so library functions
+are instrumented whether or not a profile is being taken.
+"""
+
+import os
+import sys
+import json
+import time
+import functools
+import threading
+import cProfile
+import tracemalloc
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PROFILER = None
+
+class NullStage(object):
+    """ Context manager doing nothing, returned by stage() while profiling is disabled """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_STAGE = NullStage()
+
+class Profiler(object):
+    """
+    Wall time, peak memory and counts of every stage run while it is enabled.
+    Stages nest, a stage started within another is named 'outer/inner' and its counts
+    and peaks also belong to the outer stage.
+    memory: trace Python allocations (NumPy arrays included, VTK objects are not) to report
+    the peak of each stage in peak_bytes; the resident set size is reported in any case.
+    filename: JSON file rewritten every time a top level stage ends.
+    cprofile: name of a stage run under cProfile, its statistics being dumped to
+    cprofile_filename (see the pstats module).
+    Each thread has its own stack of stages; the peak memory of stages running at the same
+    time in several threads includes the allocations of all of them.
+    """
+
+    def __init__(self, filename=None, memory=True, cprofile=None, cprofile_filename=None):
+        self.filename = filename
+        self.memory = memory
+        self.cprofile = cprofile
+        self.cprofile_filename = cprofile_filename
+        self.profile = None
+        self.stages = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    @property
+    def stack(self):
+        """ The stages started and not ended by the current thread, outermost first """
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def stage(self, name):
+        """ Context manager measuring the stage name """
+        return ProfiledStage(self, name)
+
+    def count(self, counts):
+        """ Add counts to the current stage and the stages containing it """
+        for record in self.stack:
+            for key, value in counts.items():
+                record['counts'][key] = record['counts'].get(key, 0) + value
+
+    def enter(self, name):
+        """ Start the stage name """
+        if self.stack:
+            name = self.stack[-1]['name'] + '/' + name
+        record = {'name': name, 'depth': len(self.stack), 'counts': {}}
+        if self.memory and tracemalloc.is_tracing():
+            if self.stack:
+                # the peak is reset for this stage, keep the peak of the outer stage so far
+                outer = self.stack[-1]
+                outer['peak_bytes'] = max(outer['peak_bytes'], tracemalloc.get_traced_memory()[1])
+            record['start_bytes'] = tracemalloc.get_traced_memory()[0]
+            record['peak_bytes'] = 0
+            tracemalloc.reset_peak()
+        if name.rsplit('/', 1)[-1] == self.cprofile:
+            if self.profile is None:
+                self.profile = cProfile.Profile()
+            self.profile.enable()
+        self.stack.append(record)
+        record['start'] = time.perf_counter()
+
+    def exit(self):
+        """ End the current stage """
+        end = time.perf_counter()
+        record = self.stack.pop()
+        record['seconds'] = end - record.pop('start')
+        record['start_seconds'] = end - record['seconds'] - self.start
+        if record['name'].rsplit('/', 1)[-1] == self.cprofile:
+            self.profile.disable()
+            self.profile.dump_stats(self.cprofile_filename)
+        if 'peak_bytes' in record:
+            peak = tracemalloc.get_traced_memory()[1]
+            record['peak_bytes'] = max(record['peak_bytes'], peak) - record.pop('start_bytes')
+            if self.stack:
+                outer = self.stack[-1]
+                outer['peak_bytes'] = max(outer['peak_bytes'], peak)
+        record.update(memory_usage())
+        with self.lock:
+            self.stages.append(record)
+            if not self.stack and self.filename is not None:
+                self.write(self.filename)
+
+    def report(self):
+        """ The stages in the order they started, and the total wall time """
+        stages = sorted(list(self.stages), key=lambda record: (record['start_seconds'],
+                                                         record['depth']))
+        return {'stages': stages, 'seconds': time.perf_counter() - self.start,
+                'argv': sys.argv}
+
+    def write(self, filename):
+        """ Write report() as JSON at filename """
+        with open(filename, 'w') as output:
+            json.dump(self.report(), output, indent=1)
+
+class ProfiledStage(object):
+    """ Context manager of a stage of profiler """
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.enter(self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.exit()
+        return False
+
+def memory_usage():
+    """ Current and peak resident set size of the process in bytes, when available """
+    usage = {}
+    try:
+        with open('/proc/self/statm') as statm:
+            usage['rss_bytes'] = int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        pass
+    if resource is not None:
+        # kilobytes on Linux, bytes on macOS
+        scale = 1 if sys.platform == 'darwin' else 1024
+        usage['max_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    return usage
+
+def enable(filename=None, memory=True, cprofile=None, cprofile_filename=None):
+    """ Start profiling the stages run from now on, return the Profiler (see its options) """
+    global PROFILER
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if cprofile is not None and cprofile_filename is None:
+        cprofile_filename = os.path.splitext(filename or 'profile')[0] + '.' + cprofile + '.prof'
+    PROFILER = Profiler(filename, memory=memory, cprofile=cprofile,
+                        cprofile_filename=cprofile_filename)
+    return PROFILER
+
+def disable():
+    """ Stop profiling, return the Profiler that was enabled or None """
+    global PROFILER
+    profiler, PROFILER = PROFILER, None
+    if profiler is not None and profiler.memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    return profiler
+
+def stage(name):
+    """ Context manager measuring the stage name if profiling is enabled """
+    if PROFILER is None:
+        return NULL_STAGE
+    return PROFILER.stage(name)
+
+def enabled():
+    """ Whether profiling is enabled, to skip computing counts otherwise """
+    return PROFILER is not None
+
+def profiled(name):
+    """ Decorator measuring every call of a function as the stage name (see stage) """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if PROFILER is None:
+                return function(*args, **kwargs)
+            with PROFILER.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def count(**counts):
+    """ Add counts, e.g. count(blocks=10), to the current stage if profiling is enabled """
+    if PROFILER is not None:
+        PROFILER.count(counts)
+
+def print_report(report):
+    """ Print the stages of Profiler.report() as a table """
+    print("%-32s %9s %11s %11s  %s" % ('stage', 'seconds', 'peak MB', 'RSS MB', 'counts'))
+    for record in report['stages']:
+        peak = record.get('peak_bytes')
+        print("%-32s %9.3f %11s %11s  %s" % (
+            '  ' * record['depth'] + record['name'].rsplit('/', 1)[-1], record['seconds'],
+            '-' if peak is None else '%.1f' % (peak / 2.**20),
+            '%.1f' % (record['rss_bytes'] / 2.**20) if 'rss_bytes' in record else '-',
+            ', '.join('%s=%d' % item for item in sorted(record['counts'].items()))))
+    print("%-32s %9.3f" % ('total', report['seconds']))
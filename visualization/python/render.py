@@ -0,0 +1,117 @@
+"""
+Offscreen batch rendering of the shapes of a voxel file
+"""
+
+import os
+import time
+import multiprocessing
+from util import read_tensor, preprocess
+from cache import ShapeCache, cached_voxels, cached_actors, print_report
+
+# state of a rendering worker: the open tensor, the options and an offscreen render window
+WORKER = {}
+
+def parse_indices(spec, count):
+    """
+    Parse a one based shape range into zero based indices:
+    'all', a single index '3', a range '1-10' or a comma separated list of these.
+    """
+    if spec == 'all':
+        return list(range(count))
+    indices = []
+    for part in spec.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            if int(first) > int(last):
+                raise ValueError('reversed range %s' % part)
+            indices.extend(range(int(first) - 1, int(last)))
+        else:
+            indices.append(int(part) - 1)
+    for ind in indices:
+        if not 0 <= ind < count:
+            raise ValueError('index %d out of range 1-%d' % (ind + 1, count))
+    return indices
+
+def init_worker(filename, varname, options):
+    """ Open the tensor file once per worker process """
+    WORKER['tensor'] = read_tensor(filename, varname, lazy=True)
+    WORKER['options'] = options
+    WORKER['window'] = None
+    WORKER['cache'] = None
+    if options['cache_dir'] is not None:
+        WORKER['cache'] = ShapeCache(options['cache_dir'], max_bytes=options['cache_bytes'])
+    WORKER['filename'] = filename
+    WORKER['varname'] = varname
+
+def render_shape(index):
+    """ Preprocess and render one shape of the worker's tensor, return the image path """
+    # imported here so that every worker process creates its own VTK context
+    from util_vtk import visualization, generate_actors
+    options = WORKER['options']
+    cache = WORKER['cache']
+    preprocessing = dict((name, options[name]) for name in ('threshold', 'connect', 'factor',
+                                                            'method'))
+
+    def compute():
+        return preprocess(WORKER['tensor'][index], **preprocessing)
+
+    drawing = dict((name, options[name]) for name in ('uniform_size', 'use_colormap', 'merge',
+                                                      'surface', 'lod', 'isosurface', 'decimate',
+                                                      'smooth', 'volume', 'opacity'))
+    actors = None
+    if cache is None:
+        voxels = compute()
+    else:
+        params = dict(preprocessing, varname=WORKER['varname'], index=index, pipeline='preprocess')
+        voxels = cached_voxels(cache, cache.key(WORKER['filename'], **params), compute)
+        actors = cached_actors(cache, cache.key(WORKER['filename'], mesh=True,
+                                                **dict(params, **drawing)),
+                               lambda: generate_actors(voxels, options['threshold'], **drawing))
+    path = os.path.join(options['output_dir'], options['pattern'] % (index + 1))
+    WORKER['window'] = visualization(voxels, options['threshold'], filename=path,
+                                     ren_win=WORKER['window'], actors=actors, **drawing)
+    return path
+
+def render_shapes(filename, indices, output_dir, workers=None, varname='voxels', threshold=0.1,
+                  connect=3, factor=1, method='max', uniform_size=0.9, use_colormap=False,
+                  merge=True, surface=False, lod=False, isosurface=False, decimate=0,
+                  smooth=0, volume=False, opacity=0.8, pattern=None, cache_dir=None,
+                  cache_bytes=2**30):
+    """
+    Render the shapes at indices (zero based) of a tensor file to images in output_dir,
+    named after pattern with the one based index (default: file name followed by _%d.png).
+    Shapes are spread over a pool of workers processes (all cores if None), each reading
+    its shapes from the file and rendering them offscreen with the camera of visualization().
+    If cache_dir is set, preprocessed shapes and meshes are cached there (see cache.ShapeCache)
+    and a hit/miss report is printed at the end, the lookups of this run being those of the
+    workers (the growth of the totals of the cache). Return the paths of the images.
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    if pattern is None:
+        pattern = os.path.splitext(os.path.basename(filename))[0] + '_%d.png'
+    options = {'threshold': threshold, 'connect': connect, 'factor': factor, 'method': method,
+               'uniform_size': uniform_size, 'use_colormap': use_colormap, 'merge': merge,
+               'surface': surface, 'lod': lod, 'isosurface': isosurface, 'decimate': decimate,
+               'smooth': smooth, 'volume': volume, 'opacity': opacity, 'output_dir': output_dir,
+               'pattern': pattern, 'cache_dir': cache_dir, 'cache_bytes': cache_bytes}
+
+    if cache_dir is not None:
+        before = ShapeCache(cache_dir, max_bytes=cache_bytes).report()
+    start = time.time()
+    context = multiprocessing.get_context('spawn')
+    pool = context.Pool(workers, initializer=init_worker, initargs=(filename, varname, options))
+    try:
+        paths = list(pool.imap(render_shape, indices))
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+    print("%d shapes rendered in %.1f s, %.2f shapes per second"
+          % (len(paths), elapsed, len(paths) / elapsed))
+    if cache_dir is not None:
+        report = ShapeCache(cache_dir, max_bytes=cache_bytes).report()
+        report.update(hits=report['total_hits'] - before['total_hits'],
+                      misses=report['total_misses'] - before['total_misses'])
+        print_report(report)
+    return paths
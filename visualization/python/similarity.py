@@ -0,0 +1,317 @@
+"""
+Similarity search over the shapes of a voxel file: top-k IoU, latent neighbors, duplicates
+"""
+
+import os
+import time
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components as graph_components
+from util import read_tensor, read_inputs
+
+if hasattr(np, 'bitwise_count'):
+    def popcount_rows(words):
+        """ Number of set bits of each row of a 2D uint64 array """
+        return np.bitwise_count(words).sum(axis=1, dtype=np.int64)
+else:
+    POPCOUNT_TABLE = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+    def popcount_rows(words):
+        """ Number of set bits of each row of a 2D uint64 array """
+        return POPCOUNT_TABLE[words.view(np.uint8)].sum(axis=1, dtype=np.int64)
+
+def pack_occupancy(voxels, threshold=0.1):
+    """ Occupancy at threshold of a batch of shapes (4D) as bits, (n, words) uint64 """
+    occupied = np.asarray(voxels).reshape(len(voxels), -1) >= threshold
+    packed = np.packbits(occupied, axis=1)
+    padded = np.zeros((len(packed), -(-packed.shape[1] // 8) * 8), dtype=np.uint8)
+    padded[:, :packed.shape[1]] = packed
+    return padded.view(np.uint64)
+
+def cell_counts(voxels, threshold=0.1, cell=8):
+    """
+    Number of occupied voxels in each cell of cell^3 voxels of a batch of shapes (4D),
+    (n, cells) uint16. The sum over cells of the minimum of the counts of two shapes bounds
+    their intersection.
+    """
+    occupied = np.asarray(voxels) >= threshold
+    dims = [-(-dim // cell) * cell for dim in occupied.shape[1:]]
+    grid = np.zeros([len(occupied)] + dims, dtype=np.uint16)
+    grid[(slice(None),) + tuple(slice(0, dim) for dim in occupied.shape[1:])] = occupied
+    grid = grid.reshape(len(occupied), dims[0] // cell, cell, dims[1] // cell, cell,
+                        dims[2] // cell, cell)
+    return grid.sum(axis=(2, 4, 6), dtype=np.uint16).reshape(len(occupied), -1)
+
+def coarse_counts(cells, grid):
+    """ Sum the cell counts (n, cells) of a grid of cells by blocks of 2 x 2 x 2 cells """
+    padded = np.zeros((len(cells),) + tuple(-(-dim // 2) * 2 for dim in grid), dtype=np.uint16)
+    padded[:, :grid[0], :grid[1], :grid[2]] = cells.reshape((len(cells),) + tuple(grid))
+    padded = padded.reshape(len(cells), padded.shape[1] // 2, 2, padded.shape[2] // 2, 2,
+                            padded.shape[3] // 2, 2)
+    return padded.sum(axis=(2, 4, 6), dtype=np.uint16).reshape(len(cells), -1)
+
+def iou(intersection, count_a, count_b):
+    """ Intersection over union from intersection and occupied counts, 1 for two empty shapes """
+    union = count_a + count_b - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1), 1.)
+
+class ShapeIndex(object):
+    """
+    Index of the shapes of a tensor for IoU queries at a threshold, and of their latent
+    vectors for nearest neighbor queries.
+    words: bit-packed occupancy of each shape (see pack_occupancy)
+    counts: number of occupied voxels of each shape
+    cells: occupied voxels per cell of each shape (see cell_counts)
+    latent: (n, d) latent vectors (the inputs of main.lua), or None
+    A query only computes the exact IoU of the shapes that may be in the top k: an upper
+    bound of the IoU with every shape is computed from the counts of cells twice as large
+    (see coarse_counts), then shapes are taken by decreasing bound and skipped once their
+    bound from the cell counts falls below the k-th IoU found so far.
+    """
+
+    def __init__(self, words, counts, cells, dims, threshold=0.1, cell=8, latent=None):
+        self.words = words
+        self.counts = counts
+        self.cells = cells
+        self.dims = tuple(int(dim) for dim in dims)
+        self.threshold = float(threshold)
+        self.cell = int(cell)
+        self.latent = latent
+        self.latent_norms = None if latent is None else np.linalg.norm(latent, axis=1)
+        grid = [-(-dim // self.cell) for dim in self.dims[1:]]
+        self.coarse = coarse_counts(cells, grid)
+
+    @classmethod
+    def build(cls, tensor, threshold=0.1, cell=8, latent=None, chunk_size=256):
+        """ Index a 4D tensor (array or LazyTensor), reading chunk_size shapes at a time """
+        words, counts, cells = [], [], []
+        for start in range(0, tensor.shape[0], chunk_size):
+            voxels = tensor[start:start + chunk_size]
+            words.append(pack_occupancy(voxels, threshold))
+            counts.append(popcount_rows(words[-1]))
+            cells.append(cell_counts(voxels, threshold, cell))
+        if latent is not None:
+            latent = np.asarray(latent, dtype=float).reshape(tensor.shape[0], -1)
+        return cls(np.concatenate(words), np.concatenate(counts), np.concatenate(cells),
+                   tensor.shape, threshold, cell, latent)
+
+    @classmethod
+    def load(cls, filename):
+        """ Load an index saved by save() """
+        with np.load(filename) as archive:
+            return cls(archive['words'], archive['counts'], archive['cells'], archive['dims'],
+                       archive['threshold'], archive['cell'],
+                       archive['latent'] if 'latent' in archive.files else None)
+
+    def save(self, filename):
+        """ Save the index as an .npz archive """
+        arrays = {'words': self.words, 'counts': self.counts, 'cells': self.cells,
+                  'dims': np.array(self.dims), 'threshold': np.array(self.threshold),
+                  'cell': np.array(self.cell)}
+        if self.latent is not None:
+            arrays['latent'] = self.latent
+        np.savez(filename, **arrays)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def signature(self, voxels):
+        """ (words, count, cells) of a shape, an index in the tensor or a 3D matrix """
+        if np.ndim(voxels) == 0:
+            return self.words[voxels], self.counts[voxels], self.cells[voxels]
+        assert tuple(np.shape(voxels)) == self.dims[1:]
+        words = pack_occupancy(np.asarray(voxels)[np.newaxis], self.threshold)[0]
+        return (words, int(popcount_rows(words[np.newaxis])[0]),
+                cell_counts(np.asarray(voxels)[np.newaxis], self.threshold, self.cell)[0])
+
+    def iou(self, voxels, indices):
+        """ IoU of a shape (an index or a 3D matrix) with the shapes at indices """
+        words, count, _ = self.signature(voxels)
+        intersection = popcount_rows(self.words[indices] & words)
+        return iou(intersection, count, self.counts[indices])
+
+    def bound(self, cells, count, indices, coarse=False):
+        """
+        Upper bound of the IoU of a shape of cell counts cells and occupied count with the
+        shapes at indices: intersections are at most the sum over cells of the smaller count.
+        """
+        counts = self.coarse[indices] if coarse else self.cells[indices]
+        intersection = np.minimum(counts, cells).sum(axis=1, dtype=np.int64)
+        return iou(intersection, count, self.counts[indices])
+
+    def query(self, voxels, k=10, block_size=64):
+        """
+        The k shapes of highest IoU with a shape (an index, then excluded from the result,
+        or a 3D matrix), as (indices, ious) by decreasing IoU, empty if k is not positive.
+        """
+        words, count, cells = self.signature(voxels)
+        grid = [-(-dim // self.cell) for dim in self.dims[1:]]
+        bound = self.bound(coarse_counts(cells[np.newaxis], grid)[0], count, slice(None),
+                           coarse=True)
+        if np.ndim(voxels) == 0:
+            bound[voxels] = -1.
+        order = np.argsort(-bound, kind='stable')
+        if np.ndim(voxels) == 0:
+            order = order[:-1]
+
+        best_indices = np.zeros(0, dtype=np.int64)
+        best_ious = np.zeros(0)
+        if k <= 0:
+            return best_indices, best_ious
+        for start in range(0, len(order), block_size):
+            kth = best_ious[-1] if k > 0 and len(best_ious) == k else -1.
+            block = order[start:start + block_size]
+            if bound[block[0]] < kth:
+                break
+            block = block[self.bound(cells, count, block) >= kth]
+            intersection = popcount_rows(self.words[block] & words)
+            candidates = np.concatenate([best_indices, block])
+            ious = np.concatenate([best_ious, iou(intersection, count, self.counts[block])])
+            top = np.lexsort((candidates, -ious))[:k]
+            best_indices, best_ious = candidates[top], ious[top]
+        return best_indices, best_ious
+
+    def nearest_latent(self, vector, k=10, metric='l2'):
+        """
+        The k shapes of latent vector nearest to vector (an index, then excluded, or a
+        vector), as (indices, distances) by increasing distance.
+        metric: l2 for the euclidean distance, cosine for 1 - the cosine similarity.
+        """
+        assert self.latent is not None, 'the index has no latent vectors'
+        assert metric in ('l2', 'cosine')
+        exclude = None
+        if np.ndim(vector) == 0:
+            exclude = int(vector)
+            vector = self.latent[exclude]
+        vector = np.asarray(vector, dtype=float).ravel()
+        norms = self.latent_norms
+        if metric == 'l2':
+            distances = np.sqrt(np.maximum(norms ** 2 - 2 * self.latent.dot(vector)
+                                           + vector.dot(vector), 0))
+        else:
+            distances = 1 - self.latent.dot(vector) / np.maximum(norms * np.linalg.norm(vector),
+                                                                  1e-12)
+        if exclude is not None:
+            distances[exclude] = np.inf
+        k = min(k, len(distances) - (exclude is not None))
+        top = np.argpartition(distances, k - 1)[:k] if k > 0 else np.zeros(0, dtype=np.int64)
+        top = top[np.lexsort((top, distances[top]))]
+        return top, distances[top]
+
+    def duplicates(self, min_iou=0.9):
+        """
+        Pairs of shapes with an IoU of at least min_iou, and the groups they form.
+        Shapes are sorted by count, so each one is only compared with the following shapes
+        of count up to its own divided by min_iou, then the per cell bound skips more pairs.
+        Return (pairs (m, 2), ious (m,), groups): pairs are sorted, each with its smaller index
+        first; groups is a list of index arrays of the shapes linked by pairs, with at least
+        two shapes each.
+        """
+        assert 0 < min_iou <= 1
+        order = np.argsort(self.counts, kind='stable')
+        counts = self.counts[order]
+        limits = np.searchsorted(counts, counts / min_iou, side='right')
+        firsts, seconds, values = [], [], []
+        for pos, shape in enumerate(order):
+            candidates = order[pos + 1:limits[pos]]
+            if len(candidates) == 0:
+                continue
+            candidates = candidates[self.bound(self.cells[shape], self.counts[shape],
+                                               candidates) >= min_iou]
+            ious = self.iou(shape, candidates)
+            keep = ious >= min_iou
+            firsts.append(np.full(int(keep.sum()), shape))
+            seconds.append(candidates[keep])
+            values.append(ious[keep])
+        pairs = np.zeros((0, 2), dtype=np.int64)
+        ious = np.zeros(0)
+        if firsts:
+            pairs = np.sort(np.stack([np.concatenate(firsts), np.concatenate(seconds)],
+                                     axis=1), axis=1)
+            ious = np.concatenate(values)
+            order = np.lexsort((pairs[:, 1], pairs[:, 0]))
+            pairs, ious = pairs[order], ious[order]
+        graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                           shape=(len(self), len(self)))
+        _, labels = graph_components(graph, directed=False)
+        sizes = np.bincount(labels)
+        groups = [np.nonzero(labels == label)[0] for label in np.nonzero(sizes > 1)[0]]
+        return pairs, ious, groups
+
+def index_path(filename, threshold=0.1, varname='voxels'):
+    """ Path of the index kept next to a tensor file """
+    return '%s.%s.index_%g.npz' % (filename, varname, threshold)
+
+def open_index(filename, varname='voxels', threshold=0.1, cache=False):
+    """
+    The ShapeIndex of a tensor file at threshold, with its latent vectors if the file has
+    inputs. It is saved next to the file and loaded again while the file is unchanged.
+    """
+    path = index_path(filename, threshold, varname)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(filename):
+        return ShapeIndex.load(path)
+    start = time.time()
+    tensor = read_tensor(filename, varname, lazy=True, cache=cache)
+    latent = read_inputs(filename) if filename[-4:] in ('.mat', '.npz') else None
+    index = ShapeIndex.build(tensor, threshold, latent=latent)
+    index.save(path)
+    print("%d shapes indexed in %.1f s" % (len(index), time.time() - start))
+    return index
+
+if __name__ == '__main__':
+    import sys
+    import csv
+    import argparse
+    CMD_PARSER = argparse.ArgumentParser(description="""Finding the shapes most similar to a
+                                         shape, or the near duplicate shapes, of a .mat voxel
+                                         file or .npz archive. """)
+    CMD_PARSER.add_argument('filename', metavar='filename', type=str,
+                            help='name of .mat file, .npz archive or .npy file')
+    CMD_PARSER.add_argument('-t', '--threshold', metavar='threshold', type=float, default=0.1,
+                            help='voxels with confidence lower than the threshold are empty')
+    CMD_PARSER.add_argument('-q', '--query', metavar='index', type=int, default=None,
+                            help='print the shapes of highest IoU with this shape (one based)')
+    CMD_PARSER.add_argument('-k', metavar='k', type=int, default=10,
+                            help='number of shapes printed by --query')
+    CMD_PARSER.add_argument('-l', '--latent', action="store_true",
+                            help='with --query, rank shapes by the distance of their latent\
+                            vectors (the inputs variable) instead')
+    CMD_PARSER.add_argument('--metric', metavar='metric', type=str, default='l2',
+                            help='latent distance: l2 or cosine')
+    CMD_PARSER.add_argument('-d', '--dedup', metavar='min_iou', type=float, default=None,
+                            help='list the groups of shapes with an IoU of at least MIN_IOU')
+    CMD_PARSER.add_argument('-o', '--output', metavar='output', type=str, default=None,
+                            help='with --dedup, write the groups as CSV (group, index)\
+                            instead of printing them')
+    CMD_PARSER.add_argument('-nc', '--npy-cache', action="store_true",
+                            help='keep a memory mapped .npy copy of the voxels next to the\
+                            input file')
+
+    ARGS = CMD_PARSER.parse_args()
+    INDEX = open_index(ARGS.filename, threshold=ARGS.threshold, cache=ARGS.npy_cache)
+
+    if ARGS.query is not None:
+        START = time.time()
+        if ARGS.latent:
+            INDICES, SCORES = INDEX.nearest_latent(ARGS.query - 1, ARGS.k, metric=ARGS.metric)
+            NAME = ARGS.metric + ' distance'
+        else:
+            INDICES, SCORES = INDEX.query(ARGS.query - 1, ARGS.k)
+            NAME = 'IoU'
+        print("query of shape %d in %.1f ms" % (ARGS.query, 1000 * (time.time() - START)))
+        for IND, SCORE in zip(INDICES, SCORES):
+            print("%8d  %s %.4f" % (IND + 1, NAME, SCORE))
+
+    if ARGS.dedup is not None:
+        START = time.time()
+        PAIRS, IOUS, GROUPS = INDEX.duplicates(ARGS.dedup)
+        print("%d pairs, %d groups of near duplicates (%d shapes) found in %.1f s"
+              % (len(PAIRS), len(GROUPS), sum(len(group) for group in GROUPS),
+                 time.time() - START))
+        OUTPUT = open(ARGS.output, 'w', newline='') if ARGS.output else sys.stdout
+        WRITER = csv.writer(OUTPUT)
+        WRITER.writerow(['group', 'index'])
+        for NUMBER, GROUP in enumerate(GROUPS):
+            WRITER.writerows([NUMBER + 1, IND + 1] for IND in GROUP)
+        if ARGS.output:
+            OUTPUT.close()
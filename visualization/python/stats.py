@@ -0,0 +1,65 @@
+"""
+Per-shape statistics of a voxel file, to screen sample runs before rendering
+"""
+
+import sys
+import csv
+import json
+import time
+import numpy as np
+from util import read_tensor, shape_statistics
+
+def statistics_rows(columns):
+    """ Turn the columns of shape_statistics into one dict per shape, NaN becoming None """
+    names = list(columns)
+    rows = []
+    for ind in range(len(columns['index'])):
+        row = {}
+        for name in names:
+            value = columns[name][ind].item()
+            row[name] = None if isinstance(value, float) and np.isnan(value) else value
+        row['index'] += 1    # matlab use 1 base index
+        rows.append(row)
+    return rows
+
+def write_statistics(rows, output):
+    """ Write rows to a file object as CSV, or as JSON if its name ends with .json """
+    if output.name.endswith('.json'):
+        json.dump(rows, output, indent=1)
+        return
+    writer = csv.DictWriter(output, fieldnames=list(rows[0]) if rows else [])
+    writer.writeheader()
+    writer.writerows(rows)
+
+if __name__ == '__main__':
+    import argparse
+    CMD_PARSER = argparse.ArgumentParser(description="""Computing per-shape statistics of a
+                                         .mat voxel file or .npz archive. """)
+    CMD_PARSER.add_argument('filename', metavar='filename', type=str,
+                            help='name of .mat file or .npz archive')
+    CMD_PARSER.add_argument('-t', '--thresholds', metavar='threshold', type=float, nargs='+',
+                            default=[0.1], help='occupancy thresholds, the first one is used\
+                            for center of mass, bounding box, mean confidence and components')
+    CMD_PARSER.add_argument('-mc', '--max-component', metavar='max_component', type=int, default=3,
+                            help='distance of neighbors for the fraction of voxels in the\
+                            max connected component. Set to 0 to skip it, which is much faster.')
+    CMD_PARSER.add_argument('-o', '--output', metavar='output', type=str, default=None,
+                            help='.csv or .json file to write, csv on standard output by default')
+    CMD_PARSER.add_argument('-c', '--chunk-size', metavar='chunk_size', type=int, default=64,
+                            help='number of shapes reduced at once')
+    CMD_PARSER.add_argument('-nc', '--npy-cache', action="store_true",
+                            help='keep a memory mapped .npy copy of the voxels next to the\
+                            input file, where every shape is contiguous')
+
+    ARGS = CMD_PARSER.parse_args()
+    START = time.time()
+    VOXELS = read_tensor(ARGS.filename, lazy=True, cache=ARGS.npy_cache)
+    COLUMNS = shape_statistics(VOXELS, ARGS.thresholds, distance=ARGS.max_component,
+                               chunk_size=ARGS.chunk_size)
+    ROWS = statistics_rows(COLUMNS)
+    if ARGS.output is None:
+        write_statistics(ROWS, sys.stdout)
+    else:
+        with open(ARGS.output, 'w') as OUTPUT:
+            write_statistics(ROWS, OUTPUT)
+    sys.stderr.write("%d shapes in %.2f s\n" % (len(ROWS), time.time() - START))
@@ -2,13 +2,310 @@
 Tools for the next steps of visualization
 """
 
+import os
+import zipfile
 import numpy as np
 from scipy import ndimage
 from scipy.io import loadmat
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components as graph_components
+try:
+    from profiling import profiled, count, enabled
+except ImportError:
+    # util is usable on its own: without profiling, its hooks do nothing
+    def profiled(name):
+        return lambda function: function
+
+    def count(**counts):
+        pass
+
+    def enabled():
+        return False
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+# MATLAB v5 data types that can be memory mapped, see the MAT-File Format documentation
+MAT5_DTYPES = {1: 'i1', 2: 'u1', 3: 'i2', 4: 'u2', 5: 'i4', 6: 'u4', 7: 'f4', 9: 'f8',
+               12: 'i8', 13: 'u8'}
+MAT5_MATRIX = 14
+
+# corners of a unit cube centered at the origin, and its faces as corner indices,
+# counterclockwise when seen from outside
+CUBE_CORNERS = np.array([[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0],
+                         [0, 0, 1], [1, 0, 1], [1, 1, 1], [0, 1, 1]], dtype=float) - 0.5
+CUBE_FACES = np.array([[0, 3, 2, 1], [4, 5, 6, 7], [0, 1, 5, 4],
+                       [1, 2, 6, 5], [2, 3, 7, 6], [3, 0, 4, 7]])
+
+class LazyTensor(object):
+    """
+    A 4D tensor with dimensions point, x, y, z, whose shapes are only read when indexed.
+    Indexing with an integer, a slice, a list of integers or a tuple starting with one of
+    these returns a NumPy array, like the matrix returned by read_tensor.
+    read is called with a sorted array of unique shape indices, and returns their voxels.
+    source is an open file read needs, closed by close, at the end of
+    a with block or when the tensor is deleted.
+    """
+
+    def __init__(self, shape, dtype, read, source=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.ndim = len(self.shape)
+        self._read = read
+        self._source = source
+
+    def close(self):
+        """ Close the file the shapes are read from, if any """
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        rest = ()
+        if isinstance(key, tuple):
+            key, rest = key[0], key[1:]
+        if isinstance(key, (int, np.integer)):
+            if not -self.shape[0] <= key < self.shape[0]:
+                raise IndexError('shape index %d out of range' % key)
+            result = self._read(np.array([key % self.shape[0]]))[0]
+        else:
+            indices = np.arange(self.shape[0])[key]
+            unique, inverse = np.unique(indices, return_inverse=True)
+            result = self._read(unique)[inverse.ravel()]
+        return result[rest] if rest else result
+
+    def __array__(self, dtype=None, copy=None):
+        result = self[:]
+        return result if dtype is None else result.astype(dtype)
+
+def squeeze_dims(dims):
+    """ Map the dimensions of a voxels variable to (point, x, y, z), as read_tensor does """
+    dims = tuple(dims)
+    if len(dims) == 5:
+        assert dims[1] == 1
+        return (dims[0],) + dims[2:]
+    elif len(dims) == 3:
+        return (1,) + dims
+    assert len(dims) == 4
+    return dims
+
+def mat5_variable(filename, varname):
+    """
+    Locate an uncompressed numeric variable in a MATLAB v5 .mat file, without reading it.
+    Return (offset, dtype, dims) of its real part, or None if the variable is missing,
+    compressed or not a plain numeric array.
+    """
+    with open(filename, 'rb') as mat_file:
+        header = mat_file.read(128)
+        if len(header) < 128 or header[126:128] not in (b'IM', b'MI'):
+            return None
+        endian = '<' if header[126:128] == b'IM' else '>'
+        file_size = mat_file.seek(0, 2)
+        start = 128
+        while start + 8 <= file_size:
+            mat_file.seek(start)
+            data_type, size = [int(value) for value in np.frombuffer(mat_file.read(8), endian + 'u4')]
+            content_at = start + 8
+            start = content_at + size + (-size % 8)
+            if data_type != MAT5_MATRIX:
+                continue
+            # array flags, dimensions, then name of the variable
+            content = mat_file.read(min(size, 1024))
+            flags = np.frombuffer(content[8:16], endian + 'u4')
+            if flags[0] & 0x800:
+                continue    # complex
+            dims_size = int(np.frombuffer(content[20:24], endian + 'u4')[0])
+            dims = np.frombuffer(content[24:24 + dims_size], endian + 'i4')
+            name_at = 24 + dims_size + (-dims_size % 8)
+            name_tag = np.frombuffer(content[name_at:name_at + 4], endian + 'u4')[0]
+            if name_tag >> 16:
+                # small data element: size in the upper bytes, data in the tag
+                name_size = int(name_tag >> 16)
+                name = content[name_at + 4:name_at + 4 + name_size]
+                data_at = name_at + 8
+            else:
+                name_size = int(np.frombuffer(content[name_at + 4:name_at + 8], endian + 'u4')[0])
+                name = content[name_at + 8:name_at + 8 + name_size]
+                data_at = name_at + 8 + name_size + (-name_size % 8)
+            if name.decode('ascii', 'replace') != varname:
+                continue
+            real_type = int(np.frombuffer(content[data_at:data_at + 4], endian + 'u4')[0])
+            if real_type >> 16 or real_type not in MAT5_DTYPES:
+                return None
+            return content_at + data_at + 8, np.dtype(endian + MAT5_DTYPES[real_type]), \
+                   tuple(int(dim) for dim in dims)
+    return None
+
+def is_hdf5(filename):
+    """ Whether filename is an HDF5 file, such as a MATLAB v7.3 .mat file """
+    with open(filename, 'rb') as mat_file:
+        mat_file.seek(512)
+        return mat_file.read(8) == b'\x89HDF\r\n\x1a\n'
+
+def sidecar_path(filename, varname='voxels'):
+    """ Path of the memory mapped .npy cache kept next to a tensor file """
+    return '%s.%s.npy' % (filename, varname)
+
+def write_sidecar(tensor, path, chunk_bytes=64 * 2**20):
+    """ Write a tensor to a C ordered .npy file, a few shapes at a time """
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float64, shape=tensor.shape)
+    per_shape = max(1, int(np.prod(tensor.shape[1:])) * 8)
+    step = max(1, chunk_bytes // per_shape)
+    for start in range(0, tensor.shape[0], step):
+        out[start:start + step] = tensor[start:start + step]
+    out.flush()
+    del out
+    os.replace(tmp_path, path)
+
+def open_tensor(filename, varname='voxels', cache=False):
+    """
+    Open a tensor file as a LazyTensor with dimensions point, x, y, z.
+    Uncompressed MATLAB v5 files are memory mapped. In these files the point index varies
+    fastest, so one shape is spread over the whole variable; set cache to copy the variable
+    once into a C ordered .npy file next to it, where every shape is contiguous, and memory
+    map that copy on later opens. MATLAB v7.3 files are read in chunks with h5py.
+    .npz archives are opened with open_voxel_archive, .npy files (e.g. written by
+    batch.preprocess_file) are memory mapped. Other files are read entirely with loadmat.
+    """
+    if filename[-4:] == '.npz':
+        return open_voxel_archive(filename)
+    if filename[-4:] == '.npy':
+        voxels = np.load(filename, mmap_mode='r')
+        return LazyTensor(voxels.shape, np.float64,
+                          lambda indices: np.array(voxels[indices], dtype=float))
+    path = sidecar_path(filename, varname)
+    if cache and os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(filename):
+        voxels = np.load(path, mmap_mode='r')
+        return LazyTensor(voxels.shape, voxels.dtype, lambda indices: np.array(voxels[indices]))
+
+    if is_hdf5(filename):
+        if h5py is None:
+            raise ImportError('h5py is needed to read MATLAB v7.3 files')
+        mat_file = h5py.File(filename, 'r')
+        if varname not in mat_file:
+            print(".mat file only has these matrices:")
+            for var in mat_file:
+                print(var)
+            mat_file.close()
+            assert False
+        dataset = mat_file[varname]
+        # h5py sees the MATLAB dimensions reversed, with the point index last
+        dims = squeeze_dims(dataset.shape[::-1])
+        if dataset.ndim == 3:
+            voxels = np.transpose(dataset[()])[np.newaxis].astype(float)
+            mat_file.close()
+            tensor = LazyTensor(dims, np.float64, lambda indices: voxels[indices])
+        else:
+            def read(indices):
+                block = dataset[..., indices].reshape(dims[1:][::-1] + (len(indices),))
+                return np.transpose(block, (3, 2, 1, 0)).astype(float)
+            tensor = LazyTensor(dims, np.float64, read, source=mat_file)
+    else:
+        located = mat5_variable(filename, varname)
+        if located is None:
+            voxels = read_tensor(filename, varname)
+            tensor = LazyTensor(voxels.shape, voxels.dtype, lambda indices: voxels[indices])
+        else:
+            offset, dtype, dims = located
+            raw = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=dims, order='F')
+            voxels = raw.reshape(squeeze_dims(dims), order='F')
+            tensor = LazyTensor(voxels.shape, np.float64,
+                                lambda indices: np.array(voxels[indices], dtype=float))
+
+    if cache:
+        write_sidecar(tensor, path)
+        tensor.close()
+        return open_tensor(filename, varname, cache=True)
+    return tensor
+
+def write_voxel_archive(filename, voxels, inputs=None, encoding='uint8', threshold=0.1):
+    """
+    Write voxels (4D, point first, array or LazyTensor) to a compact .npz archive,
+    one compressed member per shape, written one shape at a time.
+    encoding options: uint8/bits
+    uint8 quantizes confidences in [0, 1] to 256 levels (error at most 1/510),
+    bits keeps the occupancy at threshold only, packed 8 voxels per byte.
+    inputs, the latent vectors of the shapes, are stored alongside if given.
+    """
+    assert encoding in ('uint8', 'bits')
+    assert filename[-4:] == '.npz'
+    with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as archive:
+        header = {'encoding': np.array(encoding), 'threshold': np.array(float(threshold)),
+                  'dims': np.array(voxels.shape)}
+        if inputs is not None:
+            header['inputs'] = np.asarray(inputs)
+        for name, value in header.items():
+            with archive.open(name + '.npy', 'w') as member:
+                np.lib.format.write_array(member, value)
+        for ind in range(voxels.shape[0]):
+            shape = np.asarray(voxels[ind])
+            if encoding == 'uint8':
+                data = np.round(np.clip(shape, 0, 1) * 255).astype(np.uint8)
+            else:
+                data = np.packbits(shape.ravel() >= threshold)
+            with archive.open('shape_%06d.npy' % ind, 'w') as member:
+                np.lib.format.write_array(member, data)
+
+def open_voxel_archive(filename):
+    """
+    Open a .npz archive written by write_voxel_archive as a LazyTensor.
+    Only the members of the indexed shapes are decompressed.
+    """
+    archive = np.load(filename)
+    encoding = str(archive['encoding'])
+    dims = tuple(int(dim) for dim in archive['dims'])
+    def read(indices):
+        result = np.empty((len(indices),) + dims[1:])
+        for pos, ind in enumerate(indices):
+            data = archive['shape_%06d' % ind]
+            if encoding == 'uint8':
+                result[pos] = data * (1. / 255)
+            else:
+                result[pos] = np.unpackbits(data, count=result[pos].size).reshape(dims[1:])
+        return result
+    return LazyTensor(dims, np.float64, read)
+
+def read_inputs(filename, varname='inputs'):
+    """ return the latent vectors saved with the voxels of a .mat file or .npz archive """
+    if filename[-4:] == '.npz':
+        archive = np.load(filename)
+        return archive[varname] if varname in archive else None
+    if is_hdf5(filename):
+        if h5py is None:
+            raise ImportError('h5py is needed to read MATLAB v7.3 files')
+        with h5py.File(filename, 'r') as mat_file:
+            return np.transpose(mat_file[varname][()]) if varname in mat_file else None
+    return loadmat(filename, variable_names=[varname]).get(varname)
+
+def read_tensor(filename, varname='voxels', lazy=False, cache=False):
+    """ return a 4D matrix, with dimensions point, x, y, z
+    filename is a .mat file, a .npz archive written by write_voxel_archive or a 4D .npy file.
+    If lazy is set, return a LazyTensor that only reads the shapes that are indexed.
+    If cache is set, a memory mapped .npy copy is kept next to the file (see open_tensor).
+    """
+    assert filename[-4:] in ('.mat', '.npz', '.npy')
+    if lazy or cache or filename[-4:] in ('.npz', '.npy') or is_hdf5(filename):
+        tensor = open_tensor(filename, varname, cache)
+        if lazy:
+            return tensor
+        voxels = tensor[:]
+        tensor.close()
+        return voxels
 
-def read_tensor(filename, varname='voxels'):
-    """ return a 4D matrix, with dimensions point, x, y, z """
-    assert filename[-4:] == '.mat'
     mats = loadmat(filename)
     if varname not in mats:
         print(".mat file only has these matrices:")
@@ -17,15 +314,7 @@ def read_tensor(filename, varname='voxels'):
         assert False
 
     voxels = mats[varname]
-    dims = voxels.shape
-    if len(dims) == 5:
-        assert dims[1] == 1
-        dims = (dims[0],) + tuple(dims[2:])
-    elif len(dims) == 3:
-        dims = (1) + dims
-    else:
-        assert len(dims) == 4
-    result = np.reshape(voxels, dims)
+    result = np.reshape(voxels, squeeze_dims(voxels.shape))
     return result
 
 def sigmoid(z_var, offset=0, ratio=1):
@@ -66,57 +355,344 @@ def blocktrans_side2cen6(side_size):
     return [half_x, half_y, half_z, abs_x, abs_y, abs_z]
 
 
-def center_of_mass(voxels, threshold=0.1):
-    """ Calculate the center of mass for the current object.
-    Voxels with occupancy less than threshold are ignored
+class SparseVoxels(object):
     """
-    assert voxels.ndim == 3
-    center = [0]*3
-    voxels_filtered = np.copy(voxels)
-    voxels_filtered[voxels_filtered < threshold] = 0
+    The voxels of a 3D matrix as a coordinate list: coords is (n, 3) integer coordinates in
+    scan order and values the (n,) confidences, all other voxels being 0. Memory grows with
+    the number of stored voxels rather than with the grid, and no object is kept per voxel.
+    center_of_mass, downsample, largest_component and the block generation of util_vtk
+    accept it in place of a dense matrix.
+    """
+    __slots__ = ('shape', 'coords', 'values')
+    ndim = 3
+
+    def __init__(self, shape, coords, values):
+        self.shape = tuple(int(dim) for dim in shape)
+        self.coords = coords
+        self.values = values
+
+    @classmethod
+    def from_dense(cls, voxels, threshold=0.1):
+        """ Keep the voxels of a 3D matrix with a confidence no lower than threshold """
+        voxels = np.asarray(voxels)
+        assert voxels.ndim == 3
+        mask = voxels >= threshold
+        dtype = np.int16 if max(voxels.shape) <= np.iinfo(np.int16).max else np.int32
+        return cls(voxels.shape, np.argwhere(mask).astype(dtype), voxels[mask])
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def nbytes(self):
+        """ Memory used by the coordinates and values """
+        return self.coords.nbytes + self.values.nbytes
+
+    def select(self, keep):
+        """ The stored voxels where the boolean array keep is set """
+        return SparseVoxels(self.shape, self.coords[keep], self.values[keep])
+
+    def threshold(self, threshold):
+        """ The stored voxels with a confidence no lower than threshold """
+        if len(self) and self.values.min() >= threshold:
+            return self
+        return self.select(self.values >= threshold)
+
+    def codes(self):
+        """ Linear index of each stored voxel in the dense matrix """
+        return np.ravel_multi_index(tuple(self.coords.astype(np.int64).T), self.shape)
+
+    def to_dense(self, dtype=None):
+        """ The dense matrix, 0 outside of the stored voxels """
+        voxels = np.zeros(self.shape, dtype=self.values.dtype if dtype is None else dtype)
+        voxels[tuple(self.coords.T)] = self.values
+        return voxels
+
+    def mask(self):
+        """ The dense boolean matrix of the stored voxels """
+        occupied = np.zeros(self.shape, dtype=bool)
+        occupied[tuple(self.coords.T)] = True
+        return occupied
+
+    def center_of_mass(self):
+        """ Center of mass of the stored voxels weighted by their values, as center_of_mass """
+        total = self.values.sum()
+        if total == 0:
+            print('threshold too high for current object.')
+            return [length / 2 for length in self.shape]
+        return list(self.values.dot(self.coords) / total)
 
-    total = voxels_filtered.sum()
+    def largest_component(self, distance):
+        """
+        Keep the stored voxels of the max connected component, as largest_component.
+        Components are labeled in the bounding box of the voxels only.
+        """
+        if len(self) == 0:
+            return self
+        lower = self.coords.min(0)
+        local = tuple((self.coords - lower).T)
+        box = np.zeros(self.coords.max(0) - lower + 1, dtype=bool)
+        box[local] = True
+        return self.select(largest_component(box, distance)[local])
+
+    def downsample(self, step, method='max', edge='pad'):
+        """
+        Downsample by a factor of step as downsample does on the dense matrix, reducing
+        only the blocks that hold stored voxels. occupancy is the fraction of stored voxels.
+        Blocks that are 0 (e.g. with min, unless the block is full) are not stored.
+        """
+        assert step > 0 and int(step) == step
+        assert method in ('max', 'mean', 'min', 'occupancy')
+        assert edge in ('pad', 'crop')
+        step = int(step)
+        if step == 1 and method != 'occupancy':
+            return self
+        source = self
+        if edge == 'crop':
+            shape = tuple(dim // step for dim in self.shape)
+            source = self.select(np.all(self.coords < np.array(shape) * step, axis=1))
+        else:
+            shape = tuple(-(-dim // step) for dim in self.shape)
+        if len(source) == 0:
+            return SparseVoxels(shape, source.coords, source.values.astype(float))
+
+        # stored voxels grouped by block, blocks in scan order
+        blocks = source.coords // step
+        codes = np.ravel_multi_index(tuple(blocks.astype(np.int64).T), shape)
+        order = np.argsort(codes, kind='stable')
+        codes, values = codes[order], source.values[order]
+        first = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        coords = blocks[order[first]]
+
+        # number of voxels in each block, smaller for partial blocks
+        volume = np.ones(len(first))
+        for axis, dim in enumerate(source.shape):
+            volume *= np.minimum(step, dim - step * coords[:, axis].astype(np.int64))
+        if method == 'max':
+            result = np.maximum.reduceat(values, first)
+        elif method == 'mean':
+            result = np.add.reduceat(values.astype(float), first) / volume
+        elif method == 'occupancy':
+            result = np.diff(np.r_[first, len(codes)]) / volume
+        else:
+            full = np.diff(np.r_[first, len(codes)]) == volume
+            result = np.minimum.reduceat(values, first)[full]
+            coords = coords[full]
+        return SparseVoxels(shape, coords, result)
+
+def to_sparse(voxels, threshold=0.1):
+    """ The voxels with a confidence no lower than threshold, dense matrix or SparseVoxels """
+    if isinstance(voxels, SparseVoxels):
+        return voxels.threshold(threshold)
+    return SparseVoxels.from_dense(voxels, threshold)
+
+def plane_sums(voxels, threshold=0.1):
+    """
+    Sums of the voxels of each plane (first axis) of a 3D matrix along each of the other two
+    axes, shapes (n0, n1) and (n0, n2). Voxels with occupancy less than threshold are ignored.
+    The sums of a plane do not depend on the other planes, so those of a matrix are the
+    concatenation of those of its slabs (see chunked.center_of_mass).
+    """
+    filtered = np.where(voxels < threshold, 0, voxels)
+    return filtered.sum(2), filtered.sum(1)
+
+def sums_center(shape, rows, cols):
+    """ Center of mass of a matrix of shape from its plane_sums """
+    plane_totals = rows.sum(1)
+    total = plane_totals.sum()
     if total == 0:
         print('threshold too high for current object.')
-        return [length / 2 for length in voxels.shape]
+        return [length / 2 for length in shape]
+    return [np.multiply(plane_totals, np.arange(shape[0])).sum()/total,
+            np.multiply(rows.sum(0), np.arange(shape[1])).sum()/total,
+            np.multiply(cols.sum(0), np.arange(shape[2])).sum()/total]
 
-    # calculate center of mass
-    center[0] = np.multiply(voxels_filtered.sum(1).sum(1), np.arange(voxels.shape[0])).sum()/total
-    center[1] = np.multiply(voxels_filtered.sum(0).sum(1), np.arange(voxels.shape[1])).sum()/total
-    center[2] = np.multiply(voxels_filtered.sum(0).sum(0), np.arange(voxels.shape[2])).sum()/total
+def center_of_mass(voxels, threshold=0.1):
+    """ Calculate the center of mass for the current object.
+    Voxels with occupancy less than threshold are ignored
+    """
+    if isinstance(voxels, SparseVoxels):
+        return voxels.threshold(threshold).center_of_mass()
+    assert voxels.ndim == 3
+    rows, cols = plane_sums(voxels, threshold)
+    return sums_center(voxels.shape, rows, cols)
 
-    return center
+def pool_axis(voxels, axis, step, ufunc):
+    """
+    Reduce voxels along axis by blocks of step, combining the strided slices with ufunc.
+    A partial last block is reduced over the voxels it contains.
+    """
+    index = [slice(None)] * voxels.ndim
+    index[axis] = slice(0, None, step)
+    res = np.array(voxels[tuple(index)])
+    for offset in range(1, step):
+        index[axis] = slice(offset, None, step)
+        part = voxels[tuple(index)]
+        target = [slice(None)] * voxels.ndim
+        target[axis] = slice(0, part.shape[axis])
+        ufunc(res[tuple(target)], part, out=res[tuple(target)])
+    return res
 
-def downsample(voxels, step, method='max'):
+@profiled('downsample')
+def downsample(voxels, step, method='max', threshold=0.1, edge='pad'):
     """
-    downsample a voxels matrix by a factor of step.
-    downsample method options: max/mean
-    same as a pooling
+    downsample a voxels matrix (3D) or a batch of voxels matrices (4D) by a factor of step.
+    downsample method options: max/mean/min/occupancy, where occupancy is the fraction
+    of voxels in a block with a confidence no lower than threshold.
+    same as a pooling, computed on all shapes at once with one strided pass per axis.
+    If a dimension is not a multiple of step, edge='pad' pools the last, partial block
+    over the voxels it contains, while edge='crop' drops the trailing voxels.
+    SparseVoxels are downsampled without building the dense matrix (see SparseVoxels.downsample).
     """
-    assert step > 0
+    if isinstance(voxels, SparseVoxels):
+        if method == 'occupancy':
+            voxels = voxels.threshold(threshold)
+        return voxels.downsample(step, method, edge)
+    assert step > 0 and int(step) == step
     assert voxels.ndim == 3 or voxels.ndim == 4
-    assert method in ('max', 'mean')
-    if step == 1:
+    assert method in ('max', 'mean', 'min', 'occupancy')
+    assert edge in ('pad', 'crop')
+    step = int(step)
+    if step == 1 and method != 'occupancy':
         return voxels
 
-    if voxels.ndim == 3:
-        s_x, s_y, s_z = voxels.shape[-3:]
-        r_x, r_y, r_z = np.ogrid[0:s_x, 0:s_y, 0:s_z]
-        regions = s_z/step * s_y/step * (r_x/step) + s_z/step * (r_y/step) + r_z/step
-        if method == 'max':
-            res = ndimage.maximum(voxels, labels=regions, index=np.arange(regions.max() + 1))
-        elif method == 'mean':
-            res = ndimage.mean(voxels, labels=regions, index=np.arange(regions.max() + 1))
-        res.shape = (s_x/step, s_y/step, s_z/step)
-        return res
+    grid = voxels if voxels.ndim == 4 else voxels[np.newaxis]
+    if edge == 'crop':
+        grid = grid[(slice(None),) + tuple(slice(0, dim // step * step) for dim in grid.shape[1:])]
+
+    if method == 'max':
+        ufunc = np.maximum
+    elif method == 'min':
+        ufunc = np.minimum
     else:
-        res0 = downsample(voxels[0], step, method)
-        res = np.zeros((voxels.shape[0],) + res0.shape)
-        res[0] = res0
-        for ind in range(1, voxels.shape[0]):
-            res[ind] = downsample(voxels[ind], step, method)
-        return res
+        ufunc = np.add
+        if method == 'occupancy':
+            grid = grid >= threshold
+        grid = grid.astype(float)
+
+    res = grid
+    for axis in (1, 2, 3):
+        res = pool_axis(res, axis, step, ufunc)
+
+    if ufunc is np.add:
+        # number of voxels in each block, smaller for partial blocks
+        counts = [np.minimum(step, dim - step * np.arange(-(-dim // step))) for dim in grid.shape[1:]]
+        res /= counts[0][:, np.newaxis, np.newaxis] * counts[1][:, np.newaxis] * counts[2]
+    return res if voxels.ndim == 4 else res[0]
+
+def ball_offsets(distance):
+    """
+    Integer offsets (dx, dy, dz) with dx^2+dy^2+dz^2 <= distance^2, excluding the origin.
+    Only the lexicographically positive half is returned, since connectivity is symmetric.
+    """
+    assert distance > 0
+    rng = np.arange(-distance, distance + 1)
+    d_x, d_y, d_z = np.meshgrid(rng, rng, rng, indexing='ij')
+    offsets = np.stack([d_x.ravel(), d_y.ravel(), d_z.ravel()], axis=1)
+    inside = (offsets ** 2).sum(1) <= distance * distance
+    positive = (offsets[:, 0] > 0) | ((offsets[:, 0] == 0) & (offsets[:, 1] > 0)) | \
+               ((offsets[:, 0] == 0) & (offsets[:, 1] == 0) & (offsets[:, 2] > 0))
+    return offsets[inside & positive]
+
+def erode_cube(occupied):
+    """
+    Binary erosion of a boolean batch of voxels matrices (4D) by a 3x3x3 cube,
+    one axis at a time. Voxels outside the matrix count as occupied.
+    """
+    eroded = occupied.copy()
+    for axis in (1, 2, 3):
+        lower = [slice(None)] * 4
+        upper = [slice(None)] * 4
+        lower[axis] = slice(0, -1)
+        upper[axis] = slice(1, None)
+        previous = eroded.copy()
+        eroded[tuple(upper)] &= previous[tuple(lower)]
+        eroded[tuple(lower)] &= previous[tuple(upper)]
+    return eroded
+
+def connected_components(voxels, distance):
+    """
+    Label the connected components of a boolean voxel matrix (3D) or batch (4D, shape first).
+    Two voxels are neighbors if their distance is no larger than distance.
+    Return (labels, sizes): labels has the shape of voxels, 0 for empty voxels and
+    1..n for components, numbered in scan order; sizes[l] is the size of component l
+    (sizes[0] is 0). In the 4D case components never span two shapes.
+    """
+    assert distance > 0
+    assert voxels.ndim == 3 or voxels.ndim == 4
+    occupied = np.asarray(voxels, dtype=bool)
+    grid = occupied if occupied.ndim == 4 else occupied[np.newaxis]
+
+    # the ball of radius 1 is the 6-neighborhood, from radius 2 on it contains the 3x3x3 cube
+    structure = np.zeros((3, 3, 3, 3), dtype=bool)
+    structure[1] = ndimage.generate_binary_structure(3, 1 if distance == 1 else 3)
+    base, num = ndimage.label(grid, structure=structure)
+    if num == 0:
+        return base.reshape(occupied.shape), np.zeros(1, dtype=np.int64)
+
+    # join the base components that are linked by the longer offsets of the ball.
+    # The closest linked pair of two components has both voxels on their boundaries
+    # (otherwise a neighbor in the direction of the other voxel is closer),
+    # so only voxels with an empty voxel in their 3x3x3 neighborhood are compared.
+    offsets = [offset for offset in ball_offsets(distance) if np.abs(offset).max() > 1]
+    rows, cols = [], []
+    if offsets:
+        # boundary labels in a grid padded by distance, so that no offset leaves its shape
+        padded = np.zeros((grid.shape[0],) + tuple(dim + 2 * distance for dim in grid.shape[1:]),
+                          dtype=base.dtype)
+        inner = (slice(None),) + (slice(distance, -distance),) * 3
+        padded[inner] = np.where(erode_cube(grid), 0, base)
+        boundary = np.flatnonzero(padded)
+        padded = padded.ravel()
+        src_labels = padded[boundary]
+        strides = np.cumprod((1,) + tuple(dim + 2 * distance for dim in grid.shape[:0:-1]))[2::-1]
+        for offset in offsets:
+            dst_labels = padded[boundary + offset.dot(strides)]
+            linked = dst_labels != src_labels
+            linked &= dst_labels != 0
+            rows.append(src_labels[linked])
+            cols.append(dst_labels[linked])
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=base.dtype)
+    cols = np.concatenate(cols) if cols else np.zeros(0, dtype=base.dtype)
+    graph = coo_matrix((np.ones(rows.size, dtype=np.int8), (rows, cols)), shape=(num + 1, num + 1))
+    _, merged = graph_components(graph, directed=False)
+
+    # base labels are in scan order, so number components by their lowest base label
+    _, first, inverse = np.unique(merged[1:], return_index=True, return_inverse=True)
+    relabel = np.zeros(num + 1, dtype=np.int64)
+    relabel[1:] = (np.argsort(np.argsort(first)) + 1)[inverse.ravel()]
+
+    labels = relabel[base]
+    sizes = np.bincount(labels.ravel(), minlength=first.size + 1)
+    sizes[0] = 0
+    return labels.reshape(occupied.shape), sizes
+
+def largest_component(voxels, distance):
+    """
+    Keep the max connected component of the voxels (a boolean matrix, 3D or 4D batch).
+    In the 4D case the largest component is kept for each shape independently.
+    Ties are broken in favor of the component found first in scan order.
+    SparseVoxels are labeled in their bounding box and returned as SparseVoxels.
+    """
+    if isinstance(voxels, SparseVoxels):
+        return voxels.largest_component(distance)
+    labels, sizes = connected_components(voxels, distance)
+    if sizes.size == 1:
+        return np.zeros(labels.shape, dtype=bool)
+    if labels.ndim == 3:
+        return labels == np.argmax(sizes[1:]) + 1
 
+    # shape of each component, then the largest component per shape
+    shape_of = np.zeros(sizes.size, dtype=np.int64)
+    shape_of[labels.reshape(labels.shape[0], -1)] = np.arange(labels.shape[0])[:, np.newaxis]
+    comps = np.arange(1, sizes.size)
+    order = np.lexsort((comps, -sizes[1:], shape_of[1:]))
+    best = comps[order][np.r_[True, np.diff(shape_of[1:][order]) != 0]]
+    keep = np.zeros(sizes.size, dtype=bool)
+    keep[best] = True
+    return keep[labels]
+
+@profiled('max_component')
 def max_connected(voxels, distance):
     """
     Keep the max connected component of the voxels (a boolean matrix).
@@ -124,32 +700,162 @@ def max_connected(voxels, distance):
     then two blocks are considered connected even with a hole in between
     """
     assert distance > 0
-    max_component = np.zeros(voxels.shape, dtype=bool)
-    voxels = np.copy(voxels)
-    for start_x in range(voxels.shape[0]):
-        for start_y in range(voxels.shape[1]):
-            for start_z in range(voxels.shape[2]):
-                if not voxels[start_x, start_y, start_z]:
-                    continue
-                # start a new component
-                component = np.zeros(voxels.shape, dtype=bool)
-                stack = [[start_x, start_y, start_z]]
-                component[start_x, start_y, start_z] = True
-                voxels[start_x, start_y, start_z] = False
-                while len(stack) > 0:
-                    coord_x, coord_y, coord_z = stack.pop()
-                    for i in range(coord_x-distance, coord_x+distance + 1):
-                        for j in range(coord_y-distance, coord_y+distance + 1):
-                            for k in range(coord_z-distance, coord_z+distance + 1):
-                                if (i-coord_x)**2+(j-coord_y)**2+(k-coord_z)**2 > distance*distance:
-                                    continue
-                                if voxel_exist(voxels, i, j, k):
-                                    voxels[i, j, k] = False
-                                    component[i, j, k] = True
-                                    stack.append([i, j, k])
-                if component.sum() > max_component.sum():
-                    max_component = component
-    return max_component
+    kept = largest_component(voxels, distance)
+    if enabled():
+        count(component_voxels=len(kept) if isinstance(kept, SparseVoxels)
+              else int(np.count_nonzero(kept)))
+    return kept
+
+
+@profiled('preprocess')
+def preprocess(voxels, threshold=0.1, connect=0, factor=1, method='max'):
+    """
+    Prepare a voxels matrix (3D) or a batch of them (4D) for rendering, as visualize.py does:
+    keep only the max connected component of voxels above threshold (if connect > 0,
+    with connect as the neighbor distance), then downsample by factor with method.
+    Return a new float matrix, voxels is left unchanged.
+    """
+    voxels = np.array(voxels, dtype=float)
+    if connect > 0:
+        keep = max_connected(voxels >= threshold, connect)
+        voxels[np.logical_not(keep)] = 0
+    if factor > 1:
+        voxels = downsample(voxels, factor, method=method, threshold=threshold)
+    return voxels
+
+def shape_statistics(voxels, thresholds=(0.1,), distance=3, chunk_size=64):
+    """
+    Compute statistics of every shape of a 4D tensor (array or LazyTensor), reading
+    chunk_size shapes at a time and reducing each chunk without copying it.
+    The first threshold is used for center of mass (as center_of_mass), bounding box,
+    mean confidence of occupied voxels and the fraction of occupied voxels in the
+    max connected component (with neighbor distance, skipped if distance is 0).
+    Return a dict of columns, one entry per shape:
+    index, center_x/y/z, occupied_<threshold> for each threshold, min_x/y/z and max_x/y/z
+    (-1 for empty shapes), mean_confidence and largest_component_fraction (NaN if empty).
+    """
+    assert voxels.ndim == 4
+    threshold = thresholds[0]
+    n_shapes = voxels.shape[0]
+    columns = {'index': np.arange(n_shapes)}
+    for value in thresholds:
+        columns['occupied_%g' % value] = np.zeros(n_shapes, dtype=np.int64)
+    for name in ('center_x', 'center_y', 'center_z'):
+        columns[name] = np.zeros(n_shapes)
+    for name in ('min_x', 'min_y', 'min_z', 'max_x', 'max_y', 'max_z'):
+        columns[name] = np.zeros(n_shapes, dtype=np.int64)
+    for name in ('mean_confidence', 'largest_component_fraction'):
+        columns[name] = np.zeros(n_shapes)
+
+    for start in range(0, n_shapes, chunk_size):
+        shapes = np.asarray(voxels[start:start + chunk_size])
+        stop = start + shapes.shape[0]
+        mask = shapes >= threshold
+        for value in thresholds:
+            columns['occupied_%g' % value][start:stop] = np.count_nonzero(shapes >= value,
+                                                                          axis=(1, 2, 3))
+        occupied = columns['occupied_%g' % threshold][start:stop]
+        empty = occupied == 0
+
+        # weighted marginals along each axis, as einsum does not build the filtered grid
+        marginals = [np.einsum('nxyz,nxyz->nx', shapes, mask),
+                     np.einsum('nxyz,nxyz->ny', shapes, mask),
+                     np.einsum('nxyz,nxyz->nz', shapes, mask)]
+        total = marginals[0].sum(1)
+        safe_total = np.where(empty, 1, total)
+        for axis, name in enumerate('xyz'):
+            length = shapes.shape[axis + 1]
+            center = marginals[axis].dot(np.arange(length)) / safe_total
+            columns['center_' + name][start:stop] = np.where(empty, length / 2, center)
+            present = mask.any(axis=tuple(ax for ax in (1, 2, 3) if ax != axis + 1))
+            first = np.argmax(present, axis=1)
+            last = length - 1 - np.argmax(present[:, ::-1], axis=1)
+            columns['min_' + name][start:stop] = np.where(empty, -1, first)
+            columns['max_' + name][start:stop] = np.where(empty, -1, last)
+        columns['mean_confidence'][start:stop] = np.where(empty, np.nan,
+                                                          total / np.maximum(occupied, 1))
+
+        fraction = np.full(shapes.shape[0], np.nan)
+        if distance > 0:
+            labels, sizes = connected_components(mask, distance)
+            # components are numbered in scan order, so each shape owns a range of labels
+            bounds = np.maximum.accumulate(labels.reshape(len(labels), -1).max(1))
+            lower = np.r_[0, bounds[:-1]]
+            for ind in np.nonzero(~empty)[0]:
+                fraction[ind] = sizes[lower[ind] + 1:bounds[ind] + 1].max() / occupied[ind]
+        columns['largest_component_fraction'][start:stop] = fraction
+    return columns
+
+def extract_surface(voxels, values=None, levels=256):
+    """
+    Extract the surface of a boolean voxel matrix as quads, voxel (i, j, k) spanning
+    [i, i+1] x [j, j+1] x [k, k+1]. Only faces between an occupied and an empty cell are
+    kept, then coplanar adjacent faces are greedily merged into rectangles: first into runs
+    along one in-plane axis, then identical runs of consecutive rows into one rectangle.
+    If values is given, it is quantized into levels bins and faces of different bins are
+    not merged, so that a colormap can still be applied per quad.
+    Return (quads, keys, stats): quads is (m, 4, 3) corner coordinates, counterclockwise
+    when seen from outside; keys is the (m,) bin of each quad (0 if values is None);
+    stats counts the faces before culling, after culling and after merging.
+    """
+    assert voxels.ndim == 3
+    occupied = np.asarray(voxels, dtype=bool)
+    key = np.zeros(occupied.shape, dtype=np.int64)
+    if values is None:
+        key[occupied] = 1
+    else:
+        key[occupied] = np.clip((np.asarray(values)[occupied] * levels).astype(np.int64),
+                                0, levels - 1) + 1
+    padded = np.pad(key, 1, mode='constant')
+    quads, keys = [], []
+    exposed = 0
+
+    for axis in range(3):
+        # in-plane axes, chosen so that u x w points along +axis
+        axis_u, axis_w = (axis + 1) % 3, (axis + 2) % 3
+        for direction in (-1, 1):
+            neighbor = np.roll(padded, -direction, axis=axis)
+            face_key = np.where(neighbor == 0, padded, 0)[1:-1, 1:-1, 1:-1]
+            face_key = face_key.transpose(axis, axis_u, axis_w)
+            exposed += int(np.count_nonzero(face_key))
+
+            # runs of equal keys along w
+            run_key = np.pad(face_key, ((0, 0), (0, 0), (1, 1)), mode='constant')
+            plane, row, pos = np.nonzero(run_key[..., 1:] != run_key[..., :-1])
+            after = run_key[plane, row, pos + 1]
+            before = run_key[plane, row, pos]
+            is_start = after != 0
+            plane, row, start, run = plane[is_start], row[is_start], pos[is_start], after[is_start]
+            end = pos[before != 0]
+
+            # identical runs on consecutive rows become one rectangle
+            order = np.lexsort((row, run, end, start, plane))
+            plane, row, start, end, run = plane[order], row[order], start[order], end[order], \
+                                          run[order]
+            new_rect = np.ones(len(row), dtype=bool)
+            new_rect[1:] = (plane[1:] != plane[:-1]) | (start[1:] != start[:-1]) | \
+                           (end[1:] != end[:-1]) | (run[1:] != run[:-1]) | \
+                           (row[1:] != row[:-1] + 1)
+            first = np.nonzero(new_rect)[0]
+            last = np.r_[first[1:], len(row)] - 1
+            plane, start, end, run = plane[first], start[first], end[first], run[first]
+            row_lo, row_hi = row[first], row[last] + 1
+
+            corners = np.zeros((len(first), 4, 3))
+            corners[:, :, axis] = (plane + (direction > 0))[:, np.newaxis]
+            corners[:, :, axis_u] = np.stack([row_lo, row_hi, row_hi, row_lo], axis=1)
+            corners[:, :, axis_w] = np.stack([start, start, end, end], axis=1)
+            if direction < 0:
+                corners = corners[:, ::-1]
+            quads.append(corners)
+            keys.append(run - 1 if values is not None else np.zeros(len(run), dtype=np.int64))
+
+    quads = np.concatenate(quads)
+    keys = np.concatenate(keys)
+    total = 6 * int(np.count_nonzero(occupied))
+    stats = {'faces': total, 'exposed_faces': exposed, 'culled_faces': total - exposed,
+             'quads': len(quads), 'merged_faces': exposed - len(quads)}
+    return quads, keys, stats
 
 
 def voxel_exist(voxels, coord_x, coord_y, coord_z):
@@ -3,9 +3,30 @@ VTK functions
 """
 import math
 import numpy as np
-from util import blocktrans_cen2side, center_of_mass
+from util import blocktrans_cen2side, center_of_mass, extract_surface, SparseVoxels, to_sparse, \
+    CUBE_CORNERS, CUBE_FACES
+from octree import VoxelOctree
+from profiling import stage, profiled, count
+import matplotlib
 import matplotlib.cm
 import vtk
+from vtk.util import numpy_support
+
+
+def get_colormap(name='jet'):
+    """ Return the matplotlib colormap called name, for old and new matplotlib versions """
+    if hasattr(matplotlib, 'colormaps'):
+        return matplotlib.colormaps[name]
+    return matplotlib.cm.get_cmap(name)
+
+def set_block_property(actor, color):
+    """ Set the lighting and color of a block actor """
+    actor.GetProperty().SetColor(np.array(color[:3]))
+    actor.GetProperty().SetAmbient(0.5)
+    actor.GetProperty().SetDiffuse(.5)
+    actor.GetProperty().SetSpecular(0.1)
+    actor.GetProperty().SetSpecularColor(1, 1, 1)
+    actor.GetProperty().SetDiffuseColor(color[:3])
 
 
 def block_generation(cen_size, color):
@@ -39,63 +60,459 @@ def block_generation(cen_size, color):
     cube_actor.SetMapper(cube_mapper)
 
     # set the colors
-    cube_actor.GetProperty().SetColor(np.array(color[:3]))
-    cube_actor.GetProperty().SetAmbient(0.5)
-    cube_actor.GetProperty().SetDiffuse(.5)
-    cube_actor.GetProperty().SetSpecular(0.1)
-    cube_actor.GetProperty().SetSpecularColor(1, 1, 1)
-    cube_actor.GetProperty().SetDiffuseColor(color[:3])
+    set_block_property(cube_actor, color)
     # cube_actor.GetProperty().SetAmbientColor(1, 1, 1)
     # cube_actor.GetProperty().ShadingOn()
     return cube_actor
 
-def generate_all_blocks(voxels, threshold=0.1, uniform_size=-1, use_colormap=False):
+def polydata_actor(points, cells, colors=None, default_color=(0.9, 0, 0)):
+    """
+    Build a single actor from NumPy geometry.
+    points: (n, 3) float coordinates
+    cells: (m, k) point indices, one polygon with k corners per row
+    colors: optional (n, 3) per-vertex colors in [0, 1], otherwise default_color is used
+    """
+    poly_data = vtk.vtkPolyData()
+    vtk_points = vtk.vtkPoints()
+    vtk_points.SetData(numpy_support.numpy_to_vtk(np.ascontiguousarray(points, dtype=float),
+                                                  deep=True))
+    poly_data.SetPoints(vtk_points)
+
+    id_type = numpy_support.get_vtk_to_numpy_typemap()[vtk.VTK_ID_TYPE]
+    polys = vtk.vtkCellArray()
+    if hasattr(polys, 'SetData'):
+        # VTK 9: offsets and connectivity arrays
+        offsets = np.arange(cells.shape[0] + 1, dtype=id_type) * cells.shape[1]
+        connectivity = np.ascontiguousarray(cells, dtype=id_type).ravel()
+        polys.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=True),
+                      numpy_support.numpy_to_vtkIdTypeArray(connectivity, deep=True))
+    else:
+        # older VTK: legacy layout, each cell prefixed by its number of points
+        legacy = np.empty((cells.shape[0], cells.shape[1] + 1), dtype=id_type)
+        legacy[:, 0] = cells.shape[1]
+        legacy[:, 1:] = cells
+        polys.SetCells(cells.shape[0],
+                       numpy_support.numpy_to_vtkIdTypeArray(legacy.ravel(), deep=True))
+    poly_data.SetPolys(polys)
+
+    if colors is not None:
+        rgb = np.ascontiguousarray(np.clip(colors[:, :3] * 255, 0, 255), dtype=np.uint8)
+        vtk_colors = numpy_support.numpy_to_vtk(rgb, deep=True)
+        vtk_colors.SetName('colors')
+        poly_data.GetPointData().SetScalars(vtk_colors)
+
+    return mesh_actor(poly_data, default_color)
+
+def mesh_actor(poly_data, default_color=(0.9, 0, 0)):
+    """ Actor drawing poly_data, with the block lighting and default_color without scalars """
+    mapper = vtk.vtkPolyDataMapper()
+    mapper.SetInputData(poly_data)
+    actor = vtk.vtkActor()
+    actor.SetMapper(mapper)
+    set_block_property(actor, default_color)
+    return actor
+
+def polydata_arrays(poly_data):
+    """
+    NumPy arrays of the points, polygons (offsets and connectivity), colors and normals of
+    poly_data, to be cached and drawn again with arrays_actor.
+    None for empty meshes, or VTK versions older than 9.
+    """
+    polys = poly_data.GetPolys()
+    if poly_data.GetNumberOfPoints() == 0 or not hasattr(polys, 'GetOffsetsArray'):
+        return None
+    arrays = {'points': numpy_support.vtk_to_numpy(poly_data.GetPoints().GetData()),
+              'offsets': numpy_support.vtk_to_numpy(polys.GetOffsetsArray()),
+              'connectivity': numpy_support.vtk_to_numpy(polys.GetConnectivityArray())}
+    if poly_data.GetPointData().GetScalars() is not None:
+        arrays['colors'] = numpy_support.vtk_to_numpy(poly_data.GetPointData().GetScalars())
+    if poly_data.GetPointData().GetNormals() is not None:
+        arrays['normals'] = numpy_support.vtk_to_numpy(poly_data.GetPointData().GetNormals())
+    return arrays
+
+def arrays_actor(arrays):
+    """ Actor drawing the mesh arrays returned by polydata_arrays """
+    poly_data = vtk.vtkPolyData()
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(arrays['points'], deep=True))
+    poly_data.SetPoints(points)
+    id_type = numpy_support.get_vtk_to_numpy_typemap()[vtk.VTK_ID_TYPE]
+    polys = vtk.vtkCellArray()
+    polys.SetData(numpy_support.numpy_to_vtkIdTypeArray(arrays['offsets'].astype(id_type),
+                                                        deep=True),
+                  numpy_support.numpy_to_vtkIdTypeArray(arrays['connectivity'].astype(id_type),
+                                                        deep=True))
+    poly_data.SetPolys(polys)
+    if 'colors' in arrays:
+        colors = numpy_support.numpy_to_vtk(arrays['colors'], deep=True)
+        colors.SetName('colors')
+        poly_data.GetPointData().SetScalars(colors)
+    if 'normals' in arrays:
+        normals = numpy_support.numpy_to_vtk(arrays['normals'], deep=True)
+        normals.SetName('Normals')
+        poly_data.GetPointData().SetNormals(normals)
+    return mesh_actor(poly_data)
+
+def cubes_actor(centers, sizes, values, use_colormap=False):
+    """
+    Build a single actor drawing one cube per row of centers (m, 3), with sides sizes (m,),
+    colored by values (m,) in [0, 1] with the jet colormap if use_colormap is set.
+    """
+    points = centers[:, np.newaxis, :] + CUBE_CORNERS[np.newaxis] * sizes[:, np.newaxis, np.newaxis]
+    cells = CUBE_FACES[np.newaxis] + 8 * np.arange(len(centers))[:, np.newaxis, np.newaxis]
+
+    colors = None
+    if use_colormap:
+        colors = np.repeat(get_colormap('jet')(values)[:, :3], 8, axis=0)
+    return polydata_actor(points.reshape(-1, 3), cells.reshape(-1, 4), colors)
+
+def glyph_actor(centers, sizes, values, use_colormap=False):
+    """
+    Build a single actor drawing one cube per row of centers (m, 3), with sides sizes (m,),
+    colored by values (m,) like cubes_actor. The cube geometry is stored once and instanced
+    by vtkGlyph3DMapper, so memory and build time only grow with the number of blocks.
+    """
+    poly_data = vtk.vtkPolyData()
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(np.ascontiguousarray(centers, dtype=float),
+                                              deep=True))
+    poly_data.SetPoints(points)
+    scales = numpy_support.numpy_to_vtk(np.ascontiguousarray(sizes, dtype=float), deep=True)
+    scales.SetName('sizes')
+    poly_data.GetPointData().AddArray(scales)
+    if use_colormap:
+        rgb = np.ascontiguousarray(get_colormap('jet')(values)[:, :3] * 255, dtype=np.uint8)
+        colors = numpy_support.numpy_to_vtk(rgb, deep=True)
+        colors.SetName('colors')
+        poly_data.GetPointData().SetScalars(colors)
+
+    cube = vtk.vtkCubeSource()
+    cube.Update()
+    mapper = vtk.vtkGlyph3DMapper()
+    mapper.SetSourceData(cube.GetOutput())
+    mapper.SetInputData(poly_data)
+    mapper.SetScaleArray('sizes')
+    mapper.SetScaleModeToScaleByMagnitude()
+    mapper.OrientOff()
+    mapper.SetScalarVisibility(use_colormap)
+    actor = vtk.vtkActor()
+    actor.SetMapper(mapper)
+    set_block_property(actor, (0.9, 0, 0))
+    return actor
+
+def generate_merged_blocks(voxels, threshold=0.1, uniform_size=-1, use_colormap=False):
+    """
+    Generate one cube per voxel like generate_all_blocks, but merged into a single
+    vtkPolyData built with NumPy, so the scene holds one actor whatever the number of blocks.
+    """
+    assert voxels.ndim == 3
+    sparse = to_sparse(voxels, threshold)
+    coords = sparse.coords
+    occupancy = sparse.values.astype(float)
+
+    if 0 < uniform_size <= 1:
+        block_size = np.full(len(coords), float(uniform_size))
+    else:
+        block_size = occupancy
+
+    print(len(coords), "blocks filled")
+    count(blocks=len(coords), faces=6 * len(coords))
+    return cubes_actor(coords + 0.5, block_size, occupancy, use_colormap)
+
+def generate_lod_blocks(voxels, threshold=0.1, uniform_size=-1, use_colormap=False, merge=False):
+    """
+    Generate the multi-resolution blocks of the octree of voxels (see VoxelOctree.blocks):
+    solid regions are drawn as single big blocks, thin parts at voxel size.
+    The gap between blocks is the one of voxel size blocks, 1 - uniform_size, or 1 - the
+    mean probability of the block if the size is not uniform. Color follows the mean probability.
+    If merge is set, all blocks are returned as a single actor.
+    """
+    assert voxels.ndim == 3
+    if isinstance(voxels, SparseVoxels):
+        voxels = voxels.to_dense()
+    blocks, values = VoxelOctree(voxels, threshold).blocks()
+    if 0 < uniform_size <= 1:
+        sizes = blocks[:, 3] - (1 - uniform_size)
+    else:
+        sizes = blocks[:, 3] - (1 - values)
+    print(int(blocks[:, 3].dot(blocks[:, 3] ** 2)), "voxels filled,", len(blocks), "blocks drawn")
+    count(blocks=len(blocks), faces=6 * len(blocks))
+    if merge:
+        return [cubes_actor(blocks[:, :3], sizes, values, use_colormap)]
+
+    cmap = get_colormap('jet')
+    actors = []
+    for block, size, value in zip(blocks, sizes, values):
+        color = cmap(float(value)) if use_colormap else [0.9, 0, 0]
+        actors.append(block_generation(list(block[:3]) + [size] * 3, color=color))
+    return actors
+
+def generate_surface_blocks(voxels, threshold=0.1, use_colormap=False):
+    """
+    Generate the blocks of all voxels above threshold as unit cubes, drawing only
+    the faces between occupied and empty cells, greedily merged into large quads.
+    Blocks touch each other, so there are no gaps between neighboring voxels.
+    """
+    assert voxels.ndim == 3
+    if isinstance(voxels, SparseVoxels):
+        voxels = voxels.to_dense()
+    occupied = voxels >= threshold
+    cmap = get_colormap('jet')
+    quads, keys, stats = extract_surface(occupied, voxels if use_colormap else None, levels=cmap.N)
+
+    colors = None
+    if use_colormap:
+        colors = np.repeat(cmap(keys)[:, :3], 4, axis=0)
+
+    filled = int(occupied.sum())
+    print(filled, "blocks filled,", stats['culled_faces'], "hidden faces removed,",
+          stats['merged_faces'], "faces merged,", stats['quads'], "quads drawn")
+    count(blocks=filled, faces=stats['quads'])
+    return polydata_actor(quads.reshape(-1, 3), np.arange(4 * len(quads)).reshape(-1, 4), colors)
+
+def image_data(voxels, cells=False):
+    """
+    Wrap a 3D matrix as vtkImageData without copying it, a point per voxel at its center.
+    VTK runs x fastest, so the image axes are the matrix axes reversed: voxel (i, j, k)
+    is at (k + 0.5, j + 0.5, i + 0.5). Boolean matrices are viewed as uint8,
+    matrices that are not C contiguous are copied once.
+    If cells is set, the voxels are the cell scalars instead, voxel (i, j, k) being the cell
+    [k, k + 1] x [j, j + 1] x [i, i + 1].
+    """
+    assert voxels.ndim == 3
+    voxels = np.ascontiguousarray(voxels)
+    if voxels.dtype == bool:
+        voxels = voxels.view(np.uint8)
+    image = vtk.vtkImageData()
+    scalars = numpy_support.numpy_to_vtk(voxels.ravel(), deep=False)
+    scalars.SetName('confidence')
+    if cells:
+        image.SetDimensions(*[dim + 1 for dim in voxels.shape[::-1]])
+        image.GetCellData().SetScalars(scalars)
+    else:
+        image.SetDimensions(*voxels.shape[::-1])
+        image.SetOrigin(0.5, 0.5, 0.5)
+        image.GetPointData().SetScalars(scalars)
+    return image
+
+def isosurface_polydata(voxels, threshold=0.1, decimate=0, smooth=0, use_colormap=False):
+    """
+    Extract the isosurface of voxels at threshold as a triangle mesh, in the coordinates of
+    the blocks (voxel (i, j, k) centered at (i + 0.5, j + 0.5, k + 0.5)).
+    The matrix is contoured in place with flying edges (marching cubes on older VTK).
+    decimate: fraction of triangles to remove with quadric decimation, 0 to keep them all.
+    smooth: number of windowed sinc smoothing iterations, 0 for none.
+    If use_colormap is set, each vertex is colored with the jet colormap by the highest
+    confidence of the 8 voxels around it.
+    Shapes touching the border of the matrix give surfaces open at the border.
+    """
+    if isinstance(voxels, SparseVoxels):
+        voxels = voxels.to_dense()
+    voxels = np.asarray(voxels)
+    image = image_data(voxels)
+    if hasattr(vtk, 'vtkFlyingEdges3D'):
+        contour = vtk.vtkFlyingEdges3D()
+    else:
+        contour = vtk.vtkMarchingCubes()
+    contour.SetInputData(image)
+    contour.SetValue(0, threshold)
+    contour.ComputeNormalsOff()
+    contour.ComputeGradientsOff()
+    contour.ComputeScalarsOff()
+    output = contour
+
+    if decimate > 0:
+        decimation = vtk.vtkQuadricDecimation()
+        decimation.SetInputConnection(output.GetOutputPort())
+        decimation.SetTargetReduction(decimate)
+        output = decimation
+    if smooth > 0:
+        smoothing = vtk.vtkWindowedSincPolyDataFilter()
+        smoothing.SetInputConnection(output.GetOutputPort())
+        smoothing.SetNumberOfIterations(smooth)
+        smoothing.SetPassBand(0.1)
+        smoothing.NormalizeCoordinatesOn()
+        smoothing.BoundarySmoothingOff()
+        smoothing.FeatureEdgeSmoothingOff()
+        output = smoothing
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputConnection(output.GetOutputPort())
+    normals.SplittingOff()
+
+    # back from image axes to matrix axes: a reflection, so triangles are turned over
+    swap = vtk.vtkTransform()
+    swap.SetMatrix([0, 0, 1, 0, 0, 1, 0, 0, 1, 0, 0, 0, 0, 0, 0, 1])
+    transform = vtk.vtkTransformFilter()
+    transform.SetInputConnection(normals.GetOutputPort())
+    transform.SetTransform(swap)
+    reverse = vtk.vtkReverseSense()
+    reverse.SetInputConnection(transform.GetOutputPort())
+    reverse.ReverseCellsOn()
+    reverse.ReverseNormalsOff()
+    reverse.Update()
+    poly_data = reverse.GetOutput()
+
+    if use_colormap and poly_data.GetNumberOfPoints() > 0:
+        points = numpy_support.vtk_to_numpy(poly_data.GetPoints().GetData())
+        lower = np.clip(np.floor(points - 0.5).astype(np.int64), 0,
+                        np.maximum(np.array(voxels.shape) - 2, 0))
+        confidence = np.zeros(len(points))
+        for corner in CUBE_CORNERS + 0.5:
+            index = np.minimum(lower + corner.astype(np.int64), np.array(voxels.shape) - 1)
+            confidence = np.maximum(confidence, voxels[tuple(index.T)])
+        rgb = np.ascontiguousarray(get_colormap('jet')(confidence)[:, :3] * 255, dtype=np.uint8)
+        colors = numpy_support.numpy_to_vtk(rgb, deep=True)
+        colors.SetName('colors')
+        poly_data.GetPointData().SetScalars(colors)
+
+    print(poly_data.GetNumberOfCells(), "triangles in the isosurface")
+    count(faces=poly_data.GetNumberOfCells())
+    return poly_data
+
+def generate_isosurface(voxels, threshold=0.1, decimate=0, smooth=0, use_colormap=False):
+    """ Generate the isosurface of voxels at threshold as a single actor (see isosurface_polydata) """
+    return mesh_actor(isosurface_polydata(voxels, threshold, decimate=decimate, smooth=smooth,
+                                          use_colormap=use_colormap))
+
+def volume_actor(voxels, threshold=0.1, use_colormap=False, opacity=0.8, gpu=False):
+    """
+    Draw the confidence of voxels by direct volume rendering, without any geometry:
+    a dense matrix is handed to the ray caster as is (see image_data), SparseVoxels are
+    made dense first, and sampled with trilinear interpolation. Confidences below threshold are transparent, above it the
+    opacity per unit length rises linearly up to opacity at 1. Colors are the jet colormap
+    of the confidence if use_colormap is set, uniform red otherwise, as for the blocks.
+    The CPU ray caster (vtkFixedPointVolumeRayCastMapper) works offscreen on any box and
+    lowers its sampling while the camera moves; gpu uses vtkSmartVolumeMapper instead,
+    which ray casts on the GPU when OpenGL has one.
+    """
+    if isinstance(voxels, SparseVoxels):
+        voxels = voxels.to_dense()
+    assert voxels.ndim == 3
+    if gpu:
+        mapper = vtk.vtkSmartVolumeMapper()
+    else:
+        mapper = vtk.vtkFixedPointVolumeRayCastMapper()
+        mapper.SetAutoAdjustSampleDistances(1)
+    # half voxel steps, a step of a voxel shows bands on flat walls; moving the camera
+    # lowers it on the CPU ray caster until the frame is drawn at the desired rate
+    mapper.SetSampleDistance(0.5)
+    mapper.SetInputData(image_data(voxels))
+
+    scalar_opacity = vtk.vtkPiecewiseFunction()
+    scalar_opacity.AddPoint(0, 0)
+    scalar_opacity.AddPoint(threshold, 0)
+    scalar_opacity.AddPoint(1, opacity)
+    colors = vtk.vtkColorTransferFunction()
+    if use_colormap:
+        cmap = get_colormap('jet')
+        for value in np.linspace(0, 1, 17):
+            colors.AddRGBPoint(value, *cmap(value)[:3])
+    else:
+        colors.AddRGBPoint(0, 0.9, 0, 0)
+        colors.AddRGBPoint(1, 0.9, 0, 0)
+
+    volume_property = vtk.vtkVolumeProperty()
+    volume_property.SetScalarOpacity(scalar_opacity)
+    volume_property.SetColor(colors)
+    volume_property.SetInterpolationTypeToLinear()
+    volume_property.ShadeOn()
+    # the lighting of the blocks (see set_block_property)
+    volume_property.SetAmbient(0.5)
+    volume_property.SetDiffuse(0.5)
+    volume_property.SetSpecular(0.1)
+
+    volume = vtk.vtkVolume()
+    volume.SetMapper(mapper)
+    volume.SetProperty(volume_property)
+    # swap back the image axes to the matrix axes (see image_data)
+    swap = vtk.vtkMatrix4x4()
+    swap.DeepCopy((0, 0, 1, 0, 0, 1, 0, 0, 1, 0, 0, 0, 0, 0, 0, 1))
+    volume.SetUserMatrix(swap)
+    count(voxels=voxels.size)
+    return volume
+
+@profiled('export')
+def export_mesh(actors, filename):
+    """
+    Write the geometry of actors as a single mesh at filename, with the format given by its
+    extension: .ply (with vertex colors), .stl, .obj or .vtp. Volumes have no geometry
+    and are left out.
+    """
+    append = vtk.vtkAppendPolyData()
+    for actor in actors:
+        if isinstance(actor, vtk.vtkActor):
+            append.AddInputData(actor.GetMapper().GetInput())
+    append.Update()
+
+    extension = filename.lower().rsplit('.', 1)[-1]
+    if extension == 'ply':
+        writer = vtk.vtkPLYWriter()
+        writer.SetFileTypeToBinary()
+        writer.SetArrayName('colors')
+    elif extension == 'stl':
+        writer = vtk.vtkSTLWriter()
+        writer.SetFileTypeToBinary()
+    elif extension == 'obj':
+        writer = vtk.vtkOBJWriter()
+    else:
+        assert extension == 'vtp', 'unknown mesh format: ' + filename
+        writer = vtk.vtkXMLPolyDataWriter()
+    writer.SetFileName(filename)
+    writer.SetInputData(append.GetOutput())
+    writer.Write()
+    print("Mesh saved to " + filename)
+
+def generate_all_blocks(voxels, threshold=0.1, uniform_size=-1, use_colormap=False, merge=False,
+                        surface=False, lod=False):
     """
     Generate one block per voxel, with block size and color dependent on probability.
     Performance is desirable if number of blocks is below 20,000.
+    voxels is a dense matrix or SparseVoxels, only the voxels above threshold are visited.
+    If merge is set, all blocks are returned as a single actor instead (see generate_merged_blocks).
+    If surface is set and blocks have a uniform size, only the outer surface of the blocks
+    is drawn, as a single actor (see generate_surface_blocks).
+    If lod is set, solid regions are drawn as big blocks (see generate_lod_blocks).
     """
     assert voxels.ndim == 3
+    if lod and not surface:
+        return generate_lod_blocks(voxels, threshold, uniform_size=uniform_size,
+                                   use_colormap=use_colormap, merge=merge)
+    if surface:
+        if 0 < uniform_size <= 1:
+            return [generate_surface_blocks(voxels, threshold, use_colormap=use_colormap)]
+        print("surface mode needs a uniform block size, drawing merged blocks instead")
+        merge = True
+    if merge:
+        return [generate_merged_blocks(voxels, threshold, uniform_size=uniform_size,
+                                       use_colormap=use_colormap)]
     actors = []
-    counter = 0
-    dims = voxels.shape
+    sparse = to_sparse(voxels, threshold)
 
-    cmap = matplotlib.cm.get_cmap('jet')
+    cmap = get_colormap('jet')
     default_color = [0.9, 0, 0]
 
-    for k in range(dims[2]):
-        for j in range(dims[1]):
-            for i in range(dims[0]):
-                occupancy = voxels[i][j][k]
-                if occupancy < threshold:
-                    continue
-
-                if use_colormap:
-                    color = cmap(float(occupancy))
-                else:    # use default color
-                    color = default_color
-
-                if 0 < uniform_size <= 1:
-                    block_size = uniform_size
-                else:
-                    block_size = occupancy
-                block = [i+0.5, j+0.5, k+0.5, block_size, block_size, block_size]
-                actors.append(block_generation(block, color=(color)))
-                counter = counter + 1
-
-    print(counter, "blocks filled")
-    return actors
+    for (i, j, k), occupancy in zip(sparse.coords.tolist(), sparse.values.tolist()):
+        if use_colormap:
+            color = cmap(occupancy)
+        else:    # use default color
+            color = default_color
 
-def display(actors, cam_pos, cam_vocal, cam_up, title=None):
-    """ Display the scene from actors.
-    cam_pos: list of positions of cameras.
-    cam_vocal: vocal point of cameras
-    cam_up: view up direction of cameras
-    title: display window title
-    """
+        if 0 < uniform_size <= 1:
+            block_size = uniform_size
+        else:
+            block_size = occupancy
+        block = [i+0.5, j+0.5, k+0.5, block_size, block_size, block_size]
+        actors.append(block_generation(block, color=(color)))
 
-    ren_win = vtk.vtkRenderWindow()
-    window_size = 1024
+    print(len(actors), "blocks filled")
+    count(blocks=len(actors), faces=6 * len(actors))
+    return actors
 
+def setup_scene(ren_win, actors, cam_pos, cam_vocal, cam_up, window_size=1024):
+    """ Fill a render window with a white background renderer holding actors,
+    seen from the given camera. Renderers already in the window are removed.
+    """
+    ren_win.GetRenderers().RemoveAllItems()
     renderer = vtk.vtkRenderer()
     for actor in actors:
         renderer.AddActor(actor)
@@ -112,6 +529,19 @@ def display(actors, cam_pos, cam_vocal, cam_up, title=None):
     camera.SetPosition(*cam_pos)
 
     ren_win.SetSize(window_size, window_size)
+    renderer.ResetCameraClippingRange()
+    return renderer
+
+def display(actors, cam_pos, cam_vocal, cam_up, title=None):
+    """ Display the scene from actors.
+    cam_pos: list of positions of cameras.
+    cam_vocal: vocal point of cameras
+    cam_up: view up direction of cameras
+    title: display window title
+    """
+
+    ren_win = vtk.vtkRenderWindow()
+    setup_scene(ren_win, actors, cam_pos, cam_vocal, cam_up)
 
     iren = vtk.vtkRenderWindowInteractor()
     style = vtk.vtkInteractorStyleTrackballCamera()
@@ -120,30 +550,259 @@ def display(actors, cam_pos, cam_vocal, cam_up, title=None):
     if title is not None:
         ren_win.SetWindowName(title)
 
-    renderer.ResetCameraClippingRange()
-    ren_win.Render()
+    with stage('render'):
+        ren_win.Render()
 
     iren.Initialize()
     iren.Start()
 
-def visualization(voxels, threshold, title=None, uniform_size=-1, use_colormap=False):
+class InteractiveScene(object):
     """
-    Given a voxel matrix, plot all occupied blocks (defined by voxels[x][y][z] > threshold)
-    if size_change is set to true, block size will be proportional to voxels[x][y][z]
-    otherwise voxel matrix is transfered to {0, 1} matrix,
-    where consecutive blocks are merged for performance.
+    Blocks of a voxel matrix drawn by a VTK pipeline, so that threshold, block size,
+    colormap and component filtering change without rebuilding actors in Python:
+    the matrix is wrapped once as the cell scalars of an image (see image_data), then
+    vtkThreshold keeps the cells above the threshold, vtkConnectivityFilter optionally keeps
+    the largest region (voxels sharing a face, an edge or a corner are connected) and
+    vtkShrinkFilter scales every block around its center.
+    """
+
+    def __init__(self, voxels, threshold=0.1, uniform_size=0.9, use_colormap=False,
+                 largest=False):
+        if isinstance(voxels, SparseVoxels):
+            voxels = voxels.to_dense()
+        self.image = image_data(np.asarray(voxels), cells=True)
+        self.threshold = vtk.vtkThreshold()
+        self.threshold.SetInputData(self.image)
+        self.threshold.SetInputArrayToProcess(0, 0, 0, vtk.vtkDataObject.FIELD_ASSOCIATION_CELLS,
+                                              'confidence')
+        if hasattr(self.threshold, 'SetThresholdFunction'):
+            self.threshold.SetThresholdFunction(vtk.vtkThreshold.THRESHOLD_UPPER)
+        self.connectivity = vtk.vtkConnectivityFilter()
+        self.connectivity.SetInputConnection(self.threshold.GetOutputPort())
+        self.connectivity.SetExtractionModeToLargestRegion()
+        self.shrink = vtk.vtkShrinkFilter()
+
+        lookup = vtk.vtkLookupTable()
+        cmap = get_colormap('jet')
+        lookup.SetNumberOfTableValues(cmap.N)
+        for ind in range(cmap.N):
+            lookup.SetTableValue(ind, *cmap(ind))
+        lookup.SetRange(0, 1)
+        self.mapper = vtk.vtkDataSetMapper()
+        self.mapper.SetInputConnection(self.shrink.GetOutputPort())
+        self.mapper.SetLookupTable(lookup)
+        self.mapper.SetScalarModeToUseCellData()
+        self.mapper.UseLookupTableScalarRangeOn()
+        self.actor = vtk.vtkActor()
+        self.actor.SetMapper(self.mapper)
+        set_block_property(self.actor, (0.9, 0, 0))
+        # back from image axes to matrix axes
+        swap = vtk.vtkMatrix4x4()
+        swap.DeepCopy([0, 0, 1, 0, 0, 1, 0, 0, 1, 0, 0, 0, 0, 0, 0, 1])
+        self.actor.SetUserMatrix(swap)
+
+        self.values = {}
+        self.set_threshold(threshold)
+        self.set_block_size(uniform_size if 0 < uniform_size <= 1 else 1)
+        self.set_colormap(use_colormap)
+        self.set_largest(largest)
+
+    def set_threshold(self, threshold):
+        """ Draw the voxels with a confidence no lower than threshold """
+        if hasattr(self.threshold, 'SetThresholdFunction'):
+            self.threshold.SetUpperThreshold(threshold)
+        else:
+            self.threshold.ThresholdByUpper(threshold)
+        self.values['threshold'] = threshold
+
+    def set_block_size(self, size):
+        """ Set the side of the blocks, in voxels """
+        self.shrink.SetShrinkFactor(size)
+        self.values['block size'] = size
 
-    The function saves an image at address ofilename, with form jpg/png.
-    If form is empty string, no image is saved.
+    def set_colormap(self, use_colormap):
+        """ Color the blocks by confidence, or with a uniform color """
+        self.mapper.SetScalarVisibility(use_colormap)
+        self.values['colormap'] = use_colormap
 
+    def set_largest(self, largest):
+        """ Draw only the largest connected region, or all voxels above threshold """
+        upstream = self.connectivity if largest else self.threshold
+        self.shrink.SetInputConnection(upstream.GetOutputPort())
+        self.values['largest component'] = largest
+
+    def number_of_blocks(self):
+        """ Update the pipeline and return the number of blocks drawn """
+        self.shrink.Update()
+        return self.shrink.GetOutput().GetNumberOfCells()
+
+    def description(self):
+        """ The current settings, one per line """
+        return '\n'.join('%s: %s' % (name, '%.2f' % value if isinstance(value, float) else value)
+                         for name, value in sorted(self.values.items()))
+
+def add_slider(iren, title, value, minimum, maximum, position, callback):
+    """ Add a horizontal slider at the normalized vertical position, calling callback(value) """
+    slider = vtk.vtkSliderRepresentation2D()
+    slider.SetMinimumValue(minimum)
+    slider.SetMaximumValue(maximum)
+    slider.SetValue(value)
+    slider.SetTitleText(title)
+    slider.GetPoint1Coordinate().SetCoordinateSystemToNormalizedDisplay()
+    slider.GetPoint1Coordinate().SetValue(0.05, position)
+    slider.GetPoint2Coordinate().SetCoordinateSystemToNormalizedDisplay()
+    slider.GetPoint2Coordinate().SetValue(0.35, position)
+    for prop in (slider.GetTitleProperty(), slider.GetLabelProperty()):
+        prop.SetColor(0, 0, 0)
+    widget = vtk.vtkSliderWidget()
+    widget.SetInteractor(iren)
+    widget.SetRepresentation(slider)
+    widget.SetAnimationModeToJump()
+    widget.AddObserver('InteractionEvent',
+                       lambda caller, event: callback(caller.GetRepresentation().GetValue()))
+    widget.EnabledOn()
+    return widget
+
+def display_interactive(voxels, threshold=0.1, uniform_size=0.9, use_colormap=False,
+                        largest=False, title=None):
+    """
+    Display the blocks of voxels with controls (see InteractiveScene):
+    sliders for the threshold and the block size, Up/Down keys to step the threshold by 0.01,
+    m to toggle the colormap and l to toggle the largest component.
     """
-    actors = generate_all_blocks(voxels, threshold,
-                                 uniform_size=uniform_size, use_colormap=use_colormap)
+    scene = InteractiveScene(voxels, threshold, uniform_size=uniform_size,
+                             use_colormap=use_colormap, largest=largest)
+    cam_pos, center, cam_up = camera_setup(voxels)
+    ren_win = vtk.vtkRenderWindow()
+    renderer = setup_scene(ren_win, [scene.actor], cam_pos, center, cam_up)
+    text = vtk.vtkTextActor()
+    text.GetTextProperty().SetColor(0, 0, 0)
+    text.SetDisplayPosition(10, 10)
+    renderer.AddActor2D(text)
 
+    iren = vtk.vtkRenderWindowInteractor()
+    iren.SetInteractorStyle(vtk.vtkInteractorStyleTrackballCamera())
+    iren.SetRenderWindow(ren_win)
+    if title is not None:
+        ren_win.SetWindowName(title)
+
+    def update():
+        text.SetInput('%s\nblocks: %d' % (scene.description(), scene.number_of_blocks()))
+        ren_win.Render()
+
+    def set_threshold(value):
+        scene.set_threshold(value)
+        sliders[0].GetRepresentation().SetValue(value)
+        update()
+
+    def set_block_size(value):
+        scene.set_block_size(value)
+        update()
+
+    def key_press(caller, event):
+        key = caller.GetKeySym()
+        if key in ('Up', 'Down'):
+            step = 0.01 if key == 'Up' else -0.01
+            set_threshold(min(max(scene.values['threshold'] + step, 0), 1))
+        elif key == 'm':
+            scene.set_colormap(not scene.values['colormap'])
+            update()
+        elif key == 'l':
+            scene.set_largest(not scene.values['largest component'])
+            update()
+
+    sliders = [add_slider(iren, 'threshold', threshold, 0, 1, 0.92, set_threshold),
+               add_slider(iren, 'block size', scene.values['block size'], 0.1, 1, 0.8,
+                          set_block_size)]
+    iren.AddObserver('KeyPressEvent', key_press)
+    update()
+    iren.Initialize()
+    iren.Start()
+
+def offscreen_window():
+    """ Create a render window that draws offscreen, e.g. on a headless box with OSMesa or EGL """
+    ren_win = vtk.vtkRenderWindow()
+    ren_win.SetOffScreenRendering(1)
+    return ren_win
+
+def save_image(actors, cam_pos, cam_vocal, cam_up, filename, ren_win=None, window_size=1024):
+    """ Render the scene from actors offscreen and save it at filename, as png or jpg.
+    ren_win: an offscreen render window to reuse, a new one is created if None.
+    Return the render window.
+    """
+    if ren_win is None:
+        ren_win = offscreen_window()
+    setup_scene(ren_win, actors, cam_pos, cam_vocal, cam_up, window_size=window_size)
+    with stage('render'):
+        ren_win.Render()
+
+    image = vtk.vtkWindowToImageFilter()
+    image.SetInput(ren_win)
+    image.ReadFrontBufferOff()
+    image.Update()
+    if filename.lower().endswith(('.jpg', '.jpeg')):
+        writer = vtk.vtkJPEGWriter()
+    else:
+        writer = vtk.vtkPNGWriter()
+    writer.SetFileName(filename)
+    writer.SetInputConnection(image.GetOutputPort())
+    writer.Write()
+    return ren_win
+
+def camera_setup(voxels):
+    """ Return the camera position, focal point and view up direction used to show voxels """
     center = center_of_mass(voxels)
     distance = voxels.shape[0] * 2.8
     height = voxels.shape[2] * 0.85
     rad = math.pi * 0.43 #+ math.pi
     cam_pos = [center[0]+distance*math.cos(rad), center[1]+distance*math.sin(rad), center[2]+height]
+    return cam_pos, center, (0, 0, 1)
+
+@profiled('actors')
+def generate_actors(voxels, threshold, uniform_size=-1, use_colormap=False, merge=False,
+                    surface=False, lod=False, isosurface=False, decimate=0, smooth=0, volume=False,
+                    opacity=0.8):
+    """ The actors drawn by visualization() for voxels, see its options """
+    if volume:
+        return [volume_actor(voxels, threshold, use_colormap=use_colormap, opacity=opacity)]
+    if isosurface:
+        return [generate_isosurface(voxels, threshold, decimate=decimate, smooth=smooth,
+                                    use_colormap=use_colormap)]
+    return generate_all_blocks(voxels, threshold, uniform_size=uniform_size,
+                               use_colormap=use_colormap, merge=merge, surface=surface, lod=lod)
+
+def visualization(voxels, threshold, title=None, uniform_size=-1, use_colormap=False, merge=False,
+                  surface=False, lod=False, isosurface=False, decimate=0, smooth=0, volume=False,
+                  opacity=0.8, export=None, filename=None, ren_win=None, actors=None):
+    """
+    Given a voxel matrix, plot all occupied blocks (defined by voxels[x][y][z] > threshold)
+    if size_change is set to true, block size will be proportional to voxels[x][y][z]
+    otherwise voxel matrix is transfered to {0, 1} matrix,
+    where consecutive blocks are merged for performance.
+
+    The function saves an image at address filename, with form jpg/png, rendered offscreen
+    in ren_win if given. If filename is None, the scene is displayed in a window instead.
+
+    If merge is set, all blocks are drawn by a single actor.
+    If surface is set, hidden faces are removed and coplanar faces merged (uniform size only).
+    If lod is set, solid regions are drawn as big blocks from an octree of the voxels.
+    If isosurface is set, the smooth surface at threshold is drawn instead of blocks,
+    with decimate and smooth passed to isosurface_polydata.
+    If volume is set, the confidences are volume rendered instead, with opacity at
+    confidence 1 (see volume_actor).
+    If export is set, the drawn geometry is also saved as a mesh (see export_mesh).
+    actors already generated for voxels (e.g. by generate_actors, or from a cache) are drawn
+    as given.
+    """
+    if actors is None:
+        actors = generate_actors(voxels, threshold, uniform_size=uniform_size,
+                                 use_colormap=use_colormap, merge=merge, surface=surface, lod=lod,
+                                 isosurface=isosurface, decimate=decimate, smooth=smooth,
+                                 volume=volume, opacity=opacity)
+    if export is not None:
+        export_mesh(actors, export)
 
-    display(actors, cam_pos, center, (0, 0, 1), title=title)
+    cam_pos, center, cam_up = camera_setup(voxels)
+    if filename is not None:
+        return save_image(actors, cam_pos, center, cam_up, filename, ren_win=ren_win)
+    display(actors, cam_pos, center, cam_up, title=title)
@@ -2,9 +2,11 @@
 Visualization module
 """
 
-import numpy as np
-from util import read_tensor, downsample, max_connected
-from util_vtk import visualization
+from util import read_tensor, downsample, max_connected, SparseVoxels
+from util_vtk import visualization, generate_actors, display_interactive
+from cache import ShapeCache, voxels_arrays, arrays_voxels, cached_actors, print_report
+import profiling
+from profiling import stage, count
 
 if __name__ == '__main__':
     import argparse
@@ -16,13 +18,14 @@ if __name__ == '__main__':
                             help='the index of objects in the inputfile that should be\
                             rendered (one based)')
     CMD_PARSER.add_argument('filename', metavar='filename', type=str,
-                            help='name of .torch or .mat file to be visualized')
+                            help='name of .mat file or .npz archive to be visualized')
     CMD_PARSER.add_argument('-df', '--downsample-factor', metavar='factor', type=int, default=1,
                             help="downsample objects via a max pooling of step STEPSIZE\
-                            for efficiency. Currently supporting STEPSIZE 1, 2, and 4.")
+                            for efficiency. Any integer STEPSIZE is supported.")
     CMD_PARSER.add_argument('-dm', '--downsample-method', metavar='downsample_method', type=str,
                             default='max', help='downsample method, where mean stands\
-                            for average pooling and max for max pooling')
+                            for average pooling, max for max pooling, min for min pooling\
+                            and occupancy for the fraction of voxels above the threshold')
     CMD_PARSER.add_argument('-u', '--uniform-size', metavar='uniform_size', type=float, default=0.9,
                             help='set the size of the voxels to BLOCK_SIZE')
     CMD_PARSER.add_argument('-cm', '--colormap', action="store_true",
@@ -32,6 +35,70 @@ if __name__ == '__main__':
                             help='whether to keep only the maximal connected component,\
                             where voxels of distance no larger than `DISTANCE` are considered connected.\
                             Set to 0 to disable this function.')
+    CMD_PARSER.add_argument('-mg', '--merge', action="store_true",
+                            help='draw all voxels as a single merged mesh instead of\
+                            one actor per voxel, for large numbers of blocks')
+    CMD_PARSER.add_argument('-sf', '--surface', action="store_true",
+                            help='draw only the outer surface of the voxels, with coplanar\
+                            faces merged. Blocks are drawn at full size without gaps.')
+    CMD_PARSER.add_argument('-lod', '--level-of-detail', action="store_true",
+                            help='draw solid regions as big blocks from an octree of the voxels,\
+                            thin parts staying at voxel size')
+    CMD_PARSER.add_argument('-iso', '--isosurface', action="store_true",
+                            help='draw the smooth surface at the threshold instead of blocks')
+    CMD_PARSER.add_argument('--decimate', metavar='fraction', type=float, default=0,
+                            help='fraction of the isosurface triangles to remove')
+    CMD_PARSER.add_argument('--smooth', metavar='iterations', type=int, default=0,
+                            help='number of smoothing iterations of the isosurface')
+    CMD_PARSER.add_argument('-vol', '--volume', action="store_true",
+                            help='volume render the confidences instead of drawing blocks,\
+                            transparent below the threshold (CPU ray casting, no geometry).\
+                            The matrix is handed to the ray caster without a copy only with\
+                            -mc 0 -df 1: with -mc > 0 the sparse voxels of the component are\
+                            made dense again, and -df > 1 builds a downsampled matrix.\
+                            Not available with --gallery or --interactive.')
+    CMD_PARSER.add_argument('--opacity', metavar='opacity', type=float, default=None,
+                            help='opacity per voxel length of the volume at confidence 1\
+                            (0.8 by default), with --volume')
+    CMD_PARSER.add_argument('-e', '--export', metavar='mesh', type=str, default=None,
+                            help='also save the drawn geometry as a .ply, .stl, .obj or .vtp mesh\
+                            (single shape window only)')
+    CMD_PARSER.add_argument('-nc', '--npy-cache', action="store_true",
+                            help='keep a memory mapped .npy copy of the voxels next to the\
+                            input file, so that later runs only read the rendered shape')
+    CMD_PARSER.add_argument('-o', '--output-dir', metavar='output_dir', type=str, default=None,
+                            help='render offscreen to png images in OUTPUT_DIR instead of\
+                            opening a window, for the shapes given by --range')
+    CMD_PARSER.add_argument('-r', '--range', metavar='range', type=str, default=None,
+                            help='shapes to render with --output-dir (one based): all,\
+                            an index, a range such as 1-100, or a comma separated list.\
+                            Defaults to --index.')
+    CMD_PARSER.add_argument('-in', '--interactive', action="store_true",
+                            help='display the shape with sliders for the threshold and block\
+                            size, Up/Down to step the threshold, m to toggle the colormap and\
+                            l to toggle the max connected component, all updated in place')
+    CMD_PARSER.add_argument('-ca', '--cache', metavar='cache_dir', type=str, default=None,
+                            help='directory of a cache of preprocessed shapes and meshes, so\
+                            that later runs on the same file with the same preprocessing\
+                            skip straight to rendering. It can be shared by several processes.')
+    CMD_PARSER.add_argument('--cache-size', metavar='size', type=float, default=1024,
+                            help='size of the cache in MB, least recently used entries above it\
+                            are removed')
+    CMD_PARSER.add_argument('-j', '--jobs', metavar='jobs', type=int, default=None,
+                            help='number of rendering processes with --output-dir,\
+                            all cores by default')
+    CMD_PARSER.add_argument('-g', '--gallery', action="store_true",
+                            help='show the shapes given by --range (all by default) as a grid,\
+                            PAGE_SIZE per page, Left/Right to change pages. With --output-dir\
+                            every page is saved as an image.')
+    CMD_PARSER.add_argument('--page-size', metavar='page_size', type=int, default=16,
+                            help='number of shapes per page of the gallery')
+    CMD_PARSER.add_argument('--profile', metavar='profile', type=str, default=None,
+                            help='write the wall time, peak memory and counts (voxels, blocks,\
+                            faces) of every stage to PROFILE as JSON, and print them at the end')
+    CMD_PARSER.add_argument('--profile-stage', metavar='stage', type=str, default=None,
+                            help='with --profile, also run the stage STAGE (e.g. max_component,\
+                            actors or render) under cProfile, saving PROFILE.STAGE.prof')
 
     ARGS = CMD_PARSER.parse_args()
     FILENAME = ARGS.filename
@@ -43,28 +110,128 @@ if __name__ == '__main__':
     UNIFORM_SIZE = ARGS.uniform_size
     USE_COLORMAP = ARGS.colormap
     CONNECT = ARGS.max_component
+    MERGE = ARGS.merge
+    SURFACE = ARGS.surface
+    LOD = ARGS.level_of_detail
+    ISOSURFACE = ARGS.isosurface
 
-    assert METHOD in ('max', 'mean')
+    assert METHOD in ('max', 'mean', 'min', 'occupancy')
+    if ARGS.export is not None and (ARGS.gallery or ARGS.output_dir is not None
+                                    or ARGS.interactive):
+        CMD_PARSER.error('--export only applies to the single shape window, not to\
+ --gallery, --output-dir or --interactive')
+    if (ARGS.volume or ARGS.opacity is not None) and (ARGS.gallery or ARGS.interactive):
+        CMD_PARSER.error('--volume and --opacity are not available with --gallery or\
+ --interactive, which draw blocks')
+    if ARGS.opacity is not None and not ARGS.volume:
+        CMD_PARSER.error('--opacity only applies with --volume')
+    OPACITY = 0.8 if ARGS.opacity is None else ARGS.opacity
+
+    if ARGS.profile is not None:
+        import atexit
+        PROFILER = profiling.enable(ARGS.profile, cprofile=ARGS.profile_stage)
+        # printed whichever mode ends the run
+        atexit.register(lambda: profiling.print_report(PROFILER.report()))
+
+    if ARGS.gallery:
+        from render import parse_indices
+        from gallery import Gallery
+        COUNT = read_tensor(FILENAME, MATNAME, lazy=True, cache=ARGS.npy_cache).shape[0]
+        GALLERY = Gallery(FILENAME, parse_indices(ARGS.range or 'all', COUNT), varname=MATNAME,
+                          page_size=ARGS.page_size, threshold=THRESHOLD, connect=CONNECT,
+                          factor=FACTOR, method=METHOD, uniform_size=UNIFORM_SIZE,
+                          use_colormap=USE_COLORMAP, cache=ARGS.npy_cache)
+        if ARGS.output_dir is not None:
+            import os
+            os.makedirs(ARGS.output_dir, exist_ok=True)
+            NAME = os.path.splitext(os.path.basename(FILENAME))[0]
+            REN_WIN = None
+            for PAGE in range(GALLERY.page_count):
+                OUTPUT = os.path.join(ARGS.output_dir, '%s_page_%d.png' % (NAME, PAGE + 1))
+                REN_WIN = GALLERY.save_page(PAGE, OUTPUT, ren_win=REN_WIN)
+                print("==> Saved "+OUTPUT)
+        else:
+            GALLERY.display(title=FILENAME)
+        GALLERY.close()
+        raise SystemExit
+
+    if ARGS.output_dir is not None:
+        # offscreen batch rendering, see render.py
+        from render import parse_indices, render_shapes
+        COUNT = read_tensor(FILENAME, MATNAME, lazy=True, cache=ARGS.npy_cache).shape[0]
+        INDICES = parse_indices(ARGS.range or str(ARGS.index), COUNT)
+        print("==> Rendering "+str(len(INDICES))+" shapes to "+ARGS.output_dir)
+        with stage('render_shapes'):
+            render_shapes(FILENAME, INDICES, ARGS.output_dir, workers=ARGS.jobs, varname=MATNAME,
+                          threshold=THRESHOLD, connect=CONNECT, factor=FACTOR, method=METHOD,
+                          uniform_size=UNIFORM_SIZE, use_colormap=USE_COLORMAP, merge=True,
+                          surface=SURFACE, lod=LOD, isosurface=ISOSURFACE,
+                          decimate=ARGS.decimate, smooth=ARGS.smooth, volume=ARGS.volume,
+                          opacity=OPACITY, cache_dir=ARGS.cache,
+                          cache_bytes=int(ARGS.cache_size * 2**20))
+            count(shapes=len(INDICES))
+        raise SystemExit
 
     # read file
     print("==> Reading input voxel file: "+FILENAME)
-    VOXELS_RAW = read_tensor(FILENAME, MATNAME)
+    VOXELS_RAW = read_tensor(FILENAME, MATNAME, lazy=True, cache=ARGS.npy_cache)
     print("Done")
 
-    VOXELS = VOXELS_RAW[IND]
+    if ARGS.interactive:
+        # the whole matrix is kept, the threshold and component are applied by VTK
+        VOXELS = VOXELS_RAW[IND]
+        if FACTOR > 1:
+            VOXELS = downsample(VOXELS, FACTOR, method=METHOD, threshold=THRESHOLD)
+        display_interactive(VOXELS, THRESHOLD, uniform_size=UNIFORM_SIZE,
+                            use_colormap=USE_COLORMAP, largest=CONNECT > 0,
+                            title=str(IND+1)+'/'+str(VOXELS_RAW.shape[0]))
+        raise SystemExit
+
+    CACHE = None
+    CACHED = None
+    if ARGS.cache is not None:
+        CACHE = ShapeCache(ARGS.cache, max_bytes=int(ARGS.cache_size * 2**20))
+        PARAMS = dict(varname=MATNAME, index=IND, threshold=THRESHOLD, connect=CONNECT,
+                      factor=FACTOR, method=METHOD, pipeline='visualize')
+        SHAPE_KEY = CACHE.key(FILENAME, **PARAMS)
+        CACHED = CACHE.get(SHAPE_KEY)
+
+    if CACHED is not None:
+        print("==> Preprocessed shape read from the cache")
+        VOXELS = arrays_voxels(CACHED)
+    else:
+        with stage('read'):
+            VOXELS = VOXELS_RAW[IND]
+            count(voxels=VOXELS.size)
+
+        # keep only max connected component
+        print("Looking for max connected component")
+        if CONNECT > 0:
+            # voxels outside the component are zeroed, so threshold once and keep the sparse voxels
+            with stage('threshold'):
+                VOXELS = SparseVoxels.from_dense(VOXELS, THRESHOLD)
+                count(voxels_kept=len(VOXELS))
+            VOXELS = max_connected(VOXELS, CONNECT)
 
-    # keep only max connected component
-    print("Looking for max connected component")
-    if CONNECT > 0:
-        VOXELS_KEEP = (VOXELS >= THRESHOLD)
-        VOXELS_KEEP = max_connected(VOXELS_KEEP, CONNECT)
-        VOXELS[np.logical_not(VOXELS_KEEP)] = 0
+        # downsample if needed
+        if FACTOR > 1:
+            print("==> Performing downsample: factor: "+str(FACTOR)+" method: "+METHOD)
+            VOXELS = downsample(VOXELS, FACTOR, method=METHOD, threshold=THRESHOLD)
+            print("Done")
+        if CACHE is not None:
+            CACHE.put(SHAPE_KEY, voxels_arrays(VOXELS))
 
-    # downsample if needed
-    if FACTOR > 1:
-        print("==> Performing downsample: factor: "+str(FACTOR)+" method: "+METHOD)
-        VOXELS = downsample(VOXELS, FACTOR, method=METHOD)
-        print("Done")
+    OPTIONS = dict(uniform_size=UNIFORM_SIZE, use_colormap=USE_COLORMAP, merge=MERGE,
+                   surface=SURFACE, lod=LOD, isosurface=ISOSURFACE, decimate=ARGS.decimate,
+                   smooth=ARGS.smooth, volume=ARGS.volume, opacity=OPACITY)
+    ACTORS = None
+    if CACHE is not None and (MERGE or SURFACE or ISOSURFACE) and not ARGS.volume:
+        # modes drawing a single mesh, which is cached as well
+        MESH_KEY = CACHE.key(FILENAME, mesh=True, **dict(PARAMS, **OPTIONS))
+        ACTORS = cached_actors(CACHE, MESH_KEY,
+                               lambda: generate_actors(VOXELS, THRESHOLD, **OPTIONS))
+    if CACHE is not None:
+        print_report(CACHE.report())
 
     visualization(VOXELS, THRESHOLD, title=str(IND+1)+'/'+str(VOXELS_RAW.shape[0]),
-                  uniform_size=UNIFORM_SIZE, use_colormap=USE_COLORMAP)
+                  export=ARGS.export, actors=ACTORS, **OPTIONS)
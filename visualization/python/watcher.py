@@ -0,0 +1,276 @@
+"""
+Watcher preprocessing, screening and rendering the tensor files of main.lua as they land
+"""
+
+import os
+import json
+import time
+import hashlib
+import asyncio
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from util import read_tensor, shape_statistics
+from stats import statistics_rows, write_statistics
+from batch import preprocess_file
+from render import parse_indices, render_shapes
+
+STAGES = ('preprocess', 'stats', 'render')
+
+def file_signature(path):
+    """ Size and modification time of path, which change when the file is written again """
+    stat = os.stat(path)
+    return '%d:%d' % (stat.st_size, stat.st_mtime_ns)
+
+def scan(directory, extensions=('.mat', '.npz')):
+    """ {path: signature} of the tensor files directly in directory """
+    files = {}
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.name.endswith(extensions):
+            try:
+                files[entry.path] = file_signature(entry.path)
+            except OSError:
+                continue    # removed since listed
+    return files
+
+class WorkState(object):
+    """
+    Stages done for each input file, with the signature the file had then, kept in a JSON
+    file so that a restarted watcher skips them. A file written again has a new signature,
+    so all its stages run again. The watcher adds the parameters of each stage to the
+    signature (see Watcher.stage_signature), so that a stage run with other parameters is
+    not skipped either.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        if os.path.exists(path):
+            with open(path) as state_file:
+                self.done = json.load(state_file)
+
+    def is_done(self, filename, stage, signature):
+        """ Whether stage was done on filename with signature """
+        return self.done.get(filename, {}).get(stage) == signature
+
+    def mark(self, filename, stage, signature):
+        """ Record that stage was done on filename with signature """
+        self.done.setdefault(filename, {})[stage] = signature
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+        with os.fdopen(handle, 'w') as state_file:
+            json.dump(self.done, state_file, indent=1)
+        os.replace(temp_path, self.path)
+
+class Watcher(object):
+    """
+    Watch directory for new or rewritten tensor files and run on each of them, in
+    results_dir (directory/processed by default):
+    preprocess: max connected component and downsample to NAME.pre.npy (see batch.py)
+    stats: per-shape statistics of the raw shapes to NAME.stats.csv (see stats.py)
+    render: offscreen images of the preprocessed shapes in the range in NAME/ (see render.py)
+    A file is queued once its signature is the same on two scans in a row, as main.lua
+    writes it in one go at the end of a class. Files go through bounded asyncio queues, one
+    per stage: when a stage is behind, the stages feeding it and then the scan wait, rather
+    than piling up work. Stages run in threads: preprocessing and rendering each over a pool
+    of jobs processes, statistics in their thread, so the statistics of a file and the
+    rendering of the previous one overlap while Torch generates the next class. If jobs is
+    None, preprocessing and rendering share the cores, half each when both run. Stages
+    already done on a file with the same signature and parameters are skipped, also across
+    restarts (see WorkState).
+    """
+
+    def __init__(self, directory, results_dir=None, interval=5., queue_size=2, stages=STAGES,
+                 threshold=0.1, connect=3, factor=1, method='max', shapes='all', jobs=None,
+                 render_options=None):
+        assert all(stage in STAGES for stage in stages)
+        self.directory = directory
+        self.results_dir = results_dir or os.path.join(directory, 'processed')
+        if not os.path.isdir(self.results_dir):
+            os.makedirs(self.results_dir)
+        self.interval = interval
+        self.queue_size = queue_size
+        self.stages = stages
+        self.preprocessing = {'threshold': threshold, 'connect': connect, 'factor': factor,
+                              'method': method}
+        self.shapes = shapes
+        if jobs is None:
+            # both pools run at the same time on different files
+            pools = len([stage for stage in stages if stage in ('preprocess', 'render')])
+            jobs = max(1, (os.cpu_count() or 1) // max(pools, 1))
+        self.jobs = jobs
+        self.render_options = render_options or {}
+        self.state = WorkState(os.path.join(self.results_dir, 'watcher.json'))
+
+    def output(self, filename, suffix):
+        """ Path in results_dir of the output of filename with suffix """
+        name = os.path.splitext(os.path.basename(filename))[0]
+        return os.path.join(self.results_dir, name + suffix)
+
+    def parameters(self, stage):
+        """ Parameters the output of stage depends on """
+        if stage == 'preprocess':
+            return self.preprocessing
+        if stage == 'stats':
+            return {'threshold': self.preprocessing['threshold'],
+                    'connect': self.preprocessing['connect']}
+        return {'preprocessing': self.preprocessing, 'shapes': self.shapes,
+                'render_options': self.render_options,
+                'preprocessed': 'preprocess' in self.stages}
+
+    def stage_signature(self, stage, signature):
+        """ signature of an input file joined to a hash of the parameters of stage """
+        parameters = json.dumps(self.parameters(stage), sort_keys=True, default=repr)
+        return '%s:%s' % (signature, hashlib.sha1(parameters.encode()).hexdigest()[:16])
+
+    def preprocess(self, filename):
+        """ Preprocess all shapes of filename to a .npy file """
+        preprocess_file(filename, self.output(filename, '.pre.npy'), workers=self.jobs,
+                        **self.preprocessing)
+
+    def statistics(self, filename):
+        """ Statistics of the raw shapes of filename to a .csv file """
+        columns = shape_statistics(read_tensor(filename, lazy=True),
+                                   [self.preprocessing['threshold']],
+                                   distance=self.preprocessing['connect'])
+        with open(self.output(filename, '.stats.csv'), 'w') as output:
+            write_statistics(statistics_rows(columns), output)
+
+    def render(self, filename):
+        """ Render the shapes of filename, preprocessed if that stage runs, to images """
+        name = os.path.splitext(os.path.basename(filename))[0]
+        source, options = filename, dict(self.preprocessing)
+        if 'preprocess' in self.stages:
+            source = self.output(filename, '.pre.npy')
+            options.update(connect=0, factor=1)
+        count = read_tensor(source, lazy=True).shape[0]
+        options.update(self.render_options)
+        render_shapes(source, parse_indices(self.shapes, count), self.output(filename, ''),
+                      workers=self.jobs, pattern=name + '_%d.png', **options)
+
+    def pending(self, filename, signature):
+        """ Whether some stage is still to be done on filename with signature """
+        return any(not self.state.is_done(filename, stage, self.stage_signature(stage, signature))
+                   for stage in self.stages)
+
+    async def run_stage(self, stage, function, queue, next_queues, executor):
+        """
+        Run function on the (filename, signature) items of queue in executor, then pass them
+        to next_queues, until a None item, which is passed on as well.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await queue.get()
+            if item is None:
+                for next_queue in next_queues:
+                    await next_queue.put(None)
+                return
+            filename, signature = item
+            stage_signature = self.stage_signature(stage, signature)
+            if self.state.is_done(filename, stage, stage_signature):
+                print("==> %s of %s already done" % (stage, filename))
+            else:
+                print("==> %s of %s" % (stage, filename))
+                start = time.time()
+                try:
+                    await loop.run_in_executor(executor, function, filename)
+                except Exception as error:  # pylint: disable=broad-except
+                    # keep watching, the file is tried again when it changes or on restart
+                    print("==> %s of %s failed: %r" % (stage, filename, error))
+                    continue
+                self.state.mark(filename, stage, stage_signature)
+                print("==> %s of %s done in %.1f s" % (stage, filename, time.time() - start))
+            for next_queue in next_queues:
+                # waits while the next stage is behind
+                await next_queue.put(item)
+
+    async def run(self, once=False):
+        """
+        Watch the directory until cancelled, or if once is set, process the files already
+        there (without waiting for them to settle) and return.
+        """
+        queues = dict((stage, asyncio.Queue(self.queue_size)) for stage in self.stages)
+        functions = {'preprocess': self.preprocess, 'stats': self.statistics,
+                     'render': self.render}
+        # rendering follows preprocessing when both run, other stages start from the scan
+        followers = dict((stage, []) for stage in self.stages)
+        first = list(self.stages)
+        if 'preprocess' in queues and 'render' in queues:
+            followers['preprocess'].append(queues['render'])
+            first.remove('render')
+
+        executor = ThreadPoolExecutor(max_workers=len(self.stages))
+        tasks = [asyncio.ensure_future(self.run_stage(stage, functions[stage], queues[stage],
+                                                      followers[stage], executor))
+                 for stage in self.stages]
+        queued = {}
+        previous = {}
+        try:
+            while True:
+                current = scan(self.directory)
+                for filename, signature in sorted(current.items()):
+                    settled = once or previous.get(filename) == signature
+                    if settled and queued.get(filename) != signature and \
+                       self.pending(filename, signature):
+                        queued[filename] = signature
+                        for stage in first:
+                            # waits while the stage is behind
+                            await queues[stage].put((filename, signature))
+                previous = current
+                if once:
+                    break
+                await asyncio.sleep(self.interval)
+            for stage in first:
+                await queues[stage].put(None)
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            executor.shutdown(wait=False)
+
+if __name__ == '__main__':
+    import argparse
+    CMD_PARSER = argparse.ArgumentParser(description="""Watching the output directory of
+                                         main.lua, and preprocessing, screening and rendering
+                                         every new or rewritten .mat file. """)
+    CMD_PARSER.add_argument('directory', metavar='directory', type=str,
+                            help='directory of the .mat files, e.g. ./output')
+    CMD_PARSER.add_argument('-d', '--results-dir', metavar='results_dir', type=str, default=None,
+                            help='directory of the results, DIRECTORY/processed by default')
+    CMD_PARSER.add_argument('-s', '--stages', metavar='stage', type=str, nargs='+',
+                            default=list(STAGES), help='stages to run: preprocess, stats\
+                            and render')
+    CMD_PARSER.add_argument('-r', '--range', metavar='range', type=str, default='all',
+                            help='shapes to render (one based): all, an index, a range such\
+                            as 1-100, or a comma separated list')
+    CMD_PARSER.add_argument('-t', '--threshold', metavar='threshold', type=float, default=0.1,
+                            help='voxels with confidence lower than the threshold are empty')
+    CMD_PARSER.add_argument('-mc', '--max-component', metavar='max_component', type=int, default=3,
+                            help='keep only the maximal connected component, where voxels of\
+                            distance no larger than `DISTANCE` are considered connected.\
+                            Set to 0 to disable this function.')
+    CMD_PARSER.add_argument('-df', '--downsample-factor', metavar='factor', type=int, default=1,
+                            help='downsample factor')
+    CMD_PARSER.add_argument('-dm', '--downsample-method', metavar='downsample_method', type=str,
+                            default='max', help='downsample method: max, mean, min or occupancy')
+    CMD_PARSER.add_argument('-cm', '--colormap', action="store_true",
+                            help='render with a colormap of the voxel occupancy')
+    CMD_PARSER.add_argument('-i', '--interval', metavar='seconds', type=float, default=5,
+                            help='time between two scans of the directory')
+    CMD_PARSER.add_argument('-q', '--queue-size', metavar='size', type=int, default=2,
+                            help='number of files waiting for each stage before the\
+                            previous stages wait')
+    CMD_PARSER.add_argument('-j', '--jobs', metavar='jobs', type=int, default=None,
+                            help='number of processes of each of the preprocessing and rendering\
+                            stages, half of the cores each by default (all when only one runs)')
+    CMD_PARSER.add_argument('--once', action="store_true",
+                            help='process the files already in the directory, then exit')
+
+    ARGS = CMD_PARSER.parse_args()
+    WATCHER = Watcher(ARGS.directory, ARGS.results_dir, interval=ARGS.interval,
+                      queue_size=ARGS.queue_size, stages=ARGS.stages, threshold=ARGS.threshold,
+                      connect=ARGS.max_component, factor=ARGS.downsample_factor,
+                      method=ARGS.downsample_method, shapes=ARGS.range, jobs=ARGS.jobs,
+                      render_options={'use_colormap': ARGS.colormap})
+    try:
+        asyncio.run(WATCHER.run(once=ARGS.once))
+    except KeyboardInterrupt:
+        pass